@@ -1,109 +1,433 @@
 # backend/api/omr.py
+import asyncio
+import hashlib
 import io
+import tarfile
 import uuid
-import shutil
-from typing import Optional
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, UploadFile, File, Form, BackgroundTasks, Depends, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from core.config import settings
 from db.session import get_db
 from db import crud  # implement later: create_sheet_record, update_sheet_status, get_sheet_by_id
-from services import omr_service  # implement later: process_sheet(file_path, sheet_id, exam_id, version)
 from db.models import Sheet  # model placeholder
+from services.document_service import DocumentPageError, iter_document_pages, pdf_supported, sniff_document_format
+from services.ingest_service import IngestError, ingest_batch, sniff_image_format, SNIFF_BYTES
+from services.overlay_service import get_overlay, overlay_key
+from services.storage_service import (
+    resolve_image, store_upload, store_upload_bytes, upload_buffers, UPLOAD_CHUNK_SIZE,
+    media_type as storage_media_type,
+)
+from utils.http_utils import file_etag, etag_matches
 
 router = APIRouter(prefix="/omr", tags=["omr"])
 
+DUPLICATE_POLICIES = ("existing", "reject")
+
+
+def _duplicate_policy(value: Optional[str]) -> str:
+    policy = (value or settings.DUPLICATE_UPLOAD_POLICY).lower()
+    if policy not in DUPLICATE_POLICIES:
+        raise HTTPException(status_code=400, detail=f"on_duplicate must be one of: {', '.join(DUPLICATE_POLICIES)}")
+    return policy
+
+
+async def _read_image_upload(file: UploadFile, max_bytes: int):
+    """
+    Read an uploaded image in chunks, hashing as it goes. Fails with 413 as soon as it
+    passes max_bytes and with 415 when the leading bytes aren't a supported image format
+    (the client's content_type is not trusted). Returns (data, extension, sha256 hex).
+    """
+    buf = bytearray()
+    digest = hashlib.sha256()
+    ext = None
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        buf += chunk
+        digest.update(chunk)
+        if len(buf) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"File exceeds {max_bytes // (1024 * 1024)} MB")
+        if ext is None and len(buf) >= SNIFF_BYTES:
+            ext = _sniff_or_415(bytes(buf[:SNIFF_BYTES]))
+    if ext is None:
+        ext = _sniff_or_415(bytes(buf))
+    return bytes(buf), ext, digest.hexdigest()
+
+
+def _sniff_or_415(head: bytes) -> str:
+    fmt = sniff_image_format(head)
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Unsupported file type; expected JPEG, PNG, TIFF, WebP or BMP")
+    return fmt[1]
+
+
+def _duplicate_response(sheet: Sheet, policy: str):
+    if policy == "reject":
+        raise HTTPException(status_code=409, detail={"message": "Duplicate upload", "sheet_id": sheet.sheet_id})
+    return JSONResponse(status_code=200, content={
+        "sheet_id": sheet.sheet_id,
+        "status": sheet.status,
+        "duplicate": True,
+    })
+
+
+async def _requeue_errored(db: AsyncSession, sheet: Sheet, data: bytes, ext: str) -> bool:
+    """
+    Re-run a dead-lettered sheet whose bytes were uploaded again, instead of returning it as a
+    duplicate (the archived copy is put back first in case it went missing). False when the
+    sheet isn't in "error" (any more).
+    """
+    if sheet.status != "error":
+        return False
+    await asyncio.to_thread(store_upload_bytes, data, sheet.content_hash, ext, settings)
+    upload_buffers.put(sheet.sheet_id, data)
+    if await crud.requeue_errored_sheets(db, [sheet], max_attempts=settings.JOB_MAX_ATTEMPTS):
+        return True
+    upload_buffers.pop(sheet.sheet_id)
+    return False
+
 
 @router.post("/upload", status_code=201)
 async def upload_omr_sheet(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     exam_id: str = Form(...),
     student_id: str = Form(...),
     version: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    on_duplicate: Optional[str] = Form(None),
+    db: AsyncSession = Depends(get_db),
     user=Depends(lambda: None),  # placeholder for auth dependency; replace with get_current_active_user
 ):
     """
-    Upload an OMR sheet image. Returns a sheet_id. Processing is done in background.
-    Required form fields: exam_id, student_id. Optional: version (A/B).
+    Upload an OMR sheet image. Returns a sheet_id. Processing is done by the job queue workers.
+    Required form fields: exam_id, student_id. Optional: version (A/B), on_duplicate.
+    An exact re-upload (same bytes, same exam) is not processed again: with on_duplicate
+    "existing" (default: DUPLICATE_UPLOAD_POLICY) the existing sheet is returned, with "reject" 409.
+    A re-upload of a sheet that failed (status "error") re-enqueues that sheet instead.
     """
-    # Basic validation
-    if file.content_type.split("/")[0] != "image":
-        raise HTTPException(status_code=400, detail="Only image files are allowed")
+    policy = _duplicate_policy(on_duplicate)
+
+    # read (size-limited, magic-byte validated) and hash in one pass
+    data, ext, content_hash = await _read_image_upload(file, settings.MAX_UPLOAD_SIZE_MB * 1024 * 1024)
+
+    existing = await crud.get_sheet_by_content_hash(db, exam_id, content_hash)
+    if existing is not None:
+        if await _requeue_errored(db, existing, data, ext):
+            return {"sheet_id": existing.sheet_id, "status": "queued", "requeued": True}
+        return _duplicate_response(existing, policy)
 
     # create a unique sheet id
     sheet_id = str(uuid.uuid4())
 
-    # save file to disk
-    upload_path = settings.UPLOAD_DIR / f"{sheet_id}_{file.filename}"
-    with upload_path.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    # create DB record (status = pending)
-    # Implement crud.create_sheet_record(db, sheet_id, exam_id, student_id, version, original_path)
-    await crud.create_sheet_record(
-        db=db,
-        sheet_id=sheet_id,
-        exam_id=exam_id,
-        student_id=student_id,
-        version=version,
-        original_path=str(upload_path),
-    )
-
-    # enqueue background task to process the sheet
-    background_tasks.add_task(
-        _process_sheet_background, str(upload_path), sheet_id, exam_id, version
-    )
+    # archive to content-addressed storage before the job exists: a standalone worker reads
+    # the file; a worker in this process decodes the in-memory copy instead
+    original_path, _ = await asyncio.to_thread(store_upload_bytes, data, content_hash, ext, settings)
+    upload_buffers.put(sheet_id, data)
+
+    # create DB record (status = pending) and its processing job in one transaction;
+    # a worker (embedded or `python -m backend.worker`) picks it up from the jobs table
+    try:
+        await crud.create_sheet_and_enqueue(
+            db=db,
+            sheet_id=sheet_id,
+            exam_id=exam_id,
+            student_id=student_id,
+            version=version,
+            original_path=str(original_path),
+            max_attempts=settings.JOB_MAX_ATTEMPTS,
+            content_hash=content_hash,
+        )
+    except IntegrityError:
+        # the same bytes were uploaded concurrently and won the unique index
+        upload_buffers.pop(sheet_id)
+        await db.rollback()
+        existing = await crud.get_sheet_by_content_hash(db, exam_id, content_hash)
+        if existing is None:
+            raise
+        if await _requeue_errored(db, existing, data, ext):
+            return {"sheet_id": existing.sheet_id, "status": "queued", "requeued": True}
+        return _duplicate_response(existing, policy)
 
     return {"sheet_id": sheet_id, "status": "queued"}
 
 
-async def _process_sheet_background(file_path: str, sheet_id: str, exam_id: str, version: Optional[str]):
+@router.post("/upload-batch", status_code=201)
+async def upload_omr_batch(
+    exam_id: str = Form(...),
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    manifest: Optional[UploadFile] = File(None),
+    on_duplicate: Optional[str] = Form(None),
+    db: AsyncSession = Depends(get_db),
+    user=Depends(lambda: None),  # placeholder for auth dependency; replace with get_current_active_user
+):
     """
-    wrapper for calling the service to process the sheet.
-    Uses the omr_service to process and will update DB via crud functions.
+    Upload many OMR sheets at once: loose image files and/or a ZIP/TAR archive.
+    The CSV manifest (filename,student_id[,version]) can be posted as `manifest` or be
+    included in the archive as manifest.csv; without one the file name stem is the student_id.
+    Entries are streamed to disk one by one and all sheets are inserted in one bulk statement.
+    Exact duplicates (of earlier entries or of sheets already in the exam) are not enqueued:
+    they are listed under "duplicates" (on_duplicate="existing") or "skipped" ("reject").
+    Entries matching a sheet that failed (status "error") re-enqueue that sheet; they are
+    listed under "sheets" with "requeued": true.
     """
+    if not files and archive is None:
+        raise HTTPException(status_code=400, detail="Provide image files and/or an archive")
+    policy = _duplicate_policy(on_duplicate)
+
+    manifest_bytes = await manifest.read() if manifest is not None else None
+    manifest_name = (manifest.filename or "manifest") if manifest is not None else "manifest.csv"
+    loose = [(f.filename, f.file) for f in (files or [])]
+    archive_arg = (archive.filename or "", archive.file) if archive is not None else None
     try:
-        # process_sheet should save processed images and results to DB via crud
-        result = await omr_service.process_sheet(file_path, sheet_id, exam_id, version, settings)
-        # result expected: dict with answers, per_subject scores, total, flags, paths, confidence
-        # update DB record to processed
-        # await crud.update_sheet_result(db, sheet_id, result)
-        # We do not have db here; omr_service should persist results itself or crud functions should be imported
-    except Exception as e:
-        # Ideally update DB with error state
+        rows, duplicates, skipped = await asyncio.to_thread(
+            ingest_batch, exam_id, loose, archive_arg, manifest_bytes, settings, manifest_name)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise HTTPException(status_code=400, detail=f"Unreadable archive: {e}")
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not rows and not duplicates:
+        raise HTTPException(status_code=400, detail={"message": "No sheets found in upload", "skipped": skipped})
+
+    batch_id = str(uuid.uuid4())
+    for attempt in range(2):
+        existing = await crud.get_sheets_by_content_hashes(db, exam_id, [r["content_hash"] for r in rows])
+        new_rows = [r for r in rows if r["content_hash"] not in existing]
         try:
-            # await crud.update_sheet_status_error(db, sheet_id, str(e))
-            pass
-        finally:
-            # Logging omitted here, but should log
-            print(f"Error processing sheet {sheet_id}: {e}")
+            await crud.bulk_create_sheets_and_enqueue(db, new_rows, batch_id=batch_id, max_attempts=settings.JOB_MAX_ATTEMPTS)
+            break
+        except IntegrityError:
+            # a concurrent upload inserted some of the same bytes; re-check once
+            await db.rollback()
+            if attempt:
+                raise HTTPException(status_code=409, detail="Concurrent upload of the same sheets, please retry")
+
+    # failed sheets uploaded again get another run (their files were just re-archived by ingest)
+    requeued = set(await crud.requeue_errored_sheets(
+        db, [s for s in existing.values() if s.status == "error"], max_attempts=settings.JOB_MAX_ATTEMPTS))
+    requeued_rows = [r for r in rows if r["content_hash"] in existing
+                     and existing[r["content_hash"]].sheet_id in requeued]
+
+    # every hash of this upload -> the sheet that holds it
+    by_hash: Dict[str, dict] = {
+        h: {"sheet_id": s.sheet_id, "status": "queued" if s.sheet_id in requeued else s.status}
+        for h, s in existing.items()
+    }
+    by_hash.update({r["content_hash"]: {"sheet_id": r["sheet_id"], "status": "queued"} for r in new_rows})
+    duplicates = duplicates + [{"filename": r["filename"], "content_hash": r["content_hash"]}
+                               for r in rows if r["content_hash"] in existing
+                               and existing[r["content_hash"]].sheet_id not in requeued]
+    resolved = []
+    for d in duplicates:
+        target = by_hash.get(d["content_hash"])
+        if target is None:
+            skipped.append({"filename": d["filename"], "reason": "duplicate of a skipped entry"})
+        elif policy == "reject":
+            skipped.append({"filename": d["filename"], "reason": "duplicate", "sheet_id": target["sheet_id"]})
+        else:
+            resolved.append({"filename": d["filename"], **target})
+
+    return {
+        "batch_id": batch_id,
+        "count": len(new_rows) + len(requeued_rows),
+        "status": "queued",
+        "sheets": [{"sheet_id": r["sheet_id"], "filename": r["filename"], "student_id": r["student_id"]} for r in new_rows]
+        + [{"sheet_id": existing[r["content_hash"]].sheet_id, "filename": r["filename"],
+            "student_id": existing[r["content_hash"]].student_id, "requeued": True} for r in requeued_rows],
+        "duplicates": resolved,
+        "skipped": skipped,
+    }
+
+
+@router.post("/upload-document", status_code=201)
+async def upload_omr_document(
+    file: UploadFile = File(...),
+    exam_id: str = Form(...),
+    version: Optional[str] = Form(None),
+    on_duplicate: Optional[str] = Form(None),
+    db: AsyncSession = Depends(get_db),
+    user=Depends(lambda: None),  # placeholder for auth dependency; replace with get_current_active_user
+):
+    """
+    Upload a multi-page scan (PDF or TIFF). Pages are extracted one at a time and each is
+    enqueued as its own sheet as soon as it is extracted, so processing starts before the
+    last page is out. Pages get a placeholder student_id ("<document>-p<page>") that is
+    replaced by the id read from the sheet when the template has a student_id grid.
+    """
+    policy = _duplicate_policy(on_duplicate)
+    head = await file.read(SNIFF_BYTES)
+    await file.seek(0)
+    fmt = sniff_document_format(head)
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Expected a PDF or TIFF document; use /upload for single images")
+    if fmt == "pdf" and not pdf_supported():
+        raise HTTPException(status_code=415, detail="PDF documents are not supported on this server (PyMuPDF missing)")
+
+    content_hash, doc_path, _ = await asyncio.to_thread(store_upload, file.file, file.filename, settings)
+    document_id = str(uuid.uuid4())
+    await crud.create_document(db, document_id, exam_id, file.filename, str(doc_path), content_hash, fmt)
+
+    sheets, duplicates, skipped = [], [], []
+    pages = iter_document_pages(doc_path, fmt, settings)
+    page_count = 0
+    try:
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            page_count, data = page
+            page_hash = hashlib.sha256(data).hexdigest()
+            existing = await crud.get_sheet_by_content_hash(db, exam_id, page_hash)
+            if existing is None:
+                sheet_id = str(uuid.uuid4())
+                path, _ = await asyncio.to_thread(store_upload_bytes, data, page_hash, ".png", settings)
+                upload_buffers.put(sheet_id, data)
+                row = {
+                    "sheet_id": sheet_id,
+                    "exam_id": exam_id,
+                    "student_id": f"{document_id[:8]}-p{page_count}",
+                    "version": version,
+                    "original_path": str(path),
+                    "content_hash": page_hash,
+                    "document_id": document_id,
+                    "page_number": page_count,
+                }
+                try:
+                    # committed per page: workers pick it up while extraction continues
+                    await crud.bulk_create_sheets_and_enqueue(db, [row], max_attempts=settings.JOB_MAX_ATTEMPTS)
+                    sheets.append({"sheet_id": sheet_id, "page_number": page_count})
+                    continue
+                except IntegrityError:
+                    upload_buffers.pop(sheet_id)
+                    await db.rollback()
+                    existing = await crud.get_sheet_by_content_hash(db, exam_id, page_hash)
+                    if existing is None:
+                        raise
+            if await _requeue_errored(db, existing, data, ".png"):
+                sheets.append({"sheet_id": existing.sheet_id, "page_number": page_count, "requeued": True})
+                continue
+            if policy == "reject":
+                skipped.append({"page_number": page_count, "reason": "duplicate", "sheet_id": existing.sheet_id})
+            else:
+                duplicates.append({"page_number": page_count, "sheet_id": existing.sheet_id, "status": existing.status})
+    except DocumentPageError as e:
+        await db.rollback()
+        await crud.finish_document(db, document_id, page_count, status="error", error_message=str(e))
+        raise HTTPException(status_code=400, detail={
+            "message": f"Could not read page {page_count + 1} of the document",
+            "document_id": document_id,
+            "sheets": sheets,
+        })
+    finally:
+        pages.close()
+
+    await crud.finish_document(db, document_id, page_count)
+    return {
+        "document_id": document_id,
+        "page_count": page_count,
+        "count": len(sheets),
+        "status": "queued",
+        "sheets": sheets,
+        "duplicates": duplicates,
+        "skipped": skipped,
+    }
+
+
+@router.get("/document/{document_id}")
+async def get_document_status(document_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Extraction status of a multi-page document and the processing status of its pages.
+    """
+    doc = await crud.get_document(db, document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    pages = await crud.get_document_sheets(db, document_id)
+    return {
+        "document_id": document_id,
+        "exam_id": doc.exam_id,
+        "filename": doc.filename,
+        "status": doc.status,
+        "page_count": doc.page_count,
+        "error": doc.error_message,
+        "sheets": [
+            {"sheet_id": s.sheet_id, "page_number": s.page_number, "student_id": s.student_id, "status": s.status}
+            for s in pages
+        ],
+    }
 
 
 @router.get("/status/{sheet_id}")
-async def get_sheet_status(sheet_id: str, db: Session = Depends(get_db)):
+async def get_sheet_status(sheet_id: str, db: AsyncSession = Depends(get_db)):
     """
     Get processing status of a sheet.
     """
     sheet = await crud.get_sheet_by_id(db, sheet_id)
     if not sheet:
         raise HTTPException(status_code=404, detail="Sheet not found")
-    return {"sheet_id": sheet_id, "status": sheet.status, "processed_at": sheet.processed_at}
+    return {"sheet_id": sheet_id, "status": sheet.status, "processed_at": sheet.processed_at, "error": sheet.error_message}
+
+
+def _cache_headers(etag: str, filename: str) -> dict:
+    return {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={settings.IMAGE_CACHE_MAX_AGE}",
+        "Content-Disposition": f'inline; filename="{filename}"',
+    }
+
+
+@router.get("/image/{sheet_id}")
+async def get_sheet_image(sheet_id: str, request: Request, width: Optional[int] = None, db: AsyncSession = Depends(get_db)):
+    """
+    Return the processed (warped) sheet image, or the smallest stored thumbnail at least
+    `width` pixels wide. Supports ETag / If-None-Match revalidation.
+    """
+    sheet = await crud.get_sheet_by_id(db, sheet_id)
+    if not sheet:
+        raise HTTPException(status_code=404, detail="Sheet not found")
+    if not sheet.warped_path:
+        raise HTTPException(status_code=404, detail="Image not available")
+    path, media_type = resolve_image(sheet.warped_path, width)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Image not available")
+    etag = file_etag(path)
+    headers = _cache_headers(etag, path.name)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
 
 
 @router.get("/overlay/{sheet_id}")
-async def get_overlay_image(sheet_id: str, db: Session = Depends(get_db)):
+async def get_overlay_image(sheet_id: str, request: Request, db: AsyncSession = Depends(get_db)):
     """
-    Return overlay image (if available) for human review.
+    Return overlay image for human review. Rendered from the warped image and the
+    compiled template on first request, then served from the overlay cache.
     """
     sheet = await crud.get_sheet_by_id(db, sheet_id)
     if not sheet:
         raise HTTPException(status_code=404, detail="Sheet not found")
-    overlay_path = sheet.overlay_path if hasattr(sheet, "overlay_path") else None
-    if not overlay_path:
+    # sheets processed before overlays became lazy have a pre-rendered file
+    if sheet.overlay_path and Path(sheet.overlay_path).exists():
+        etag = file_etag(Path(sheet.overlay_path))
+        headers = _cache_headers(etag, f"{sheet_id}_overlay.jpg")
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(sheet.overlay_path, media_type="image/jpeg", headers=headers)
+    result = await crud.get_result_by_sheet(db, sheet_id)
+    if not sheet.warped_path or not result:
+        raise HTTPException(status_code=404, detail="Overlay not available")
+    etag = f'"{overlay_key(sheet_id, result["answers"])}"'
+    headers = _cache_headers(etag, f"{sheet_id}_overlay{Path(sheet.warped_path).suffix}")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    try:
+        data = await get_overlay(sheet_id, sheet.exam_id, sheet.warped_path, result["answers"], settings)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Overlay not available")
-    return FileResponse(overlay_path, media_type="image/jpeg", filename=f"{sheet_id}_overlay.jpg")
+    return Response(content=data, media_type=storage_media_type(), headers=headers)
@@ -1,21 +1,34 @@
 # backend/api/results.py
-import io
-from typing import List
+import asyncio
+import json
+import math
+import os
+import tempfile
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from sqlalchemy.orm import Session
-import pandas as pd
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.background import BackgroundTask
 
-from db.session import get_db
+from core.config import settings
+from db.session import get_db, AsyncSessionLocal
 from db import crud  # implement functions like get_result_by_sheet, get_results_by_exam
-from services.export_service import export_results_to_csv, export_results_to_excel_bytes, generate_results_dataframe
+from services.export_service import (
+    ARROW_EXPORT_FIELDS, ARROW_FORMATS, EXPORT_FIELDS, XLSX_EXPORT_FIELDS, arrow_supported, export_results_arrow,
+    export_results_xlsx, stream_results_csv, template_layout,
+)
+from services.omr_service import AMBIGUITY_MARGIN, MIN_FILL_RATIO
+from services.rescoring_service import rescore_exam, rethreshold_exam
+from services.results_cache import results_cache, results_cache_key
+from utils.http_utils import etag_matches
 
 router = APIRouter(prefix="/results", tags=["results"])
 
 
 @router.get("/sheet/{sheet_id}")
-async def get_result_by_sheet(sheet_id: str, db: Session = Depends(get_db)):
+async def get_result_by_sheet(sheet_id: str, db: AsyncSession = Depends(get_db)):
     """
     Return result JSON for a processed sheet.
     """
@@ -25,46 +38,215 @@ async def get_result_by_sheet(sheet_id: str, db: Session = Depends(get_db)):
     return JSONResponse(content=res)
 
 
+def _parse_fields(fields: Optional[str], include_answers: bool) -> List[str]:
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in crud.RESULT_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. "
+                                                        f"Use any of: {', '.join(crud.RESULT_FIELDS)}")
+    else:
+        selected = list(crud.DEFAULT_RESULT_FIELDS)
+    if include_answers and "answers" not in selected:
+        selected.append("answers")
+    return selected
+
+
 @router.get("/exam/{exam_id}")
-async def get_results_by_exam(exam_id: str, db: Session = Depends(get_db)):
+async def get_results_by_exam(exam_id: str, request: Request,
+                              cursor: Optional[int] = Query(None, ge=0, description="next_cursor of the previous page"),
+                              limit: int = Query(settings.RESULTS_PAGE_SIZE, ge=1, le=settings.RESULTS_MAX_PAGE_SIZE),
+                              fields: Optional[str] = Query(None, description="comma-separated columns to return"),
+                              include_answers: bool = False,
+                              min_total: Optional[int] = None,
+                              max_total: Optional[int] = None,
+                              flagged: Optional[bool] = None,
+                              version: Optional[str] = None,
+                              db: AsyncSession = Depends(get_db)):
+    """
+    Return one page of results for an exam, in result order.
+    Pass the returned next_cursor as ?cursor= to get the next page (null on the last page).
+    The answers/flags JSON is only returned when asked for (include_answers=true or fields=).
+    Pages are cached per results revision; supports ETag / If-None-Match revalidation.
+    """
+    selected = _parse_fields(fields, include_answers)
+    params = {"cursor": cursor, "limit": limit, "fields": selected, "min_total": min_total,
+              "max_total": max_total, "flagged": flagged, "version": version}
+    key = results_cache_key(exam_id, await crud.get_results_revision(db, exam_id), "json", params)
+    headers = _revalidate_headers(key)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    body = results_cache.get_page(key)
+    if body is None:
+        results, next_cursor = await crud.get_results_page(
+            db, exam_id, after_id=cursor, limit=limit, fields=selected,
+            min_total=min_total, max_total=max_total, flagged=flagged, version=version,
+        )
+        body = json.dumps({"exam_id": exam_id, "count": len(results), "results": results,
+                           "next_cursor": next_cursor}).encode("utf-8")
+        results_cache.put_page(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _result_chunks(exam_id: str, fields: List[str]):
+    # the response body is produced after the endpoint returns, so the stream gets its own session
+    async with AsyncSessionLocal() as db:
+        async for chunk in crud.iter_results_by_exam(db, exam_id, fields, chunk_size=settings.EXPORT_CHUNK_SIZE):
+            yield chunk
+
+
+@router.get("/exam/{exam_id}/summary")
+async def get_exam_summary(exam_id: str, db: AsyncSession = Depends(get_db)):
     """
-    Return list of results for an exam.
+    Summary statistics of an exam's results, read from the incrementally maintained
+    aggregates (ExamStats) - constant time regardless of the number of candidates.
     """
-    results = await crud.get_results_by_exam(db, exam_id)
-    return JSONResponse(content={"exam_id": exam_id, "count": len(results), "results": results})
+    stats = await crud.get_exam_stats(db, exam_id)
+    if stats is None or stats.count <= 0:
+        raise HTTPException(status_code=404, detail="No results for this exam")
+    n = stats.count
+    mean = stats.total_sum / n
+    scores = sorted(int(k) for k in stats.histogram)
+    return JSONResponse(content={
+        "exam_id": exam_id,
+        "count": n,
+        "mean": round(mean, 4),
+        "std": round(math.sqrt(max(stats.total_sumsq / n - mean * mean, 0.0)), 4),
+        "min": scores[0] if scores else None,
+        "max": scores[-1] if scores else None,
+        "subject_means": {name: round(total / n, 4) for name, total in sorted(stats.subject_sums.items())},
+        "histogram": {str(k): stats.histogram[str(k)] for k in scores},
+        "flagged": stats.flagged_count,
+        "versions": stats.version_counts,
+        "updated_at": stats.updated_at.isoformat() if stats.updated_at else None,
+    })
+
+
+class RethresholdRequest(BaseModel):
+    min_fill: float = Field(MIN_FILL_RATIO, ge=0.0, le=1.0)  # best option below this -> no_mark
+    margin: float = Field(AMBIGUITY_MARGIN, ge=0.0, le=1.0)  # best - second below this -> ambiguous
+    dry_run: bool = False  # only report how many results would change
+
+
+@router.post("/exam/{exam_id}/rethreshold")
+async def rethreshold_results(exam_id: str, req: RethresholdRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Re-derive answers, flags and scores of every result of an exam with new bubble thresholds,
+    from the stored fill-ratio matrices (no image processing).
+    """
+    try:
+        summary = await rethreshold_exam(db, exam_id, req.min_fill, req.margin, dry_run=req.dry_run)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Template or answer key not found for this exam")
+    return JSONResponse(content={**summary, "min_fill": req.min_fill, "margin": req.margin, "dry_run": req.dry_run})
+
+
+class RescoreRequest(BaseModel):
+    comment: Optional[str] = None  # reason for the re-score, kept in the audit log
+    dry_run: bool = False  # only report how many results would change
+
+
+@router.post("/exam/{exam_id}/rescore")
+async def rescore_results(exam_id: str, req: RescoreRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Re-score every result of an exam against the current answer key workbook (e.g. after a
+    corrected key was uploaded), from the stored answers (no image processing).
+    """
+    try:
+        summary = await rescore_exam(db, exam_id, dry_run=req.dry_run, comment=req.comment)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Answer key not found for this exam")
+    return JSONResponse(content={**summary, "dry_run": req.dry_run})
+
+
+def _revalidate_headers(key: str) -> dict:
+    # results change while an exam is being processed: clients must revalidate (cheap 304s)
+    return {"ETag": f'"{key}"', "Cache-Control": "private, no-cache"}
+
+
+async def _cached_stream(chunks, key: str, suffix: str):
+    """
+    Pass a streamed export through while copying it to a temp file, which goes into the
+    export cache once the stream is complete (an aborted download caches nothing).
+    """
+    fd, path = tempfile.mkstemp(dir=settings.RESULTS_EXPORT_DIR, suffix=suffix)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as out:
+            async for text in chunks:
+                out.write(text)
+                yield text
+        await asyncio.to_thread(results_cache.put_file, key, suffix, path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def _file_export(exam_id: str, key: str, suffix: str, media_type: str, headers: dict, build) -> FileResponse:
+    # built on disk (constant memory), then moved into the export cache and sent from there
+    fd, path = tempfile.mkstemp(dir=settings.RESULTS_EXPORT_DIR, suffix=suffix)
+    os.close(fd)
+    try:
+        await build(path)
+        cached = await asyncio.to_thread(results_cache.put_file, key, suffix, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    if cached is not None:
+        return FileResponse(cached, filename=f"results_{exam_id}{suffix}", media_type=media_type, headers=headers)
+    return FileResponse(path, filename=f"results_{exam_id}{suffix}", media_type=media_type, headers=headers,
+                        background=BackgroundTask(os.remove, path))
+
+
+# format parameter -> (export format, file extension, media type)
+EXPORT_FORMATS = {
+    "csv": ("csv", ".csv", "text/csv; charset=utf-8"),
+    "xls": ("xlsx", ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "xlsx": ("xlsx", ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "excel": ("xlsx", ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "parquet": ("parquet", *ARROW_FORMATS["parquet"]),
+    "arrow": ("arrow", *ARROW_FORMATS["arrow"]),
+    "ipc": ("arrow", *ARROW_FORMATS["arrow"]),
+}
 
 
 @router.get("/export/{exam_id}")
-async def export_results(exam_id: str, format: str = "csv", db: Session = Depends(get_db)):
+async def export_results(exam_id: str, request: Request, format: str = "csv", db: AsyncSession = Depends(get_db)):
     """
-    Export results for exam in CSV or Excel.
+    Export results for exam in CSV, Excel, Parquet or Arrow IPC (stream) format.
+    Exports are cached per results revision; supports ETag / If-None-Match revalidation.
     """
-    results = await crud.get_results_by_exam(db, exam_id)
-    if not results:
+    if format.lower() not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported format. Use csv, xlsx, parquet or arrow.")
+    fmt, suffix, media_type = EXPORT_FORMATS[format.lower()]
+    if fmt in ARROW_FORMATS and not arrow_supported():
+        raise HTTPException(status_code=400, detail="Parquet/Arrow exports are not available on this server (pyarrow missing)")
+
+    # XLSX/Parquet/Arrow have one column per template question: the template is part of the key
+    qids, template_digest = (None, None) if fmt == "csv" else await asyncio.to_thread(template_layout, exam_id)
+    key = results_cache_key(exam_id, await crud.get_results_revision(db, exam_id), fmt,
+                            template_digest=template_digest)
+    headers = _revalidate_headers(key)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    cached = await asyncio.to_thread(results_cache.get_file, key, suffix)
+    if cached is not None:
+        return FileResponse(cached, filename=f"results_{exam_id}{suffix}", media_type=media_type, headers=headers)
+
+    if not await crud.exam_has_results(db, exam_id):
         raise HTTPException(status_code=404, detail="No results for this exam")
 
-    # create DataFrame
-    df = generate_results_dataframe(results)
-
-    if format.lower() == "csv":
-        stream = io.StringIO()
-        df.to_csv(stream, index=False)
-        stream.seek(0)
-        headers = {
-            'Content-Disposition': f'attachment; filename="results_{exam_id}.csv"'
-        }
-        return StreamingResponse(iter([stream.getvalue()]),
-                                 media_type="text/csv",
-                                 headers=headers)
-    elif format.lower() in ("xls", "xlsx", "excel"):
-        stream = io.BytesIO()
-        with pd.ExcelWriter(stream, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="results")
-        stream.seek(0)
-        headers = {
-            'Content-Disposition': f'attachment; filename="results_{exam_id}.xlsx"'
-        }
-        return StreamingResponse(stream, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                 headers=headers)
+    if fmt == "csv":
+        headers["Content-Disposition"] = f'attachment; filename="results_{exam_id}.csv"'
+        stream = stream_results_csv(_result_chunks(exam_id, EXPORT_FIELDS), exam_id)
+        return StreamingResponse(_cached_stream(stream, key, suffix), media_type="text/csv", headers=headers)
+    elif fmt == "xlsx":
+        return await _file_export(
+            exam_id, key, suffix, media_type, headers,
+            lambda path: export_results_xlsx(_result_chunks(exam_id, XLSX_EXPORT_FIELDS), exam_id, path, qids),
+        )
     else:
-        raise HTTPException(status_code=400, detail="Unsupported format. Use csv or xlsx.")
+        return await _file_export(
+            exam_id, key, suffix, media_type, headers,
+            lambda path: export_results_arrow(_result_chunks(exam_id, ARROW_EXPORT_FIELDS), path, fmt, qids),
+        )
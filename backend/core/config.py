@@ -2,6 +2,7 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from pathlib import Path
+from typing import List
 
 
 class Settings(BaseSettings):
@@ -15,6 +16,14 @@ class Settings(BaseSettings):
         alias="DATABASE_URL",
     )
 
+    # DB connection pool (applies to the async app engine and the sync engine)
+    DB_ECHO: bool = False  # log every SQL statement
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30  # seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # recycle connections older than this (MySQL wait_timeout)
+    DB_POOL_PRE_PING: bool = True  # test connections on checkout
+
     # File storage
     BASE_DIR: Path = Path(__file__).resolve().parent.parent
     UPLOAD_DIR: Path = Field(default=BASE_DIR / "data" / "omr_samples")
@@ -29,7 +38,53 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24  # 1 day by default
 
     # Misc
-    MAX_UPLOAD_SIZE_MB: int = 10
+    MAX_UPLOAD_SIZE_MB: int = 10  # per sheet upload; larger request bodies are cut off with 413
+    MAX_BATCH_UPLOAD_SIZE_MB: int = 2048  # per /upload-batch request
+    MAX_DOCUMENT_UPLOAD_SIZE_MB: int = 1024  # per multi-page PDF/TIFF on /upload-document
+    PDF_RENDER_DPI: int = 200  # PDF pages are rasterized at this resolution (needs PyMuPDF)
+    UPLOAD_BUFFER_MB: int = 256  # uploads kept in memory for the embedded worker (skips re-reading from disk)
+    DUPLICATE_UPLOAD_POLICY: str = "existing"  # exact re-upload of a sheet: "existing" returns it, "reject" answers 409
+
+    # Processing
+    PROCESS_POOL_WORKERS: int = 0  # worker processes for the image/scoring pipeline; 0 = one per CPU core
+    DECODE_REDUCED_RESOLUTION: bool = True  # decode scans at 1/2, 1/4, 1/8 size when still >= template canvas
+
+    # Job queue (see backend/worker.py)
+    EMBEDDED_WORKER: bool = True  # run a queue worker inside the API process; disable when running `python -m backend.worker`
+    WORKER_CONCURRENCY: int = 0  # jobs in flight per worker; 0 = PROCESS_POOL_WORKERS-sized
+    JOB_LEASE_SECONDS: int = 300  # a job whose lease expires (crashed worker) becomes claimable again
+    JOB_MAX_ATTEMPTS: int = 5  # after this many failures the sheet is set to status="error"
+    JOB_RETRY_BACKOFF_SECONDS: float = 5.0  # retry delay = backoff * 2 ** (attempt - 1)
+    JOB_POLL_INTERVAL_SECONDS: float = 1.0
+    RESULT_WRITER_BATCH_SIZE: int = 50  # max results per persistence transaction (1 = write each sheet on its own)
+    RESULT_WRITER_FLUSH_MS: int = 200  # max wait for a partial batch while some worker slots are still processing
+
+    # OCR (header version fallback)
+    OCR_POOL_SIZE: int = 1  # long-lived tesseract engines per pipeline process (needs tesserocr)
+    OCR_CACHE_SIZE: int = 256  # header OCR results memoized by perceptual hash (each entry keeps its crop, bit-packed)
+
+    # Image storage (processed/warped images, thumbnails and overlays)
+    IMAGE_STORE_FORMAT: str = "webp"  # webp | png | jpeg
+    IMAGE_STORE_QUALITY: int = 80  # webp/jpeg quality
+    STORE_WARPED_GRAYSCALE: bool = True  # store (and process) the warped sheet as a single gray plane
+    THUMBNAIL_WIDTHS: List[int] = [256, 768]  # thumbnails generated for the review pages
+    IMAGE_CACHE_MAX_AGE: int = 86400  # Cache-Control max-age (s) for served images
+
+    # Overlays (rendered lazily on GET /overlay/{sheet_id})
+    PRERENDER_FLAGGED_OVERLAYS: bool = False  # render overlays of flagged sheets right after processing
+    OVERLAY_MEMORY_CACHE_MB: int = 64
+    OVERLAY_DISK_CACHE_MB: int = 2048
+
+    # Results listing (GET /results/exam/{exam_id})
+    RESULTS_PAGE_SIZE: int = 100  # default page size
+    RESULTS_MAX_PAGE_SIZE: int = 1000
+    EXPORT_CHUNK_SIZE: int = 1000  # results fetched per round trip when streaming an export
+    RESULTS_CACHE_MEMORY_MB: int = 32  # listing pages cached per (exam, results revision, query)
+    EXPORT_CACHE_DISK_MB: int = 2048  # export files cached per (exam, results revision, format)
+
+    # Caches
+    TEMPLATE_CACHE_SIZE: int = 32  # compiled templates kept per process (LRU)
+    ANSWER_KEY_CACHE_SIZE: int = 64  # (exam_id, version) answer keys kept per process (LRU)
 
     class Config:
         env_file = ".env"
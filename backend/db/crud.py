@@ -1,204 +1,748 @@
 # backend/db/crud.py
-import asyncio
-from typing import Optional, List, Dict
-from sqlalchemy.orm import Session
+import datetime
+from typing import AsyncIterator, Optional, List, Dict, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import models
-from .session import get_db
-from sqlalchemy import select, insert
+from sqlalchemy import select, insert, update, delete, or_, and_, bindparam
 from utils.logger import get_logger
 
 logger = get_logger()
 
-# NOTE: All functions are async but internally run sync DB calls in threadpool using asyncio.to_thread
-# This keeps the FastAPI route code using await intact.
+# NOTE: All functions run natively on an AsyncSession (see db/session.py). A session must not
+# be shared between concurrently running tasks; each request / worker slot gets its own.
 
 
-async def create_user(db: Session, username: str, hashed_password: str, full_name: str = None, role: str = "evaluator"):
-    def _create():
-        user = models.User(username=username, hashed_password=hashed_password, full_name=full_name, role=role)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        return user
+async def create_user(db: AsyncSession, username: str, hashed_password: str, full_name: str = None, role: str = "evaluator"):
+    user = models.User(username=username, hashed_password=hashed_password, full_name=full_name, role=role)
+    db.add(user)
+    await db.commit()
+    await db.refresh(user)
+    return user
 
-    return await asyncio.to_thread(_create)
 
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
+    return (await db.execute(select(models.User).where(models.User.username == username))).scalars().first()
 
-async def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
-    def _get():
-        return db.query(models.User).filter(models.User.username == username).first()
-    return await asyncio.to_thread(_get)
 
+async def create_exam(db: AsyncSession, exam_id: str, name: str = None, metadata: dict = None):
+    exam = models.Exam(exam_id=exam_id, name=name, exam_metadata=metadata)
+    db.add(exam)
+    await db.commit()
+    await db.refresh(exam)
+    return exam
 
-async def create_exam(db: Session, exam_id: str, name: str = None, metadata: dict = None):
-    def _create():
-        exam = models.Exam(exam_id=exam_id, name=name, exam_metadata=metadata)
-        db.add(exam)
-        db.commit()
-        db.refresh(exam)
-        return exam
-    return await asyncio.to_thread(_create)
 
+async def get_exam(db: AsyncSession, exam_id: str) -> Optional[models.Exam]:
+    return await db.get(models.Exam, exam_id)
 
-async def get_exam(db: Session, exam_id: str) -> Optional[models.Exam]:
-    def _get():
-        return db.query(models.Exam).filter(models.Exam.exam_id == exam_id).first()
-    return await asyncio.to_thread(_get)
 
+async def create_sheet_record(db: AsyncSession, sheet_id: str, exam_id: str, student_id: str, version: Optional[str], original_path: str):
+    sheet = models.Sheet(
+        sheet_id=sheet_id,
+        exam_id=exam_id,
+        student_id=student_id,
+        version=version,
+        original_path=original_path,
+        status="pending"
+    )
+    db.add(sheet)
+    await db.commit()
+    await db.refresh(sheet)
+    return sheet
 
-async def create_sheet_record(db: Session, sheet_id: str, exam_id: str, student_id: str, version: Optional[str], original_path: str):
-    def _create():
-        sheet = models.Sheet(
-            sheet_id=sheet_id,
-            exam_id=exam_id,
-            student_id=student_id,
-            version=version,
-            original_path=original_path,
-            status="pending"
+
+async def create_sheet_and_enqueue(db: AsyncSession, sheet_id: str, exam_id: str, student_id: str, version: Optional[str],
+                                   original_path: str, max_attempts: int = 5, content_hash: Optional[str] = None):
+    """
+    Create the sheet record and its processing job in one transaction, so a sheet is never
+    left pending without a job.
+    """
+    sheet = models.Sheet(
+        sheet_id=sheet_id,
+        exam_id=exam_id,
+        student_id=student_id,
+        version=version,
+        original_path=original_path,
+        content_hash=content_hash,
+        status="pending"
+    )
+    db.add(sheet)
+    db.add(models.Job(sheet_id=sheet_id, exam_id=exam_id, version=version, file_path=original_path,
+                      status="queued", max_attempts=max_attempts))
+    await db.commit()
+    await db.refresh(sheet)
+    return sheet
+
+
+async def bulk_create_sheets_and_enqueue(db: AsyncSession, rows: List[dict], batch_id: Optional[str] = None, max_attempts: int = 5):
+    """
+    Insert many sheets and their jobs with one multi-row INSERT per table, in one transaction.
+    rows: [{"sheet_id", "exam_id", "student_id", "version", "original_path"
+            [, "content_hash", "document_id", "page_number"]}, ...]
+    """
+    if not rows:
+        return 0
+    now = datetime.datetime.utcnow()
+    await db.execute(insert(models.Sheet), [
+        {
+            "sheet_id": r["sheet_id"],
+            "exam_id": r["exam_id"],
+            "student_id": r["student_id"],
+            "version": r.get("version"),
+            "original_path": r["original_path"],
+            "content_hash": r.get("content_hash"),
+            "batch_id": batch_id,
+            "document_id": r.get("document_id"),
+            "page_number": r.get("page_number"),
+            "status": "pending",
+            "created_at": now,
+        }
+        for r in rows
+    ])
+    await db.execute(insert(models.Job), [
+        {
+            "sheet_id": r["sheet_id"],
+            "exam_id": r["exam_id"],
+            "version": r.get("version"),
+            "file_path": r["original_path"],
+            "status": "queued",
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "available_at": now,
+            "created_at": now,
+            "updated_at": now,
+        }
+        for r in rows
+    ])
+    await db.commit()
+    return len(rows)
+
+
+async def requeue_errored_sheets(db: AsyncSession, sheets: List[models.Sheet], max_attempts: int = 5) -> List[str]:
+    """
+    Give dead-lettered sheets (status "error") another run: back to "pending" with a new job,
+    in one transaction. The sheet keeps its recorded student_id, version and file. Sheets that
+    are no longer in "error" (e.g. re-queued by a concurrent upload) are left alone.
+    Returns the ids of the sheets that were re-queued.
+    """
+    requeued = []
+    for sheet in sheets:
+        res = await db.execute(
+            update(models.Sheet)
+            .where(models.Sheet.sheet_id == sheet.sheet_id, models.Sheet.status == "error")
+            .values(status="pending", error_message=None, processed_at=None)
         )
-        db.add(sheet)
-        db.commit()
-        db.refresh(sheet)
-        return sheet
-    return await asyncio.to_thread(_create)
+        if res.rowcount != 1:
+            continue
+        db.add(models.Job(sheet_id=sheet.sheet_id, exam_id=sheet.exam_id, version=sheet.version,
+                          file_path=sheet.original_path, status="queued", max_attempts=max_attempts))
+        requeued.append(sheet.sheet_id)
+    await db.commit()
+    return requeued
 
 
-async def update_sheet_status(db: Session, sheet_id: str, status: str, processed_at=None):
-    def _update():
-        sheet = db.query(models.Sheet).filter(models.Sheet.sheet_id == sheet_id).first()
-        if not sheet:
-            return None
-        sheet.status = status
-        if processed_at:
-            sheet.processed_at = processed_at
-        db.add(sheet)
-        db.commit()
-        db.refresh(sheet)
-        return sheet
-    return await asyncio.to_thread(_update)
-
-
-async def update_sheet_paths(db: Session, sheet_id: str, warped_path: str = None, overlay_path: str = None):
-    def _update():
-        sheet = db.query(models.Sheet).filter(models.Sheet.sheet_id == sheet_id).first()
-        if not sheet:
-            return None
-        if warped_path:
-            sheet.warped_path = warped_path
-        if overlay_path:
-            sheet.overlay_path = overlay_path
-        db.add(sheet)
-        db.commit()
-        db.refresh(sheet)
-        return sheet
-    return await asyncio.to_thread(_update)
-
-
-async def create_result_record(db: Session, sheet_id: str, exam_id: str, student_id: str, version: Optional[str],
+async def update_sheet_status(db: AsyncSession, sheet_id: str, status: str, processed_at=None):
+    sheet = await db.get(models.Sheet, sheet_id)
+    if not sheet:
+        return None
+    sheet.status = status
+    if processed_at:
+        sheet.processed_at = processed_at
+    await db.commit()
+    return sheet
+
+
+async def update_sheet_paths(db: AsyncSession, sheet_id: str, warped_path: str = None, overlay_path: str = None):
+    sheet = await db.get(models.Sheet, sheet_id)
+    if not sheet:
+        return None
+    if warped_path:
+        sheet.warped_path = warped_path
+    if overlay_path:
+        sheet.overlay_path = overlay_path
+    await db.commit()
+    return sheet
+
+
+async def bump_results_revision(db: AsyncSession, exam_ids):
+    """
+    Advance the exams' results revision (part of the caller's transaction); cached listings
+    and exports of these exams stop matching. Exams without a row yet (sheets uploaded for
+    an exam that was never created) get one, starting at revision 1.
+    """
+    exam_ids = list(exam_ids)
+    bumped = (await db.execute(
+        update(models.Exam).where(models.Exam.exam_id.in_(exam_ids))
+        .values(results_revision=models.Exam.results_revision + 1).execution_options(synchronize_session=False)
+    )).rowcount
+    if bumped < len(exam_ids):
+        existing = set((await db.execute(
+            select(models.Exam.exam_id).where(models.Exam.exam_id.in_(exam_ids))
+        )).scalars())
+        missing = [e for e in exam_ids if e not in existing]
+        if missing:
+            await db.execute(insert(models.Exam), [{"exam_id": e, "results_revision": 1} for e in missing])
+
+
+async def get_results_revision(db: AsyncSession, exam_id: str) -> int:
+    revision = (await db.execute(
+        select(models.Exam.results_revision).where(models.Exam.exam_id == exam_id)
+    )).scalar_one_or_none()
+    return revision or 0
+
+
+# result columns the exam aggregates are built from
+STATS_FIELDS = ("exam_id", "total", "per_subject", "flag_count", "version")
+
+
+def _apply_stats_rows(stats: models.ExamStats, rows: List[dict], sign: int):
+    subject_sums = dict(stats.subject_sums or {})
+    histogram = dict(stats.histogram or {})
+    versions = dict(stats.version_counts or {})
+    for r in rows:
+        total = int(r["total"] or 0)
+        stats.count += sign
+        stats.total_sum += sign * total
+        stats.total_sumsq += sign * total * total
+        for name, score in (r["per_subject"] or {}).items():
+            subject_sums[name] = subject_sums.get(name, 0) + sign * int(score or 0)
+        histogram[str(total)] = histogram.get(str(total), 0) + sign
+        if r["flag_count"]:
+            stats.flagged_count += sign
+        v = r["version"] or "-"
+        versions[v] = versions.get(v, 0) + sign
+    # new dicts so the JSON columns are seen as changed; empty buckets are dropped
+    stats.subject_sums = subject_sums
+    stats.histogram = {k: n for k, n in histogram.items() if n}
+    stats.version_counts = {k: n for k, n in versions.items() if n}
+
+
+async def _rebuild_exam_stats(db: AsyncSession, exam_id: str, stats: models.ExamStats, chunk_size: int = 5000):
+    stats.count = stats.total_sum = stats.total_sumsq = stats.flagged_count = 0
+    stats.subject_sums, stats.histogram, stats.version_counts = {}, {}, {}
+    async for chunk in iter_results_for_update(db, exam_id, list(STATS_FIELDS), chunk_size=chunk_size):
+        _apply_stats_rows(stats, [row._asdict() for row in chunk], 1)
+
+
+async def _exam_stats_for_update(db: AsyncSession, exam_id: str) -> Tuple[models.ExamStats, bool]:
+    # (stats row, created); a created row is aggregated from the exam's results once
+    stats = (await db.execute(
+        select(models.ExamStats).where(models.ExamStats.exam_id == exam_id)
+        .with_for_update().execution_options(populate_existing=True)
+    )).scalar_one_or_none()
+    if stats is not None:
+        return stats, False
+    stats = models.ExamStats(exam_id=exam_id)
+    db.add(stats)
+    await _rebuild_exam_stats(db, exam_id, stats)
+    return stats, True
+
+
+async def apply_exam_stats(db: AsyncSession, removed: List[dict], added: List[dict]):
+    """
+    Update the exams' aggregates (ExamStats) for results written in the caller's transaction:
+    `removed` are the previous values of updated results, `added` the values written (both
+    dicts with STATS_FIELDS). Call after the results are written and after
+    bump_results_revision, whose exam row lock serializes concurrent read-modify-writes.
+    An exam without a stats row yet (e.g. results written before the table existed) is
+    aggregated from its results instead, which already include this write.
+    """
+    exam_ids = sorted({r["exam_id"] for r in removed} | {r["exam_id"] for r in added})
+    for exam_id in exam_ids:
+        stats, created = await _exam_stats_for_update(db, exam_id)
+        if not created:
+            _apply_stats_rows(stats, [r for r in removed if r["exam_id"] == exam_id], -1)
+            _apply_stats_rows(stats, [r for r in added if r["exam_id"] == exam_id], 1)
+    await db.flush()
+
+
+async def get_exam_stats(db: AsyncSession, exam_id: str) -> Optional[models.ExamStats]:
+    """
+    The exam's aggregates (one primary-key read). An exam with results but no stats row yet
+    is aggregated once, here.
+    """
+    stats = await db.get(models.ExamStats, exam_id, populate_existing=True)
+    if stats is None and await exam_has_results(db, exam_id):
+        await db.execute(select(models.Exam.exam_id).where(models.Exam.exam_id == exam_id).with_for_update())
+        stats, _ = await _exam_stats_for_update(db, exam_id)
+        await db.commit()
+    return stats
+
+
+async def create_result_record(db: AsyncSession, sheet_id: str, exam_id: str, student_id: str, version: Optional[str],
                                answers: Dict[str, Optional[str]], per_subject: Dict[str, int], total: int, flags: List[Dict] = None, confidence: str = None):
-    def _create():
-        result = models.Result(
-            sheet_id=sheet_id,
-            exam_id=exam_id,
-            student_id=student_id,
-            version=version,
-            answers=answers,
-            per_subject=per_subject,
-            total=total,
-            flags=flags or [],
-            confidence=confidence
+    result = models.Result(
+        sheet_id=sheet_id,
+        exam_id=exam_id,
+        student_id=student_id,
+        version=version,
+        answers=answers,
+        per_subject=per_subject,
+        total=total,
+        flags=flags or [],
+        flag_count=len(flags or []),
+        confidence=confidence
+    )
+    await bump_results_revision(db, [exam_id])
+    db.add(result)
+    await db.flush()  # assigns result.id
+    await apply_exam_stats(db, [], [{"exam_id": exam_id, "total": total, "per_subject": per_subject,
+                                     "flag_count": result.flag_count, "version": version}])
+    # update sheet.result_id and status
+    await db.execute(
+        update(models.Sheet).where(models.Sheet.sheet_id == sheet_id)
+        .values(result_id=result.id, status="processed")
+    )
+    await db.commit()
+    return result
+
+
+async def persist_sheet_results(db: AsyncSession, items: List[dict]) -> int:
+    """
+    Write the results of many processed sheets in one transaction: one multi-row INSERT into
+    results (rows for sheets that already have a result, e.g. a retried job, are updated in
+    place) and one executemany UPDATE of sheets setting paths, status, processed_at and
+    result_id (correlated subquery on results.sheet_id).
+
+    items: [{"sheet_id", "exam_id", "student_id" (None = keep the sheet's), "student_id_read",
+             "version", "answers", "per_subject", "total", "flags", "ratios", "confidence",
+             "warped_path", "overlay_path", "processed_at"}, ...]
+    The id read from the sheet replaces student_id only for pages of a scanned document.
+    Returns the number of sheets written (unknown sheet_ids are skipped).
+    """
+    if not items:
+        return 0
+    items = list({it["sheet_id"]: it for it in items}.values())  # last write per sheet wins
+    ids = [it["sheet_id"] for it in items]
+    sheets = {
+        row.sheet_id: row for row in await db.execute(
+            select(models.Sheet.sheet_id, models.Sheet.student_id, models.Sheet.document_id)
+            .where(models.Sheet.sheet_id.in_(ids))
         )
-        db.add(result)
-        db.commit()
-        db.refresh(result)
-        # update sheet.result_id and status
-        sheet = db.query(models.Sheet).filter(models.Sheet.sheet_id == sheet_id).first()
-        if sheet:
-            sheet.result_id = result.id
-            sheet.status = "processed"
-            db.add(sheet)
-        db.commit()
-        return result
-    return await asyncio.to_thread(_create)
-
-
-async def get_sheet_by_id(db: Session, sheet_id: str) -> Optional[models.Sheet]:
-    def _get():
-        return db.query(models.Sheet).filter(models.Sheet.sheet_id == sheet_id).first()
-    return await asyncio.to_thread(_get)
-
-
-async def get_result_by_sheet(db: Session, sheet_id: str) -> Optional[dict]:
-    def _get():
-        res = db.query(models.Result).filter(models.Result.sheet_id == sheet_id).first()
-        if not res:
-            return None
-        return {
-            "sheet_id": res.sheet_id,
-            "exam_id": res.exam_id,
-            "student_id": res.student_id,
-            "version": res.version,
-            "answers": res.answers,
-            "per_subject": res.per_subject,
-            "total": res.total,
-            "flags": res.flags,
-            "confidence": res.confidence,
-            "created_at": res.created_at.isoformat()
+    }
+    existing = {
+        row.sheet_id: row for row in await db.execute(
+            select(models.Result.sheet_id, models.Result.id, *[getattr(models.Result, f) for f in STATS_FIELDS])
+            .where(models.Result.sheet_id.in_(ids))
+        )
+    }
+
+    now = datetime.datetime.utcnow()
+    new_rows, updated_rows, sheet_rows = [], [], []
+    for it in items:
+        sheet = sheets.get(it["sheet_id"])
+        if sheet is None:
+            logger.warning(f"Result for unknown sheet {it['sheet_id']} dropped")
+            continue
+        sid = it.get("student_id") or sheet.student_id
+        if sheet.document_id and it.get("student_id_read"):
+            # pages of a scanned document only have a placeholder id until read from the sheet
+            sid = it["student_id_read"]
+        row = {
+            "sheet_id": it["sheet_id"],
+            "exam_id": it["exam_id"],
+            "student_id": sid,
+            "version": it.get("version"),
+            "answers": it["answers"],
+            "per_subject": it["per_subject"],
+            "total": it["total"],
+            "flags": it.get("flags") or [],
+            "flag_count": len(it.get("flags") or []),
+            "ratios": it.get("ratios"),
+            "confidence": it.get("confidence"),
         }
-    return await asyncio.to_thread(_get)
-
-
-async def get_results_by_exam(db: Session, exam_id: str) -> List[dict]:
-    def _get():
-        rows = db.query(models.Result).filter(models.Result.exam_id == exam_id).all()
-        outputs = []
-        for r in rows:
-            outputs.append({
-                "sheet_id": r.sheet_id,
-                "exam_id": r.exam_id,
-                "student_id": r.student_id,
-                "version": r.version,
-                "answers": r.answers,
-                "per_subject": r.per_subject,
-                "total": r.total,
-                "flags": r.flags,
-                "confidence": r.confidence,
-                "created_at": r.created_at.isoformat()
-            })
-        return outputs
-    return await asyncio.to_thread(_get)
+        if it["sheet_id"] in existing:
+            updated_rows.append({"id": existing[it["sheet_id"]].id, **row})
+        else:
+            new_rows.append({**row, "created_at": now})
+        sheet_rows.append({
+            "b_sheet_id": it["sheet_id"],
+            "b_student_id": sid,
+            "b_warped_path": it.get("warped_path"),
+            "b_overlay_path": it.get("overlay_path"),
+            "b_processed_at": it.get("processed_at") or now,
+        })
+
+    if sheet_rows:
+        await bump_results_revision(db, sorted({it["exam_id"] for it in items if it["sheet_id"] in sheets}))
+    if new_rows:
+        await db.execute(insert(models.Result), new_rows)
+    if updated_rows:
+        await db.execute(update(models.Result), updated_rows)  # bulk UPDATE by primary key
+    if sheet_rows:
+        sheets_t, results_t = models.Sheet.__table__, models.Result.__table__
+        await db.execute(
+            update(sheets_t)
+            .where(sheets_t.c.sheet_id == bindparam("b_sheet_id"))
+            .values(
+                student_id=bindparam("b_student_id"),
+                warped_path=bindparam("b_warped_path"),
+                overlay_path=bindparam("b_overlay_path"),
+                processed_at=bindparam("b_processed_at"),
+                status="processed",
+                result_id=select(results_t.c.id).where(results_t.c.sheet_id == sheets_t.c.sheet_id).scalar_subquery(),
+            ),
+            sheet_rows,
+        )
+        await apply_exam_stats(
+            db,
+            removed=[existing[r["sheet_id"]]._asdict() for r in updated_rows],
+            added=[{f: r[f] for f in STATS_FIELDS} for r in new_rows + updated_rows],
+        )
+    await db.commit()
+    return len(sheet_rows)
+
+
+async def persist_sheet_result(db: AsyncSession, item: dict) -> int:
+    """
+    Single-sheet form of persist_sheet_results (one transaction).
+    """
+    return await persist_sheet_results(db, [item])
+
+
+async def get_sheet_by_id(db: AsyncSession, sheet_id: str) -> Optional[models.Sheet]:
+    return await db.get(models.Sheet, sheet_id)
+
+
+async def create_document(db: AsyncSession, document_id: str, exam_id: str, filename: str, original_path: str,
+                          content_hash: str, fmt: str) -> models.Document:
+    doc = models.Document(document_id=document_id, exam_id=exam_id, filename=filename, original_path=original_path,
+                          content_hash=content_hash, format=fmt, status="extracting")
+    db.add(doc)
+    await db.commit()
+    await db.refresh(doc)
+    return doc
+
+
+async def finish_document(db: AsyncSession, document_id: str, page_count: int, status: str = "extracted",
+                          error_message: Optional[str] = None):
+    await db.execute(update(models.Document).where(models.Document.document_id == document_id).values(
+        page_count=page_count, status=status, error_message=error_message))
+    await db.commit()
+
+
+async def get_document(db: AsyncSession, document_id: str) -> Optional[models.Document]:
+    return await db.get(models.Document, document_id)
+
+
+async def get_document_sheets(db: AsyncSession, document_id: str) -> List[models.Sheet]:
+    return list((await db.execute(
+        select(models.Sheet).where(models.Sheet.document_id == document_id).order_by(models.Sheet.page_number)
+    )).scalars())
+
+
+async def get_sheet_by_content_hash(db: AsyncSession, exam_id: str, content_hash: str) -> Optional[models.Sheet]:
+    return (await db.execute(
+        select(models.Sheet).where(models.Sheet.exam_id == exam_id, models.Sheet.content_hash == content_hash)
+    )).scalars().first()
+
+
+async def get_sheets_by_content_hashes(db: AsyncSession, exam_id: str, hashes: List[str]) -> Dict[str, models.Sheet]:
+    """
+    Existing sheets of an exam for the given upload hashes: {content_hash: sheet}.
+    """
+    found = {}
+    unique = list(set(hashes))
+    for i in range(0, len(unique), 500):  # keep IN lists bounded
+        chunk = unique[i:i + 500]
+        rows = await db.execute(
+            select(models.Sheet).where(models.Sheet.exam_id == exam_id, models.Sheet.content_hash.in_(chunk))
+        )
+        for sheet in rows.scalars():
+            found[sheet.content_hash] = sheet
+    return found
+
+
+def _result_dict(res: models.Result) -> dict:
+    return {
+        "sheet_id": res.sheet_id,
+        "exam_id": res.exam_id,
+        "student_id": res.student_id,
+        "version": res.version,
+        "answers": res.answers,
+        "per_subject": res.per_subject,
+        "total": res.total,
+        "flags": res.flags,
+        "flag_count": res.flag_count,
+        "confidence": res.confidence,
+        "created_at": res.created_at.isoformat()
+    }
+
+
+async def get_result_by_sheet(db: AsyncSession, sheet_id: str) -> Optional[dict]:
+    res = (await db.execute(select(models.Result).where(models.Result.sheet_id == sheet_id))).scalars().first()
+    if not res:
+        return None
+    return _result_dict(res)
+
+
+async def get_results_by_exam(db: AsyncSession, exam_id: str) -> List[dict]:
+    rows = await db.execute(select(models.Result).where(models.Result.exam_id == exam_id))
+    return [_result_dict(r) for r in rows.scalars()]
+
+
+# fields a results page can project; "answers" and "flags" are the large JSON columns
+RESULT_FIELDS = ("sheet_id", "student_id", "version", "per_subject", "total", "flag_count",
+                 "confidence", "created_at", "answers", "flags")
+DEFAULT_RESULT_FIELDS = ("sheet_id", "student_id", "version", "per_subject", "total", "flag_count", "confidence",
+                         "created_at")
+
+
+async def get_results_page(db: AsyncSession, exam_id: str, after_id: Optional[int] = None, limit: int = 100,
+                           fields: Optional[List[str]] = None, min_total: Optional[int] = None,
+                           max_total: Optional[int] = None, flagged: Optional[bool] = None,
+                           version: Optional[str] = None) -> Tuple[List[dict], Optional[int]]:
+    """
+    One page of an exam's results, keyset-paginated on results.id (uses ix_results_exam_id_id):
+    only rows with id > after_id, in id order, and only the requested columns are read.
+    flagged filters on flag_count (True = any flag). Returns (rows, next_cursor); next_cursor
+    is None on the last page.
+    """
+    fields = [f for f in (fields or DEFAULT_RESULT_FIELDS) if f in RESULT_FIELDS]
+    cols = [models.Result.id] + [getattr(models.Result, f) for f in fields]
+    q = select(*cols).where(models.Result.exam_id == exam_id)
+    if after_id is not None:
+        q = q.where(models.Result.id > after_id)
+    if min_total is not None:
+        q = q.where(models.Result.total >= min_total)
+    if max_total is not None:
+        q = q.where(models.Result.total <= max_total)
+    if flagged is not None:
+        q = q.where(models.Result.flag_count > 0 if flagged else models.Result.flag_count == 0)
+    if version is not None:
+        q = q.where(models.Result.version == version)
+    # one extra row tells whether there is a next page
+    rows = (await db.execute(q.order_by(models.Result.id).limit(limit + 1))).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    page = []
+    for row in rows[:limit]:
+        item = {f: getattr(row, f) for f in fields}
+        if item.get("created_at") is not None:
+            item["created_at"] = item["created_at"].isoformat()
+        page.append(item)
+    return page, next_cursor
+
+
+async def exam_has_results(db: AsyncSession, exam_id: str) -> bool:
+    return (await db.execute(
+        select(models.Result.id).where(models.Result.exam_id == exam_id).limit(1)
+    )).first() is not None
+
+
+async def iter_results_by_exam(db: AsyncSession, exam_id: str, fields: Optional[List[str]] = None,
+                               chunk_size: int = 1000) -> AsyncIterator[List[dict]]:
+    """
+    Stream an exam's results in id order as lists of up to chunk_size row dicts, read through
+    a server-side cursor (yield_per) so the whole exam is never loaded at once.
+    fields: columns to read (RESULT_FIELDS); default is every column.
+    """
+    fields = [f for f in (fields or RESULT_FIELDS) if f in RESULT_FIELDS]
+    q = (select(*[getattr(models.Result, f) for f in fields])
+         .where(models.Result.exam_id == exam_id)
+         .order_by(models.Result.id)
+         .execution_options(yield_per=chunk_size))
+    result = await db.stream(q)
+    async for partition in result.partitions():
+        yield [row._asdict() for row in partition]
+
+
+async def iter_results_for_update(db: AsyncSession, exam_id: str, columns: List[str],
+                                  chunk_size: int = 1000) -> AsyncIterator[list]:
+    """
+    An exam's results in id order, as chunks of rows (id + columns), keyset-paginated so the
+    same session can write updates between chunks.
+    """
+    cols = [models.Result.id] + [getattr(models.Result, c) for c in columns]
+    last_id = 0
+    while True:
+        rows = (await db.execute(
+            select(*cols).where(models.Result.exam_id == exam_id, models.Result.id > last_id)
+            .order_by(models.Result.id).limit(chunk_size)
+        )).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+async def get_results_columns(db: AsyncSession, ids: List[int], columns: List[str]) -> list:
+    """
+    The given results as rows (id + columns), shaped like iter_results_for_update's.
+    """
+    if not ids:
+        return []
+    cols = [models.Result.id] + [getattr(models.Result, c) for c in columns]
+    return (await db.execute(select(*cols).where(models.Result.id.in_(ids)))).all()
+
+
+async def update_results(db: AsyncSession, rows: List[dict]):
+    """
+    Bulk UPDATE of results by primary key (each row carries "id"); part of the caller's transaction.
+    """
+    if rows:
+        await db.execute(update(models.Result), rows)
 
 
 # AnswerKey helpers - used if you persist keys to DB (optional)
-async def bulk_upsert_answer_keys_from_list(db: Session, exam_id: str, version: str, kv_list: List[dict]):
+async def bulk_upsert_answer_keys_from_list(db: AsyncSession, exam_id: str, version: str, kv_list: List[dict]):
     """
     kv_list: [{"question_number":1,"correct_answer":"A"}, ...]
     """
-    def _op():
-        # delete existing for exam+version then insert
-        db.query(models.AnswerKey).filter(models.AnswerKey.exam_id == exam_id, models.AnswerKey.version == version).delete()
-        for kv in kv_list:
-            ak = models.AnswerKey(exam_id=exam_id, version=version, question_number=kv["question_number"], correct_answer=kv["correct_answer"])
-            db.add(ak)
-        db.commit()
-        return True
-    return await asyncio.to_thread(_op)
+    # delete existing for exam+version then insert
+    await db.execute(delete(models.AnswerKey).where(models.AnswerKey.exam_id == exam_id, models.AnswerKey.version == version))
+    if kv_list:
+        await db.execute(insert(models.AnswerKey), [
+            {"exam_id": exam_id, "version": version, "question_number": kv["question_number"], "correct_answer": kv["correct_answer"]}
+            for kv in kv_list
+        ])
+    await db.commit()
+    return True
 
 
-async def get_answer_key_from_db(db: Session, exam_id: str, version: str) -> Optional[dict]:
-    def _get():
-        rows = db.query(models.AnswerKey).filter(models.AnswerKey.exam_id == exam_id, models.AnswerKey.version == version).order_by(models.AnswerKey.question_number.asc()).all()
-        if not rows:
+async def get_answer_key_from_db(db: AsyncSession, exam_id: str, version: str) -> Optional[dict]:
+    rows = (await db.execute(
+        select(models.AnswerKey)
+        .where(models.AnswerKey.exam_id == exam_id, models.AnswerKey.version == version)
+        .order_by(models.AnswerKey.question_number.asc())
+    )).scalars().all()
+    if not rows:
+        return None
+    return {str(r.question_number): r.correct_answer for r in rows}
+
+
+async def log_audit(db: AsyncSession, sheet_id: str, user: str, action: str, comment: str = None):
+    entry = models.AuditLog(sheet_id=sheet_id, user=user, action=action, comment=comment)
+    db.add(entry)
+    await db.commit()
+    await db.refresh(entry)
+    return entry
+
+
+# Job queue helpers
+def _claimable_jobs(now: datetime.datetime):
+    return or_(
+        and_(models.Job.status == "queued", models.Job.available_at <= now),
+        and_(models.Job.status == "leased", models.Job.lease_expires_at < now),
+    )
+
+
+async def claim_job(db: AsyncSession, worker_id: str, lease_seconds: int) -> Optional[models.Job]:
+    """
+    Lease the oldest claimable job (queued and due, or leased with an expired lease).
+    MySQL/PostgreSQL use SELECT ... FOR UPDATE SKIP LOCKED so concurrent workers never block
+    on each other; other backends (SQLite) use a conditional UPDATE as a compare-and-set.
+    Returns the leased job (attempts already incremented) or None.
+    """
+    now = datetime.datetime.utcnow()
+    lease_expires_at = now + datetime.timedelta(seconds=lease_seconds)
+    if db.get_bind().dialect.name in ("mysql", "mariadb", "postgresql"):
+        job = (await db.execute(
+            select(models.Job).where(_claimable_jobs(now)).order_by(models.Job.id).limit(1)
+            .with_for_update(skip_locked=True)
+            .execution_options(populate_existing=True)  # fresh attempts, not the identity map's copy
+        )).scalar_one_or_none()
+        if job is None:
+            await db.rollback()
             return None
-        return {str(r.question_number): r.correct_answer for r in rows}
-    return await asyncio.to_thread(_get)
-
-
-async def log_audit(db: Session, sheet_id: str, user: str, action: str, comment: str = None):
-    def _log():
-        entry = models.AuditLog(sheet_id=sheet_id, user=user, action=action, comment=comment)
-        db.add(entry)
-        db.commit()
-        db.refresh(entry)
-        return entry
-    return await asyncio.to_thread(_log)
+        job.status = "leased"
+        job.lease_owner = worker_id
+        job.lease_expires_at = lease_expires_at
+        job.attempts += 1
+    else:
+        job = None
+        for _ in range(5):
+            job_id = (await db.execute(
+                select(models.Job.id).where(_claimable_jobs(now)).order_by(models.Job.id).limit(1)
+            )).scalar_one_or_none()
+            if job_id is None:
+                await db.rollback()
+                return None
+            claimed = (await db.execute(
+                update(models.Job)
+                .where(models.Job.id == job_id, _claimable_jobs(now))
+                .values(status="leased", lease_owner=worker_id, lease_expires_at=lease_expires_at,
+                        attempts=models.Job.attempts + 1, updated_at=now)
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            if claimed == 1:
+                job = await db.get(models.Job, job_id, populate_existing=True)
+                break
+            await db.rollback()  # another worker won the race; try the next job
+        if job is None:
+            return None
+    await db.execute(
+        update(models.Sheet).where(models.Sheet.sheet_id == job.sheet_id)
+        .values(status="processing").execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+async def complete_job(db: AsyncSession, job_id: int, worker_id: str) -> bool:
+    """
+    Ack a job leased by `worker_id`. Returns False (nothing changed) when the lease was lost
+    to another worker in the meantime.
+    """
+    done = (await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.status == "leased", models.Job.lease_owner == worker_id)
+        .values(status="done", lease_owner=None, lease_expires_at=None, updated_at=datetime.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    await db.commit()
+    return done == 1
+
+
+async def renew_job_lease(db: AsyncSession, job_id: int, worker_id: str, lease_seconds: int) -> bool:
+    """
+    Extend the lease of a job still held by `worker_id`. Returns False when the lease was
+    lost (expired and claimed by another worker, or the job is no longer leased).
+    """
+    now = datetime.datetime.utcnow()
+    renewed = (await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.status == "leased", models.Job.lease_owner == worker_id)
+        .values(lease_expires_at=now + datetime.timedelta(seconds=lease_seconds), updated_at=now)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    await db.commit()
+    return renewed == 1
+
+
+async def fail_job(db: AsyncSession, job_id: int, worker_id: str, error: str, backoff_seconds: float,
+                   retryable: bool = True) -> Optional[str]:
+    """
+    Record a failed attempt of a job leased by `worker_id`. The job is re-queued with exponential
+    backoff (backoff_seconds * 2 ** (attempts - 1)) or, once max_attempts is reached or the
+    error isn't retryable, dead-lettered: job.status = "dead" and the sheet is set to
+    status="error" with the message.
+    Returns the job's new status, or None when the lease was lost to another worker.
+    """
+    job = await db.get(models.Job, job_id, populate_existing=True)
+    if not job or job.status != "leased" or job.lease_owner != worker_id:
+        await db.commit()  # nothing written; commit (not rollback) keeps the caller's objects loaded
+        return None
+    now = datetime.datetime.utcnow()
+    if not retryable or job.attempts >= job.max_attempts:
+        values = {"status": "dead"}
+        sheet_values = {"status": "error", "error_message": error}
+    else:
+        values = {"status": "queued",
+                  "available_at": now + datetime.timedelta(seconds=backoff_seconds * 2 ** max(job.attempts - 1, 0))}
+        sheet_values = {"status": "pending"}
+    failed = (await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.status == "leased", models.Job.lease_owner == worker_id)
+        .values(last_error=error, lease_owner=None, lease_expires_at=None, updated_at=now, **values)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    if failed != 1:
+        await db.commit()
+        return None
+    await db.execute(
+        update(models.Sheet).where(models.Sheet.sheet_id == job.sheet_id)
+        .values(**sheet_values).execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return values["status"]
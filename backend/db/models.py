@@ -1,5 +1,5 @@
 # backend/db/models.py
-from sqlalchemy import Column, String, Integer, DateTime, JSON, Text, ForeignKey
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, JSON, Text, ForeignKey, Index, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .session import Base
 import datetime
@@ -24,11 +24,14 @@ class Exam(Base):
     name = Column(String(256), nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     exam_metadata = Column(JSON, nullable=True)  # optional JSON metadata
+    results_revision = Column(Integer, nullable=False, default=0)  # bumped on every result insert/update
 
     # Relationships
     answer_keys = relationship("AnswerKey", back_populates="exam")
     sheets = relationship("Sheet", back_populates="exam")
+    documents = relationship("Document", back_populates="exam")
     results = relationship("Result", back_populates="exam")
+    stats = relationship("ExamStats", back_populates="exam", uselist=False)
 
 
 class AnswerKey(Base):
@@ -43,6 +46,27 @@ class AnswerKey(Base):
     exam = relationship("Exam", back_populates="answer_keys")
 
 
+class Document(Base):
+    """
+    A multi-page scan (PDF / TIFF) uploaded as one file; every page becomes a Sheet.
+    """
+    __tablename__ = "documents"
+    document_id = Column(String(64), primary_key=True, index=True)
+    exam_id = Column(String(128), ForeignKey("exams.exam_id"), nullable=False)
+    filename = Column(String(512), nullable=True)
+    original_path = Column(String(1024), nullable=True)
+    content_hash = Column(String(64), nullable=True)
+    format = Column(String(16), nullable=False)  # pdf/tiff
+    page_count = Column(Integer, nullable=True)  # set once all pages are extracted
+    status = Column(String(32), default="extracting")  # extracting/extracted/error
+    error_message = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    # Relationships
+    exam = relationship("Exam", back_populates="documents")
+    sheets = relationship("Sheet", back_populates="document")
+
+
 class Sheet(Base):
     __tablename__ = "sheets"
     sheet_id = Column(String(64), primary_key=True, index=True)
@@ -50,13 +74,23 @@ class Sheet(Base):
     student_id = Column(String(128), index=True, nullable=False)
     version = Column(String(8), nullable=True)
     original_path = Column(String(1024), nullable=True)
+    content_hash = Column(String(64), nullable=True)  # sha256 of the uploaded bytes
     warped_path = Column(String(1024), nullable=True)
     overlay_path = Column(String(1024), nullable=True)
+    batch_id = Column(String(64), index=True, nullable=True)  # set for sheets from /upload-batch
+    document_id = Column(String(64), ForeignKey("documents.document_id"), index=True, nullable=True)
+    page_number = Column(Integer, nullable=True)  # 1-based page within the document
     status = Column(String(32), default="pending")  # pending/processing/processed/flagged/error
+    error_message = Column(Text, nullable=True)  # set when status == "error"
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
     result_id = Column(Integer, ForeignKey("results.id"), nullable=True)
 
+    __table_args__ = (
+        # an exact re-upload resolves to the existing sheet instead of being reprocessed
+        UniqueConstraint("exam_id", "content_hash", name="uq_sheets_exam_content_hash"),
+    )
+
     # Relationships
     exam = relationship("Exam", back_populates="sheets")
     result = relationship(
@@ -66,6 +100,38 @@ class Sheet(Base):
         foreign_keys="[Result.sheet_id]"  # Specify the correct foreign key
     )
     audit_logs = relationship("AuditLog", back_populates="sheet")
+    jobs = relationship("Job", back_populates="sheet")
+    document = relationship("Document", back_populates="sheets")
+
+
+class Job(Base):
+    """
+    Durable processing queue entry (one per sheet processing attempt chain).
+    Workers lease jobs; an expired lease makes the job claimable again.
+    """
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    sheet_id = Column(String(64), ForeignKey("sheets.sheet_id"), nullable=False, index=True)
+    exam_id = Column(String(128), nullable=False)
+    version = Column(String(8), nullable=True)
+    file_path = Column(String(1024), nullable=False)
+    status = Column(String(32), default="queued")  # queued/leased/done/dead
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    available_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    lease_owner = Column(String(128), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_jobs_status_available_at", "status", "available_at"),
+        Index("ix_jobs_status_lease_expires_at", "status", "lease_expires_at"),
+    )
+
+    # Relationship
+    sheet = relationship("Sheet", back_populates="jobs")
 
 
 class Result(Base):
@@ -77,11 +143,18 @@ class Result(Base):
     version = Column(String(8), nullable=True)
     answers = Column(JSON, nullable=False)   # {"1": "A", "2": "C", ...}
     flags = Column(JSON, nullable=True)      # [{"q":3,"reason":"no_mark"}, ...]
+    flag_count = Column(Integer, nullable=False, default=0)  # len(flags), filterable without reading the JSON
+    ratios = Column(LargeBinary, nullable=True)  # (Q, O) uint8 fill ratios, see omr_service.encode_ratios
     per_subject = Column(JSON, nullable=False)  # {"subject1":18, ...}
     total = Column(Integer, nullable=False)
     confidence = Column(String(64), nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_results_exam_id_id", "exam_id", "id"),  # keyset pagination per exam
+        Index("ix_results_exam_id_total", "exam_id", "total"),  # total-range filters
+    )
+
     # Relationships
     sheet = relationship(
         "Sheet",
@@ -91,6 +164,26 @@ class Result(Base):
     exam = relationship("Exam", back_populates="results")
 
 
+class ExamStats(Base):
+    """
+    Running aggregates of an exam's results, updated in the same transaction as every result
+    write (crud.apply_exam_stats), so summaries never scan the results table.
+    """
+    __tablename__ = "exam_stats"
+    exam_id = Column(String(128), ForeignKey("exams.exam_id"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    total_sum = Column(BigInteger, nullable=False, default=0)
+    total_sumsq = Column(BigInteger, nullable=False, default=0)
+    subject_sums = Column(JSON, nullable=False, default=dict)    # {"subject1": 1234, ...}
+    histogram = Column(JSON, nullable=False, default=dict)       # {"<total>": candidates, ...}
+    flagged_count = Column(Integer, nullable=False, default=0)   # results with at least one flag
+    version_counts = Column(JSON, nullable=False, default=dict)  # {"A": 500, "B": 498}
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    # Relationship
+    exam = relationship("Exam", back_populates="stats")
+
+
 class AuditLog(Base):
     __tablename__ = "audit_logs"
     id = Column(Integer, primary_key=True, index=True)
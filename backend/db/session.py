@@ -1,10 +1,14 @@
 # backend/db/session.py
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 from dotenv import load_dotenv
 
+from core.config import settings
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -12,15 +16,60 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("❌ DATABASE_URL is not set. Please check your .env file.")
 
-engine = create_engine(DATABASE_URL, echo=True, future=True)
+# sync driver URL -> async driver used by the app (an explicit async driver is kept as is)
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "mysql": "aiomysql",
+    "mariadb": "aiomysql",
+    "postgresql": "asyncpg",
+}
+KNOWN_ASYNC_DRIVERS = {"aiosqlite", "aiomysql", "asyncmy", "asyncpg", "psycopg"}
+
+
+def async_database_url(url: str) -> URL:
+    u = make_url(url)
+    if u.get_driver_name() in KNOWN_ASYNC_DRIVERS:
+        return u
+    backend = u.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend '{backend}'")
+    return u.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def sync_database_url(url: str) -> URL:
+    u = make_url(url)
+    if u.get_driver_name() in KNOWN_ASYNC_DRIVERS - {"psycopg"}:
+        return u.set(drivername=u.get_backend_name())
+    return u
+
+
+def _engine_options(url: URL) -> dict:
+    options = {"echo": settings.DB_ECHO, "pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options  # single shared connection, no pool sizing
+    options.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    return options
+
+
+# Async engine: used by the API, the workers and db/crud.py
+_async_url = async_database_url(DATABASE_URL)
+async_engine = create_async_engine(_async_url, **_engine_options(_async_url))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Sync engine: schema creation and scripts (db/init_db.py)
+_sync_url = sync_database_url(DATABASE_URL)
+engine = create_engine(_sync_url, future=True, **_engine_options(_sync_url))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
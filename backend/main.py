@@ -1,9 +1,15 @@
 # backend/main.py
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api import omr, results, auth
 from core.config import settings
+from db.session import async_engine
+from services.worker_pool import get_process_pool, shutdown_process_pool
+from utils.http_utils import BodySizeLimitMiddleware
+from worker import run_worker
 
 app = FastAPI(
     title=settings.APP_NAME,
@@ -19,12 +25,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cut off oversized uploads while they stream in (the form is parsed before the route runs)
+MB = 1024 * 1024
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    limits={
+        "/omr/upload": settings.MAX_UPLOAD_SIZE_MB * MB + MB,  # + room for the other form fields
+        "/omr/upload-batch": settings.MAX_BATCH_UPLOAD_SIZE_MB * MB,
+        "/omr/upload-document": settings.MAX_DOCUMENT_UPLOAD_SIZE_MB * MB + MB,
+    },
+)
+
 # Routers
 app.include_router(auth.router, prefix="/api/auth")
 app.include_router(omr.router, prefix="/api/omr")
 app.include_router(results.router, prefix="/api/results")
 
 
+_worker_stop = asyncio.Event()
+_worker_task = None
+
+
+@app.on_event("startup")
+async def start_processing():
+    global _worker_task
+    # start OMR workers up front so they preload templates/answer keys before the first upload
+    get_process_pool()
+    if settings.EMBEDDED_WORKER:
+        _worker_task = asyncio.create_task(run_worker(_worker_stop))
+
+
+@app.on_event("shutdown")
+async def stop_processing():
+    _worker_stop.set()
+    if _worker_task is not None:
+        await _worker_task
+    shutdown_process_pool()
+    await async_engine.dispose()
+
+
 @app.get("/")
 def root():
     return {"message": "Automated OMR Evaluation System Backend is running"}
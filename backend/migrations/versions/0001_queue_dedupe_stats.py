@@ -0,0 +1,196 @@
+"""job queue, upload dedupe, documents, stored ratios and exam aggregates
+
+Brings a database created by db/init_db.py (create_all) from the original schema up to
+the current models:
+
+- exams.results_revision
+- sheets.content_hash (unique per exam), batch_id, document_id, page_number, error_message
+- results.flag_count (backfilled from flags), results.ratios and the per-exam indexes
+- new tables: documents, jobs, exam_stats
+
+create_all creates missing tables but never alters existing ones, so a deployment that
+already ran the new code may have the new tables and still lack the new columns; every
+step is skipped when its object already exists. With --sql the original schema is assumed
+(MySQL/PostgreSQL only: SQLite's table rebuilds need a live connection).
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# tables of the original schema
+ORIGINAL_TABLES = {"users", "exams", "answer_keys", "sheets", "results", "audit_logs"}
+
+
+class _Schema:
+    """
+    What already exists in the database being migrated.
+    """
+    def __init__(self):
+        self.inspector = None if context.is_offline_mode() else sa.inspect(op.get_bind())
+
+    def has_table(self, table: str) -> bool:
+        if self.inspector is None:
+            return table in ORIGINAL_TABLES
+        return self.inspector.has_table(table)
+
+    def has_column(self, table: str, column: str) -> bool:
+        if self.inspector is None:
+            return False
+        return column in {c["name"] for c in self.inspector.get_columns(table)}
+
+    def has_index(self, table: str, name: str) -> bool:
+        if self.inspector is None:
+            return False
+        return name in {i["name"] for i in self.inspector.get_indexes(table)}
+
+    def has_unique(self, table: str, name: str) -> bool:
+        if self.inspector is None:
+            return False
+        return name in {u["name"] for u in self.inspector.get_unique_constraints(table)}
+
+
+def upgrade() -> None:
+    schema = _Schema()
+
+    if not schema.has_column("exams", "results_revision"):
+        op.add_column("exams", sa.Column("results_revision", sa.Integer(), nullable=False, server_default="0"))
+
+    if not schema.has_table("documents"):
+        op.create_table(
+            "documents",
+            sa.Column("document_id", sa.String(64), primary_key=True),
+            sa.Column("exam_id", sa.String(128), sa.ForeignKey("exams.exam_id"), nullable=False),
+            sa.Column("filename", sa.String(512), nullable=True),
+            sa.Column("original_path", sa.String(1024), nullable=True),
+            sa.Column("content_hash", sa.String(64), nullable=True),
+            sa.Column("format", sa.String(16), nullable=False),
+            sa.Column("page_count", sa.Integer(), nullable=True),
+            sa.Column("status", sa.String(32), nullable=True),
+            sa.Column("error_message", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_documents_document_id", "documents", ["document_id"])
+
+    # batch mode: SQLite can only add foreign keys / unique constraints by recreating the table
+    with op.batch_alter_table("sheets") as batch:
+        for column in (
+            sa.Column("content_hash", sa.String(64), nullable=True),
+            sa.Column("batch_id", sa.String(64), nullable=True),
+            sa.Column("document_id", sa.String(64), nullable=True),
+            sa.Column("page_number", sa.Integer(), nullable=True),
+            sa.Column("error_message", sa.Text(), nullable=True),
+        ):
+            if not schema.has_column("sheets", column.name):
+                batch.add_column(column)
+                if column.name == "document_id":
+                    batch.create_foreign_key("fk_sheets_document_id_documents", "documents",
+                                             ["document_id"], ["document_id"])
+        if not schema.has_unique("sheets", "uq_sheets_exam_content_hash"):
+            batch.create_unique_constraint("uq_sheets_exam_content_hash", ["exam_id", "content_hash"])
+        for name, columns in (("ix_sheets_batch_id", ["batch_id"]), ("ix_sheets_document_id", ["document_id"])):
+            if not schema.has_index("sheets", name):
+                batch.create_index(name, columns)
+
+    if not schema.has_table("jobs"):
+        op.create_table(
+            "jobs",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("sheet_id", sa.String(64), sa.ForeignKey("sheets.sheet_id"), nullable=False),
+            sa.Column("exam_id", sa.String(128), nullable=False),
+            sa.Column("version", sa.String(8), nullable=True),
+            sa.Column("file_path", sa.String(1024), nullable=False),
+            sa.Column("status", sa.String(32), nullable=True),
+            sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("max_attempts", sa.Integer(), nullable=False, server_default="5"),
+            sa.Column("available_at", sa.DateTime(), nullable=False),
+            sa.Column("lease_owner", sa.String(128), nullable=True),
+            sa.Column("lease_expires_at", sa.DateTime(), nullable=True),
+            sa.Column("last_error", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+        )
+        op.create_index("ix_jobs_id", "jobs", ["id"])
+        op.create_index("ix_jobs_sheet_id", "jobs", ["sheet_id"])
+        op.create_index("ix_jobs_status_available_at", "jobs", ["status", "available_at"])
+        op.create_index("ix_jobs_status_lease_expires_at", "jobs", ["status", "lease_expires_at"])
+
+    added_flag_count = not schema.has_column("results", "flag_count")
+    if added_flag_count:
+        op.add_column("results", sa.Column("flag_count", sa.Integer(), nullable=False, server_default="0"))
+    if not schema.has_column("results", "ratios"):
+        op.add_column("results", sa.Column("ratios", sa.LargeBinary(), nullable=True))
+    for name, columns in (("ix_results_exam_id_id", ["exam_id", "id"]), ("ix_results_exam_id_total", ["exam_id", "total"])):
+        if not schema.has_index("results", name):
+            op.create_index(name, "results", columns)
+    if added_flag_count and not context.is_offline_mode():
+        _backfill_flag_count()
+
+    if not schema.has_table("exam_stats"):
+        # rows are aggregated from the results on first use (crud.get_exam_stats)
+        op.create_table(
+            "exam_stats",
+            sa.Column("exam_id", sa.String(128), sa.ForeignKey("exams.exam_id"), primary_key=True),
+            sa.Column("count", sa.Integer(), nullable=False),
+            sa.Column("total_sum", sa.BigInteger(), nullable=False),
+            sa.Column("total_sumsq", sa.BigInteger(), nullable=False),
+            sa.Column("subject_sums", sa.JSON(), nullable=False),
+            sa.Column("histogram", sa.JSON(), nullable=False),
+            sa.Column("flagged_count", sa.Integer(), nullable=False),
+            sa.Column("version_counts", sa.JSON(), nullable=False),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+        )
+
+
+def _backfill_flag_count(chunk_size: int = 5000) -> None:
+    # flag_count = len(flags); counted here because JSON length functions differ per database
+    bind = op.get_bind()
+    results = sa.table("results", sa.column("id", sa.Integer()), sa.column("flags", sa.JSON()),
+                       sa.column("flag_count", sa.Integer()))
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(results.c.id, results.c.flags).where(results.c.id > last_id)
+            .order_by(results.c.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        counts = [{"rid": r.id, "n": len(r.flags or [])} for r in rows if r.flags]
+        if counts:
+            bind.execute(
+                results.update().where(results.c.id == sa.bindparam("rid")).values(flag_count=sa.bindparam("n")),
+                counts,
+            )
+        last_id = rows[-1].id
+
+
+def downgrade() -> None:
+    op.drop_table("exam_stats")
+    op.drop_index("ix_results_exam_id_total", "results")
+    op.drop_index("ix_results_exam_id_id", "results")
+    with op.batch_alter_table("results") as batch:
+        batch.drop_column("ratios")
+        batch.drop_column("flag_count")
+    op.drop_table("jobs")
+    with op.batch_alter_table("sheets") as batch:
+        batch.drop_index("ix_sheets_document_id")
+        batch.drop_index("ix_sheets_batch_id")
+        batch.drop_constraint("uq_sheets_exam_content_hash", type_="unique")
+        batch.drop_constraint("fk_sheets_document_id_documents", type_="foreignkey")
+        for column in ("error_message", "page_number", "document_id", "batch_id", "content_hash"):
+            batch.drop_column(column)
+    op.drop_table("documents")
+    with op.batch_alter_table("exams") as batch:
+        batch.drop_column("results_revision")
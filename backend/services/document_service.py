@@ -0,0 +1,83 @@
+# backend/services/document_service.py
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+
+from core.config import settings
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# PyMuPDF renders PDF pages; it's optional: without it only multi-page TIFFs are accepted
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+PDF_MAGIC = b"%PDF-"
+TIFF_MAGICS = (b"II*\x00", b"MM\x00*")
+# pages are stored as fast, lossless PNG
+PAGE_PNG_COMPRESSION = 1
+
+
+def sniff_document_format(head: bytes) -> Optional[str]:
+    if head.startswith(PDF_MAGIC):
+        return "pdf"
+    if head.startswith(TIFF_MAGICS):
+        return "tiff"
+    return None
+
+
+def pdf_supported() -> bool:
+    return pymupdf is not None
+
+
+def _encode_page(gray: np.ndarray) -> bytes:
+    ok, buf = cv2.imencode(".png", gray, [cv2.IMWRITE_PNG_COMPRESSION, PAGE_PNG_COMPRESSION])
+    if not ok:
+        raise ValueError("Could not encode document page")
+    return buf.tobytes()
+
+
+def _iter_tiff_pages(path: Path) -> Iterator[Tuple[int, bytes]]:
+    with Image.open(path) as im:
+        # frames are decoded one at a time on seek
+        for number, frame in enumerate(ImageSequence.Iterator(im), start=1):
+            yield number, _encode_page(np.asarray(frame.convert("L")))
+
+
+def _iter_pdf_pages(path: Path, dpi: int) -> Iterator[Tuple[int, bytes]]:
+    if pymupdf is None:
+        raise RuntimeError("PDF documents need PyMuPDF (pip install pymupdf)")
+    with pymupdf.open(str(path)) as doc:
+        for number, page in enumerate(doc, start=1):
+            pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+            yield number, pix.tobytes("png")
+
+
+class DocumentPageError(Exception):
+    """A page of the document could not be decoded or extracted."""
+
+
+def _reading_pages(pages: Iterator[Tuple[int, bytes]]) -> Iterator[Tuple[int, bytes]]:
+    # only errors raised while decoding/rendering pages; the consumer's own errors don't pass here
+    try:
+        yield from pages
+    except Exception as e:
+        raise DocumentPageError(f"{type(e).__name__}: {e}") from e
+
+
+def iter_document_pages(path: Path, fmt: str, settings_obj=settings) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yield (1-based page number, PNG bytes) for each page of a PDF or multi-page TIFF,
+    extracting one page at a time so memory stays bounded regardless of document length.
+    A page that can't be read raises DocumentPageError.
+    """
+    if fmt == "pdf":
+        return _reading_pages(_iter_pdf_pages(Path(path), settings_obj.PDF_RENDER_DPI))
+    if fmt == "tiff":
+        return _reading_pages(_iter_tiff_pages(Path(path)))
+    raise ValueError(f"Unsupported document format '{fmt}'")
@@ -1,37 +1,94 @@
 # backend/services/export_service.py
-from typing import List, Dict
-import pandas as pd
+import asyncio
+import csv
 import io
+import json
+import math
+from collections import Counter
+from datetime import datetime
+from typing import AsyncIterator, List, Dict, Optional, Tuple
+import pandas as pd
+import xlsxwriter
 from pathlib import Path
 from core.config import settings
+from services.scoring_service import SUBJECTS
+from services.template_service import get_compiled_template
 from utils.logger import get_logger
 
+# pyarrow writes the Parquet / Arrow exports; it's optional: without it only CSV and XLSX are offered
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 logger = get_logger()
 
+# columnar export formats -> (file extension, media type)
+ARROW_FORMATS = {
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "arrow": (".arrows", "application/vnd.apache.arrow.stream"),  # Arrow IPC stream
+}
+
+
+# flat export layout (CSV and the DataFrame helpers)
+EXPORT_COLUMNS = ["sheet_id", "exam_id", "student_id", "version", "total", "confidence", "created_at",
+                  "subject1", "subject2", "subject3", "subject4", "subject5", "answers_json"]
+# result columns read for an export
+EXPORT_FIELDS = ["sheet_id", "student_id", "version", "total", "confidence", "created_at", "per_subject", "answers"]
+XLSX_EXPORT_FIELDS = EXPORT_FIELDS + ["flags"]
+ARROW_EXPORT_FIELDS = EXPORT_FIELDS + ["flag_count"]
+# XLSX layout; the results sheet continues with one Q<id> column per question
+RESULT_SHEET_COLUMNS = ["sheet_id", "student_id", "version", "total", *SUBJECTS, "confidence", "flag_count",
+                        "created_at"]
+FLAGGED_SHEET_COLUMNS = ["sheet_id", "student_id", "version", "question", "reason", "score", "second_score"]
+XLSX_MAX_ROWS = 1048576  # rows per worksheet (Excel's limit; xlsxwriter drops rows beyond it)
+
+
+def flatten_result(r: Dict, exam_id: str = None) -> Dict:
+    """
+    One result (from CRUD) as a flat export row (EXPORT_COLUMNS).
+    """
+    created_at = r.get("created_at")
+    row = {
+        "sheet_id": r.get("sheet_id"),
+        "exam_id": r.get("exam_id", exam_id),
+        "student_id": r.get("student_id"),
+        "version": r.get("version"),
+        "total": r.get("total"),
+        "confidence": r.get("confidence"),
+        "created_at": created_at.isoformat() if isinstance(created_at, datetime) else created_at,
+    }
+    per_subject = r.get("per_subject") or {}
+    for i in range(1, 6):
+        row[f"subject{i}"] = per_subject.get(f"subject{i}", None)
+    # answers as a JSON string
+    row["answers_json"] = json.dumps(r.get("answers") or {}, sort_keys=True)
+    return row
+
 
 def generate_results_dataframe(results: List[Dict]) -> pd.DataFrame:
     """
     Normalize results list (from CRUD) into a flat DataFrame for export.
     """
-    rows = []
-    for r in results:
-        row = {
-            "sheet_id": r.get("sheet_id"),
-            "exam_id": r.get("exam_id"),
-            "student_id": r.get("student_id"),
-            "version": r.get("version"),
-            "total": r.get("total"),
-            "confidence": r.get("confidence"),
-            "created_at": r.get("created_at"),
-        }
-        per_subject = r.get("per_subject", {})
-        for i in range(1, 6):
-            row[f"subject{i}"] = per_subject.get(f"subject{i}", None)
-        # flatten answers if needed as JSON string
-        row["answers_json"] = str(r.get("answers", {}))
-        rows.append(row)
-    df = pd.DataFrame(rows)
-    return df
+    return pd.DataFrame([flatten_result(r) for r in results], columns=EXPORT_COLUMNS)
+
+
+async def stream_results_csv(chunks: AsyncIterator[List[Dict]], exam_id: str) -> AsyncIterator[str]:
+    """
+    Encode result chunks (crud.iter_results_by_exam) as CSV incrementally: the header, then one
+    string per chunk. Memory use is bounded by the chunk size, not the exam size.
+    """
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    async for chunk in chunks:
+        writer.writerows(flatten_result(r, exam_id) for r in chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()  # header only (no results)
 
 
 def export_results_to_csv(results: List[Dict], exam_id: str) -> str:
@@ -43,10 +100,235 @@ def export_results_to_csv(results: List[Dict], exam_id: str) -> str:
     return str(out_path)
 
 
-def export_results_to_excel_bytes(results: List[Dict]) -> bytes:
-    df = generate_results_dataframe(results)
-    stream = io.BytesIO()
-    with pd.ExcelWriter(stream, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="results")
-    stream.seek(0)
-    return stream.read()
+def template_layout(exam_id: str, settings_obj=settings) -> Tuple[Optional[List[str]], Optional[str]]:
+    """
+    (question ids in template order, compiled template digest) of the exam's template,
+    the column layout of the XLSX/Parquet/Arrow exports; (None, None) when there is no template.
+    """
+    try:
+        template = get_compiled_template(exam_id, settings_obj)
+    except Exception as e:
+        logger.info(f"No template for exam {exam_id} ({e}); question columns taken from the results")
+        return None, None
+    return list(template.qids), template.digest
+
+
+def _qid_order(q: str):
+    return (0, int(q), q) if q.isdigit() else (1, 0, q)
+
+
+class XlsxResultsWriter:
+    """
+    Results workbook written in xlsxwriter's constant_memory mode: each row is flushed to a
+    temp file as soon as the next one starts, so memory stays flat for any number of
+    candidates. Rows must be added in order.
+
+    Sheets: "summary" (per-subject statistics, filled in on close), "results" (one column
+    per question) and "flagged" (one row per flagged question), continued in "flagged_2",
+    "flagged_3", ... when it runs past Excel's row limit.
+    """
+
+    def __init__(self, path, exam_id: str, qids: Optional[List[str]] = None):
+        self.exam_id = exam_id
+        self.qids = qids
+        self.workbook = xlsxwriter.Workbook(str(path), {"constant_memory": True, "tmpdir": str(Path(path).parent)})
+        self.bold = self.workbook.add_format({"bold": True})
+        self.summary = self.workbook.add_worksheet("summary")
+        self.results = self.workbook.add_worksheet("results")
+        self.flagged = self.workbook.add_worksheet("flagged")
+        self._row = 0
+        self._flag_row = 0
+        self._flag_count = 0
+        self._flag_sheets = ["flagged"]
+        # field -> [count, sum, sum of squares, min, max]
+        self._stats = {name: [0, 0, 0, None, None] for name in ("total",) + SUBJECTS}
+        self._versions = Counter()
+
+    def _write_headers(self):
+        self.results.write_row(0, 0, RESULT_SHEET_COLUMNS + [f"Q{q}" for q in self.qids], self.bold)
+        self.results.freeze_panes(1, 2)
+        self.flagged.write_row(0, 0, FLAGGED_SHEET_COLUMNS, self.bold)
+        self._row = self._flag_row = 1
+
+    def _track(self, name: str, value):
+        if value is None:
+            return
+        st = self._stats[name]
+        st[0] += 1
+        st[1] += value
+        st[2] += value * value
+        st[3] = value if st[3] is None else min(st[3], value)
+        st[4] = value if st[4] is None else max(st[4], value)
+
+    def add_rows(self, rows: List[Dict]):
+        if self._row == 0:
+            if self.qids is None:  # no template: questions of the first result
+                self.qids = sorted((rows[0].get("answers") or {}) if rows else {}, key=_qid_order)
+            self._write_headers()
+        for r in rows:
+            answers = r.get("answers") or {}
+            per_subject = r.get("per_subject") or {}
+            flags = r.get("flags") or []
+            created_at = r.get("created_at")
+            values = [
+                r.get("sheet_id"), r.get("student_id"), r.get("version"), r.get("total"),
+                *[per_subject.get(name) for name in SUBJECTS],
+                r.get("confidence"), len(flags),
+                created_at.isoformat() if isinstance(created_at, datetime) else created_at,
+            ]
+            self.results.write_row(self._row, 0, values + [answers.get(q) for q in self.qids])
+            self._row += 1
+
+            self._versions[r.get("version") or "-"] += 1
+            self._track("total", r.get("total"))
+            for name in SUBJECTS:
+                self._track(name, per_subject.get(name))
+
+            for f in flags:
+                if self._flag_row >= XLSX_MAX_ROWS:
+                    self._next_flagged_sheet()
+                scores = f.get("scores") or [f.get("score")]
+                self.flagged.write_row(self._flag_row, 0, [
+                    r.get("sheet_id"), r.get("student_id"), r.get("version"), f.get("q"), f.get("reason"),
+                    scores[0], scores[1] if len(scores) > 1 else None,
+                ])
+                self._flag_row += 1
+                self._flag_count += 1
+
+    def _next_flagged_sheet(self):
+        name = f"flagged_{len(self._flag_sheets) + 1}"
+        self._flag_sheets.append(name)
+        self.flagged = self.workbook.add_worksheet(name)
+        self.flagged.write_row(0, 0, FLAGGED_SHEET_COLUMNS, self.bold)
+        self._flag_row = 1
+
+    def _write_summary(self):
+        ws = self.summary
+        ws.write_row(0, 0, ["exam_id", self.exam_id], self.bold)
+        ws.write_row(1, 0, ["candidates", max(self._row - 1, 0)])
+        ws.write_row(2, 0, ["flagged items", self._flag_count])
+        if len(self._flag_sheets) > 1:
+            ws.write_row(3, 0, ["flagged sheets", ", ".join(self._flag_sheets)])
+        row = 4
+        ws.write_row(row, 0, ["version", "candidates"], self.bold)
+        for version, n in sorted(self._versions.items()):
+            row += 1
+            ws.write_row(row, 0, [version, n])
+        row += 2
+        ws.write_row(row, 0, ["field", "count", "mean", "std", "min", "max"], self.bold)
+        for name, (n, total, sumsq, lo, hi) in self._stats.items():
+            row += 1
+            mean = total / n if n else None
+            std = math.sqrt(max(sumsq / n - mean * mean, 0.0)) if n else None
+            ws.write_row(row, 0, [name, n, mean, std, lo, hi])
+
+    def close(self):
+        if self._row == 0:
+            self.qids = self.qids or []
+            self._write_headers()
+        self._write_summary()
+        self.workbook.close()
+
+
+async def export_results_xlsx(chunks: AsyncIterator[List[Dict]], exam_id: str, path,
+                              qids: Optional[List[str]] = None) -> str:
+    """
+    Write result chunks (crud.iter_results_by_exam) to an XLSX file at path (XlsxResultsWriter).
+    Workbook writes run in a thread so the event loop isn't blocked.
+    """
+    writer = await asyncio.to_thread(XlsxResultsWriter, path, exam_id, qids)
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(writer.add_rows, chunk)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return str(path)
+
+
+def arrow_supported() -> bool:
+    return pa is not None
+
+
+class ArrowResultsWriter:
+    """
+    Typed, columnar results file (Parquet, or an Arrow IPC stream) written one record batch per
+    chunk, so each DB chunk becomes a Parquet row group and memory stays bounded.
+
+    Columns: sheet_id, student_id, version (dictionary), total and subject1..5 (int32),
+    confidence, flag_count (int32), created_at (timestamp) and one dictionary-encoded Q<id>
+    column per question (null = no mark).
+    """
+
+    def __init__(self, path, fmt: str, qids: Optional[List[str]] = None):
+        if pa is None:
+            raise RuntimeError("Parquet/Arrow exports need pyarrow (pip install pyarrow)")
+        if fmt not in ARROW_FORMATS:
+            raise ValueError(f"Unsupported columnar format '{fmt}'. Use one of: {', '.join(ARROW_FORMATS)}")
+        self.path = str(path)
+        self.fmt = fmt
+        self.qids = qids
+        self._writer = None
+
+    def _open(self):
+        answer_type = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema(
+            [
+                ("sheet_id", pa.string()),
+                ("student_id", pa.string()),
+                ("version", answer_type),
+                ("total", pa.int32()),
+                *[(name, pa.int32()) for name in SUBJECTS],
+                ("confidence", pa.string()),
+                ("flag_count", pa.int32()),
+                ("created_at", pa.timestamp("us")),
+                *[(f"Q{q}", answer_type) for q in self.qids],
+            ],
+            metadata={"qids": json.dumps(self.qids)},
+        )
+        if self.fmt == "parquet":
+            self._writer = pq.ParquetWriter(self.path, self.schema, compression="zstd")
+        else:
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+            self._writer = pa.ipc.new_stream(self.path, self.schema, options=options)
+
+    def add_rows(self, rows: List[Dict]):
+        if self._writer is None:
+            if self.qids is None:  # no template: questions of the first result
+                self.qids = sorted((rows[0].get("answers") or {}) if rows else {}, key=_qid_order)
+            self._open()
+        if not rows:
+            return
+        per_subject = [r.get("per_subject") or {} for r in rows]
+        answers = [r.get("answers") or {} for r in rows]
+        columns = [
+            pa.array([r.get("sheet_id") for r in rows], pa.string()),
+            pa.array([r.get("student_id") for r in rows], pa.string()),
+            pa.array([r.get("version") for r in rows], pa.string()).dictionary_encode(),
+            pa.array([r.get("total") for r in rows], pa.int32()),
+            *[pa.array([ps.get(name) for ps in per_subject], pa.int32()) for name in SUBJECTS],
+            pa.array([r.get("confidence") for r in rows], pa.string()),
+            pa.array([r.get("flag_count") for r in rows], pa.int32()),
+            pa.array([r.get("created_at") for r in rows], pa.timestamp("us")),
+            *[pa.array([a.get(q) for a in answers], pa.string()).dictionary_encode() for q in self.qids],
+        ]
+        self._writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        if self._writer is None:
+            self.qids = self.qids or []
+            self._open()
+        self._writer.close()
+
+
+async def export_results_arrow(chunks: AsyncIterator[List[Dict]], path, fmt: str,
+                               qids: Optional[List[str]] = None) -> str:
+    """
+    Write result chunks (crud.iter_results_by_exam) to a Parquet / Arrow file at path (ArrowResultsWriter).
+    """
+    writer = await asyncio.to_thread(ArrowResultsWriter, path, fmt, qids)
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(writer.add_rows, chunk)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return str(path)
@@ -0,0 +1,208 @@
+# backend/services/ingest_service.py
+import csv
+import io
+import tarfile
+import uuid
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from core.config import settings
+from services.storage_service import store_upload
+from utils.logger import get_logger
+
+logger = get_logger()
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".webp"}
+# leading bytes -> (format, stored extension)
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", ("jpeg", ".jpg")),
+    (b"\x89PNG\r\n\x1a\n", ("png", ".png")),
+    (b"II*\x00", ("tiff", ".tif")),
+    (b"MM\x00*", ("tiff", ".tif")),
+    (b"BM", ("bmp", ".bmp")),
+]
+SNIFF_BYTES = 12
+MANIFEST_NAME = "manifest.csv"
+
+
+class IngestError(ValueError):
+    """An upload that can't be ingested as a whole (reported to the client as 400)."""
+
+
+def parse_manifest(data: bytes, name: str = MANIFEST_NAME) -> Dict[str, Dict[str, Optional[str]]]:
+    """
+    Parse a CSV manifest with columns filename,student_id[,version].
+    Returns {basename: {"student_id": ..., "version": ...}}.
+    Raises IngestError when the manifest isn't UTF-8 (e.g. saved by Excel as cp1252).
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise IngestError(f"Manifest {name} is not UTF-8 encoded (byte {e.start}); save it as \"CSV UTF-8\"")
+    reader = csv.DictReader(io.StringIO(text))
+    manifest = {}
+    for row in reader:
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        name = PurePosixPath(row.get("filename", "")).name
+        if not name or not row.get("student_id"):
+            continue
+        manifest[name] = {"student_id": row["student_id"], "version": row.get("version") or None}
+    return manifest
+
+
+def sniff_image_format(head: bytes) -> Optional[Tuple[str, str]]:
+    """
+    (format, extension) from the file's magic bytes, or None if it isn't a supported image.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", ".webp"
+    for magic, fmt in IMAGE_SIGNATURES:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def _is_image(name: str) -> bool:
+    return PurePosixPath(name).suffix.lower() in IMAGE_EXTENSIONS
+
+
+class _MemberTooLarge(Exception):
+    pass
+
+
+class _LimitedReader:
+    """
+    Read-through of one upload entry (its already-sniffed head, then the rest) that fails
+    as soon as more than max_bytes were read, so an oversized or decompression-bomb
+    archive member is never written out in full.
+    """
+
+    def __init__(self, head: bytes, src: BinaryIO, max_bytes: int):
+        self._head = head
+        self._src = src
+        self._left = max_bytes
+
+    def read(self, size: int = -1) -> bytes:
+        if self._head:
+            chunk, self._head = self._head, b""
+        else:
+            chunk = self._src.read(size if size > 0 and size <= self._left else self._left + 1)
+        self._left -= len(chunk)
+        if self._left < 0:
+            raise _MemberTooLarge()
+        return chunk
+
+
+def _iter_zip(fileobj: BinaryIO):
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            with zf.open(info) as src:
+                yield PurePosixPath(info.filename).name, src
+
+
+def _iter_tar(fileobj: BinaryIO):
+    # "r|*" reads the archive as a forward-only stream (any compression)
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            src = tf.extractfile(member)
+            if src is None:
+                continue
+            yield PurePosixPath(member.name).name, src
+
+
+def iter_archive(fileobj: BinaryIO, filename: str = ""):
+    """
+    Yield (basename, readable stream) for every file in a ZIP or TAR(.gz/.bz2/.xz) archive,
+    one entry at a time.
+    """
+    head = fileobj.read(4)
+    fileobj.seek(0)
+    if head.startswith(b"PK") or filename.lower().endswith(".zip"):
+        yield from _iter_zip(fileobj)
+    else:
+        yield from _iter_tar(fileobj)
+
+
+def ingest_batch(exam_id: str, files: List[Tuple[str, BinaryIO]], archive: Optional[Tuple[str, BinaryIO]] = None,
+                 manifest_bytes: Optional[bytes] = None, settings_obj=settings, manifest_name: str = MANIFEST_NAME):
+    """
+    Stream uploaded images (loose files and/or archive entries) to content-addressed storage
+    in UPLOAD_DIR. A manifest.csv found inside the archive is used unless one was posted
+    separately. Without any manifest, the file stem is used as student_id. Entries that
+    aren't an image by their magic bytes or exceed MAX_UPLOAD_SIZE_MB are skipped.
+    Returns (rows, duplicates, skipped): rows are dicts ready for
+    crud.bulk_create_sheets_and_enqueue; duplicates are entries whose bytes repeat an earlier
+    entry of the same batch ({"filename", "content_hash"}).
+    """
+    saved: List[Tuple[str, str, str, Path, bool]] = []  # (basename, sheet_id, hash, path, created)
+    duplicates: List[Dict[str, str]] = []
+    skipped: List[Dict[str, str]] = []
+    seen = set()
+    max_bytes = settings_obj.MAX_UPLOAD_SIZE_MB * 1024 * 1024
+
+    def _take(name: str, src: BinaryIO):
+        nonlocal manifest_bytes, manifest_name
+        if name.lower() == MANIFEST_NAME:
+            if manifest_bytes is None:
+                manifest_bytes, manifest_name = src.read(), name
+            return
+        if not _is_image(name):
+            skipped.append({"filename": name, "reason": "unsupported file type"})
+            return
+        # same checks as a single upload: magic bytes and MAX_UPLOAD_SIZE_MB, per entry
+        head = src.read(SNIFF_BYTES)
+        if sniff_image_format(head) is None:
+            skipped.append({"filename": name, "reason": "unsupported file type"})
+            return
+        try:
+            content_hash, path, created = store_upload(_LimitedReader(head, src, max_bytes), name, settings_obj)
+        except _MemberTooLarge:
+            skipped.append({"filename": name, "reason": f"file exceeds {settings_obj.MAX_UPLOAD_SIZE_MB} MB"})
+            return
+        if content_hash in seen:
+            duplicates.append({"filename": name, "content_hash": content_hash})
+            return
+        seen.add(content_hash)
+        saved.append((name, str(uuid.uuid4()), content_hash, path, created))
+
+    for name, src in files:
+        _take(PurePosixPath(name or "").name, src)
+    if archive is not None:
+        archive_name, archive_file = archive
+        for name, src in iter_archive(archive_file, archive_name):
+            _take(name, src)
+
+    try:
+        manifest = parse_manifest(manifest_bytes, manifest_name) if manifest_bytes is not None else None
+    except IngestError:
+        for _, _, _, path, created in saved:
+            if created:
+                path.unlink(missing_ok=True)
+        raise
+    rows = []
+    for name, sheet_id, content_hash, path, created in saved:
+        if manifest is None:
+            meta = {"student_id": PurePosixPath(name).stem, "version": None}
+        else:
+            meta = manifest.get(name)
+            if meta is None:
+                if created:  # don't drop bytes another sheet already references
+                    path.unlink(missing_ok=True)
+                skipped.append({"filename": name, "reason": "not in manifest"})
+                continue
+        rows.append({
+            "sheet_id": sheet_id,
+            "filename": name,
+            "exam_id": exam_id,
+            "student_id": meta["student_id"],
+            "version": meta["version"],
+            "original_path": str(path),
+            "content_hash": content_hash,
+        })
+    logger.info(f"Batch ingest for exam {exam_id}: {len(rows)} sheets, {len(duplicates)} duplicates, {len(skipped)} skipped")
+    return rows, duplicates, skipped
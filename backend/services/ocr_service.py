@@ -0,0 +1,243 @@
+# backend/services/ocr_service.py
+import atexit
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pytesseract
+
+from core.config import settings
+from utils.Image_utils import prepare_header_for_ocr, parse_version_text, VERSION_OCR_WHITELIST
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# tesserocr (in requirements.txt) keeps Tesseract loaded in-process, no subprocess per call.
+# The import stays optional for hosts where it can't be built (no libtesseract headers):
+# there we fall back to pytesseract, which spawns the tesseract binary per crop.
+try:
+    from PIL import Image
+    from tesserocr import PyTessBaseAPI, PSM
+except ImportError:
+    PyTessBaseAPI = None
+
+# perceptual hash grid (w x h) of the binarized crop; crops whose hashes differ in more
+# than HASH_MAX_DISTANCE of the bits aren't compared at all
+HASH_SIZE = (64, 16)
+HASH_MAX_DISTANCE = 0.15
+# same_header: ink may move this many pixels (registration), and spots of ink up to this
+# area without counterpart in the other crop are scan noise; a changed glyph is larger
+MATCH_SLACK_PX = 2
+MATCH_NOISE_PX = 25
+MATCH_CANDIDATES = 3  # nearest memo entries confirmed per lookup
+
+
+def header_hash(th: np.ndarray) -> np.ndarray:
+    """
+    Difference hash (packed bits) of a binarized crop. Only a prefilter: re-scans of the same
+    header land within a few bits of each other, but so may "SET A" and "SET B".
+    """
+    w, h = HASH_SIZE
+    if th.size == 0:
+        return np.zeros(w * h // 8, np.uint8)
+    small = cv2.resize(th, (w + 1, h), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def _hash_distance(a: np.ndarray, b: np.ndarray) -> float:
+    return np.unpackbits(a ^ b).mean()
+
+
+def same_header(ink_a: np.ndarray, ink_b: np.ndarray) -> bool:
+    """
+    Whether two ink masks (True = dark pixel) of header crops show the same print: no spot of
+    ink larger than MATCH_NOISE_PX in either lies further than MATCH_SLACK_PX from ink in the
+    other. A changed glyph ("SET A" vs "SET B") leaves whole strokes uncovered; registration
+    jitter and speckle don't.
+    """
+    if ink_a.shape != ink_b.shape:
+        return False
+    kernel = np.ones((2 * MATCH_SLACK_PX + 1,) * 2, np.uint8)
+    for ink, other in ((ink_a, ink_b), (ink_b, ink_a)):
+        uncovered = (ink & ~cv2.dilate(other.view(np.uint8), kernel).astype(bool)).view(np.uint8)
+        if np.count_nonzero(uncovered) <= MATCH_NOISE_PX:
+            continue
+        count, _, stats, _ = cv2.connectedComponentsWithStats(uncovered, connectivity=8)
+        if count > 1 and stats[1:, cv2.CC_STAT_AREA].max() > MATCH_NOISE_PX:
+            return False
+    return True
+
+
+def _ink(th: np.ndarray) -> np.ndarray:
+    return th == 0  # binarized crops: dark text on white
+
+
+def _find_same(candidates, hash_: np.ndarray, ink: np.ndarray, get_ink):
+    """
+    Key of the first of the nearest (by hash) candidates - (key, hash) pairs - whose crop
+    (get_ink(key)) is the same header as `ink`, or None.
+    """
+    near = sorted((d, i) for i, (key, h) in enumerate(candidates)
+                  if (d := _hash_distance(h, hash_)) <= HASH_MAX_DISTANCE)
+    for _, i in near[:MATCH_CANDIDATES]:
+        key = candidates[i][0]
+        if same_header(get_ink(key), ink):
+            return key
+    return None
+
+
+class OcrEnginePool:
+    """
+    Pool of long-lived Tesseract engines (tesserocr), created lazily up to `size`.
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_engine(self):
+        api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK)
+        api.SetVariable("tessedit_char_whitelist", VERSION_OCR_WHITELIST)
+        return api
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._new_engine()
+        return self._idle.get()
+
+    def recognize(self, th: np.ndarray) -> str:
+        if PyTessBaseAPI is None:
+            config = f'--psm 6 -c tessedit_char_whitelist="{VERSION_OCR_WHITELIST}"'
+            return pytesseract.image_to_string(th, config=config)
+        api = self._acquire()
+        try:
+            api.SetImage(Image.fromarray(th))
+            return api.GetUTF8Text()
+        finally:
+            self._idle.put(api)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().End()
+            except queue.Empty:
+                break
+
+
+class OcrService:
+    """
+    Batch OCR of header crops with results memoized (LRU) per distinct header print: a crop
+    reuses the text of a memoized crop when their perceptual hashes are close and same_header
+    confirms they show the same print, so "SET A" and "SET B" never share a result.
+    """
+
+    def __init__(self, pool_size: int = 1, cache_size: int = 256):
+        self.pool = OcrEnginePool(pool_size)
+        self.cache_size = cache_size
+        # entry id -> (hash, crop shape, packed ink mask, text)
+        self._cache: "OrderedDict[int, Tuple[np.ndarray, tuple, np.ndarray, str]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, hash_: np.ndarray, ink: np.ndarray) -> Optional[str]:
+        with self._lock:
+            entries = {k: e for k, e in self._cache.items() if e[1] == ink.shape}
+        if not entries:
+            return None
+
+        def stored_ink(key):
+            _, shape, packed, _ = entries[key]
+            return np.unpackbits(packed, count=ink.size).reshape(shape).astype(bool)
+
+        key = _find_same([(k, e[0]) for k, e in entries.items()], hash_, ink, stored_ink)
+        if key is None:
+            return None
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+        return entries[key][3]
+
+    def _store(self, hash_: np.ndarray, ink: np.ndarray, text: str):
+        with self._lock:
+            self._cache[self._next_id] = (hash_, ink.shape, np.packbits(ink), text)
+            self._next_id += 1
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _recognize_safe(self, th: np.ndarray) -> Optional[str]:
+        try:
+            return self.pool.recognize(th)
+        except Exception as e:
+            logger.warning(f"OCR failed: {e}")
+            return None
+
+    def recognize_batch(self, crops: List[np.ndarray]) -> List[str]:
+        """
+        OCR a batch of binarized crops. Crops showing a memoized header (or the same header as
+        an earlier crop of the batch) are recognized once; misses run across the engine pool.
+        """
+        hashes = [header_hash(th) for th in crops]
+        inks = [_ink(th) for th in crops]
+        texts: List[Optional[str]] = [self._cached(h, ink) for h, ink in zip(hashes, inks)]
+        # misses to recognize, and for every miss the index of the crop it takes its text from
+        firsts: List[int] = []
+        source: Dict[int, int] = {}
+        for i, t in enumerate(texts):
+            if t is None:
+                same = _find_same([(j, hashes[j]) for j in firsts], hashes[i], inks[i], inks.__getitem__)
+                if same is None:
+                    firsts.append(i)
+                source[i] = i if same is None else same
+        if firsts:
+            if self.pool.size > 1 and len(firsts) > 1:
+                with ThreadPoolExecutor(max_workers=self.pool.size) as ex:
+                    results = list(ex.map(lambda i: self._recognize_safe(crops[i]), firsts))
+            else:
+                results = [self._recognize_safe(crops[i]) for i in firsts]
+            found = dict(zip(firsts, results))
+            for i, text in found.items():
+                if text is not None:  # don't memoize failures
+                    self._store(hashes[i], inks[i], text)
+            texts = [t if t is not None else found[source[i]] for i, t in enumerate(texts)]
+        return [t or "" for t in texts]
+
+    def detect_versions(self, images: List[np.ndarray], bbox=None) -> List[Optional[str]]:
+        """
+        Version token for each warped sheet image (header crop = bbox or top of page).
+        """
+        crops = [prepare_header_for_ocr(img, bbox) for img in images]
+        return [parse_version_text(t) for t in self.recognize_batch(crops)]
+
+    def detect_version(self, img: np.ndarray, bbox=None) -> Optional[str]:
+        return self.detect_versions([img], bbox)[0]
+
+    def close(self):
+        self.pool.close()
+
+
+_service: Optional[OcrService] = None
+_service_lock = threading.Lock()
+
+
+def get_ocr_service() -> OcrService:
+    """
+    Per-process OCR service (each pipeline worker process gets its own engines).
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = OcrService(pool_size=settings.OCR_POOL_SIZE, cache_size=settings.OCR_CACHE_SIZE)
+            atexit.register(_service.close)
+        return _service
@@ -1,132 +1,244 @@
 # backend/services/omr_service.py
-import json
-from pathlib import Path
 from datetime import datetime
 from typing import Optional, Dict, Tuple, List
 
+import cv2
+import numpy as np
+
 from core.config import settings
-from utils.Image_utils import load_image, rectify_perspective, compute_fill_ratio, save_overlay_image, detect_version_from_header_image
-from db import crud
+from utils.Image_utils import load_image, decode_image, page_transform, warp_to_canvas, compute_fill_ratio_matrix
 from utils.logger import get_logger
-from services.scoring_service import score_answers
+from services.ocr_service import get_ocr_service
+from services.overlay_service import schedule_prerender
+from services.result_writer import get_result_writer
+from services.scoring_service import score_detected_answers
+from services.storage_service import save_warped_image, upload_buffers
+from services.worker_pool import run_in_process_pool
+from services.template_service import CompiledTemplate, get_compiled_template
 
 logger = get_logger()
 
+# Bubble decision thresholds (on fill ratio)
+MIN_FILL_RATIO = 0.12     # best option below this -> no_mark
+AMBIGUITY_MARGIN = 0.10   # best - second below this -> ambiguous
 
-async def process_sheet(file_path: str, sheet_id: str, exam_id: str, version: Optional[str], student_id: str = None, settings_obj=settings):
+
+def classify_marks(ratios: np.ndarray, option_counts: np.ndarray,
+                   min_fill: float = MIN_FILL_RATIO, margin: float = AMBIGUITY_MARGIN):
     """
-    Process saved image file:
-      - Rectify perspective
-      - Detect version from header if not provided
-      - Load template JSON (required)
-      - Evaluate bubbles -> answers dict
-      - Score using scoring_service
-      - Save overlay and processed images
-      - Persist result via crud.create_result_record
-    """
-    template_path = Path(settings_obj.ANSWER_KEYS_DIR) / f"{exam_id}_template.json"
-    if not template_path.exists():
-        raise FileNotFoundError(f"Template file for exam '{exam_id}' not found at {template_path}.")
-
-    # load template
-    with open(template_path, "r", encoding="utf-8") as f:
-        template = json.load(f)
-    canvas_size = tuple(template.get("canvas_size", (1240, 1754)))
-
-    # load image
-    img = load_image(file_path)
-    warped = rectify_perspective(img, canvas_size)
-
-    # if version not given, try OCR on header
-    detected_version = version
-    if not detected_version:
-        try:
-            v = detect_version_from_header_image(warped)
-            if v:
-                detected_version = v
-                logger.info(f"Detected version '{detected_version}' from header OCR for sheet {sheet_id}")
-            else:
-                logger.info(f"No version detected by OCR for sheet {sheet_id}; defaulting to A")
-                detected_version = "A"
-        except Exception as e:
-            logger.warning(f"Header OCR failed for sheet {sheet_id}: {e}")
-            detected_version = "A"
-
-    answers = {}
+    Vectorized bubble decision over a ratio matrix of shape (..., Q, O).
+    option_counts: (Q,) number of real options per question (rest is padding).
+    Returns (best_idx, best_score, second_score, no_mark, ambiguous), each shaped (..., Q).
+    """
+    valid = np.arange(ratios.shape[-1]) < option_counts[:, None]
+    masked = np.where(valid, ratios, -np.inf)
+    # stable sort keeps the first option on ties, like sorted() did
+    order = np.argsort(-masked, axis=-1, kind="stable")
+    best_idx = order[..., 0]
+    best = np.take_along_axis(masked, best_idx[..., None], axis=-1)[..., 0]
+    if ratios.shape[-1] > 1:
+        second = np.take_along_axis(masked, order[..., 1:2], axis=-1)[..., 0]
+        second = np.where(np.isfinite(second), second, 0.0)
+    else:
+        second = np.zeros_like(best)
+    best = np.where(np.isfinite(best), best, 0.0)
+    no_mark = best < min_fill
+    ambiguous = ~no_mark & ((best - second) < margin)
+    return best_idx, best, second, no_mark, ambiguous
+
+
+def encode_ratios(ratios: np.ndarray) -> bytes:
+    """
+    Compact form of a sheet's (Q, O) fill-ratio matrix for storage (Result.ratios): uint8 in
+    1/255 steps, row-major. Kept so answers can be re-thresholded without the image; the
+    pipeline derives a sheet's answers from the decoded copy, so both agree.
+    """
+    return np.clip(np.rint(ratios * 255.0), 0, 255).astype(np.uint8).tobytes()
+
+
+def decode_ratios(blobs: List[bytes], shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Stack stored ratio matrices (encode_ratios) into an (N, Q, O) float32 array.
+    """
+    data = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(len(blobs), *shape)
+    return data.astype(np.float32) / 255.0
+
+
+def derive_answers(ratios: np.ndarray, template: CompiledTemplate,
+                   min_fill: float = MIN_FILL_RATIO, margin: float = AMBIGUITY_MARGIN) -> Tuple[Dict[str, Optional[str]], List[Dict]]:
+    """
+    Turn a single sheet's (Q, O) ratio matrix into the answers dict and flags list.
+    """
+    qids = template.qids
+    best_idx, best, second, no_mark, ambiguous = classify_marks(ratios, template.option_counts, min_fill, margin)
+
+    chosen = np.take_along_axis(template.option_table, best_idx[:, None], axis=1)[:, 0]
+    answers: Dict[str, Optional[str]] = {
+        qid: (None if no_mark[i] else chosen[i]) for i, qid in enumerate(qids)
+    }
     flags: List[Dict] = []
-    per_question_scores = {}
-
-    for qmeta in template["questions"]:
-        qid = str(qmeta["q"])
-        opt_scores = {}
-        for opt in qmeta["options"]:
-            opt_id = opt["id"]
-            x, y, w, h = opt["bbox"]
-            ratio = compute_fill_ratio(warped, x, y, w, h)
-            opt_scores[opt_id] = float(ratio)
-        sorted_opts = sorted(opt_scores.items(), key=lambda kv: kv[1], reverse=True)
-        best_opt, best_score = sorted_opts[0]
-        second_score = sorted_opts[1][1] if len(sorted_opts) > 1 else 0.0
-
-        if best_score < 0.12:
-            answers[qid] = None
-            flags.append({"q": int(qid), "reason": "no_mark", "score": best_score})
-        elif best_score - second_score < 0.10:
-            answers[qid] = best_opt
-            flags.append({"q": int(qid), "reason": "ambiguous", "scores": [best_score, second_score]})
+    for i in np.flatnonzero(no_mark | ambiguous):
+        if no_mark[i]:
+            flags.append({"q": int(qids[i]), "reason": "no_mark", "score": float(best[i])})
         else:
-            answers[qid] = best_opt
+            flags.append({"q": int(qids[i]), "reason": "ambiguous", "scores": [float(best[i]), float(second[i])]})
+    return answers, flags
 
-        per_question_scores[qid] = opt_scores
 
-    # Score using scoring_service (pass detected_version)
-    scoring = await score_answers(exam_id=exam_id, version=detected_version, detected_answers=answers, settings_obj=settings_obj)
+def read_version_marker(warped, template: CompiledTemplate,
+                        min_fill: float = MIN_FILL_RATIO, margin: float = AMBIGUITY_MARGIN) -> Optional[str]:
+    """
+    Read the template's version-marker bubbles with the same fill-ratio rules as answers.
+    Returns the marked version id, or None if the template has no marker or the mark
+    is missing/ambiguous.
+    """
+    if template.version_boxes is None:
+        return None
+    ratios = compute_fill_ratio_matrix(warped, template.version_boxes)
+    counts = np.array([len(template.version_ids)])
+    best_idx, _, _, no_mark, ambiguous = classify_marks(ratios, counts, min_fill, margin)
+    if no_mark[0] or ambiguous[0]:
+        return None
+    return template.version_ids[int(best_idx[0])]
+
+
+def read_student_id(warped, template: CompiledTemplate,
+                    min_fill: float = MIN_FILL_RATIO, margin: float = AMBIGUITY_MARGIN) -> Optional[str]:
+    """
+    Read the template's student-id bubble grid (one marked digit per column).
+    Returns None if the template has no grid or any column is blank/ambiguous.
+    """
+    if template.student_id_boxes is None:
+        return None
+    ratios = compute_fill_ratio_matrix(warped, template.student_id_boxes)
+    best_idx, _, _, no_mark, ambiguous = classify_marks(ratios, template.student_id_counts, min_fill, margin)
+    if no_mark.any() or ambiguous.any():
+        return None
+    return "".join(template.student_id_table[np.arange(len(best_idx)), best_idx])
 
-    per_subject = scoring["per_subject"]
-    total = scoring["total"]
-    confidence = scoring.get("confidence", "n/a")
 
-    # save overlay image
-    overlay_path = Path(settings_obj.OVERLAY_DIR) / f"{sheet_id}_overlay.jpg"
-    save_overlay_image(warped, template, answers, str(overlay_path))
+def detect_version(warped, template: CompiledTemplate, sheet_id: str) -> str:
+    """
+    Version marker bubbles first; header OCR only when there is no marker or it's unreadable.
+    Falls back to "A".
+    """
+    v = read_version_marker(warped, template)
+    if v:
+        return v
+    if template.version_boxes is not None:
+        logger.info(f"Version marker unreadable for sheet {sheet_id}; falling back to OCR")
+    try:
+        v = get_ocr_service().detect_version(warped, bbox=template.version_ocr_bbox or template.header_bbox)
+        if v:
+            logger.info(f"Detected version '{v}' from header OCR for sheet {sheet_id}")
+            return v
+        logger.info(f"No version detected by OCR for sheet {sheet_id}; defaulting to A")
+    except Exception as e:
+        logger.warning(f"Header OCR failed for sheet {sheet_id}: {e}")
+    return "A"
+
+
+def run_pipeline(file_path: str, sheet_id: str, exam_id: str, version: Optional[str], settings_obj=settings,
+                 data: Optional[bytes] = None) -> Dict:
+    """
+    CPU-bound part of sheet processing (no DB access), safe to run in a worker process:
+      - Rectify perspective
+      - Detect version (marker bubbles, header OCR fallback) if not provided
+      - Load compiled template (required)
+      - Evaluate bubbles -> answers dict (the fill-ratio matrix is kept for re-thresholding)
+      - Read the student id bubbles, when the template has them
+      - Score using scoring_service
+      - Save the processed (warped) image; the overlay is rendered on demand (overlay_service)
+    `data` is the uploaded file's bytes when still in memory (decoded instead of file_path).
+    """
+    # compiled template (cached per process, reloaded when the JSON changes)
+    template = get_compiled_template(exam_id, settings_obj)
+    canvas_size = template.canvas_size
+
+    # load image: single channel, reduced-resolution decode when the scan is much larger
+    # than the template canvas. Only the gray plane is warped and scored; colour is made for the overlay.
+    min_size = canvas_size if settings_obj.DECODE_REDUCED_RESOLUTION else None
+
+    def decode(grayscale: bool):
+        if data is not None:
+            return decode_image(data, grayscale=grayscale, min_size=min_size)
+        return load_image(file_path, grayscale=grayscale, min_size=min_size)
+
+    img = decode(grayscale=True)
+    transform = page_transform(img, canvas_size)
+    warped = warp_to_canvas(img, transform, canvas_size)
+
+    # if version not given, read the version marker (OCR on header as fallback)
+    detected_version = version or detect_version(warped, template, sheet_id)
+
+    # STORE_WARPED_GRAYSCALE=False stores a colour copy: a second (colour) decode, same warp
+    stored = warped
+    if not settings_obj.STORE_WARPED_GRAYSCALE:
+        colour = decode(grayscale=False)
+        if colour.shape[:2] != img.shape[:2]:
+            colour = cv2.resize(colour, (img.shape[1], img.shape[0]))
+        stored = warp_to_canvas(colour, transform, canvas_size)
+
+    # encoded + written (with thumbnails) by a background writer thread while we score
+    warped_write = save_warped_image(sheet_id, stored, settings_obj)
+
+    # answers come from the ratios as stored, so re-thresholding with the same thresholds
+    # (rescoring_service) reproduces them exactly instead of flipping values near a threshold
+    ratios = encode_ratios(compute_fill_ratio_matrix(warped, template.boxes))
+    answers, flags = derive_answers(decode_ratios([ratios], template.option_table.shape)[0], template)
+    student_id_read = read_student_id(warped, template)
 
-    warped_path = Path(settings_obj.PROCESSED_DIR) / f"{sheet_id}_warped.jpg"
-    warped_path.parent.mkdir(parents=True, exist_ok=True)
-    import cv2
-    cv2.imwrite(str(warped_path), warped)
+    # Score using scoring_service (pass detected_version)
+    scoring = score_detected_answers(exam_id=exam_id, version=detected_version, detected_answers=answers, settings_obj=settings_obj)
 
-    # Persist in DB: update sheet paths, create result record with student_id
-    from ..db.session import SessionLocal
-    db = SessionLocal()
-    try:
-        await crud.update_sheet_paths(db, sheet_id, warped_path=str(warped_path), overlay_path=str(overlay_path))
-        # create result record — pass provided student_id (if None, fallback to sheet record value)
-        sheet_record = await crud.get_sheet_by_id(db, sheet_id)
-        sid = student_id or (sheet_record.student_id if sheet_record else "")
-        result = await crud.create_result_record(
-            db=db,
-            sheet_id=sheet_id,
-            exam_id=exam_id,
-            student_id=sid,
-            version=detected_version,
-            answers=answers,
-            per_subject=per_subject,
-            total=total,
-            flags=flags,
-            confidence=str(confidence)
-        )
-        await crud.update_sheet_status(db, sheet_id, "processed", processed_at=datetime.utcnow())
-    finally:
-        db.close()
+    # the result is only persisted (and the image served) once the file is on disk
+    warped_path = warped_write.result()
 
     return {
         "sheet_id": sheet_id,
         "answers": answers,
-        "per_subject": per_subject,
-        "total": total,
+        "per_subject": scoring["per_subject"],
+        "total": scoring["total"],
         "flags": flags,
-        "confidence": confidence,
-        "overlay_path": str(overlay_path),
-        "warped_path": str(warped_path),
+        "confidence": scoring.get("confidence", "n/a"),
+        "overlay_path": None,  # rendered lazily by GET /overlay/{sheet_id}
+        "warped_path": warped_path,
         "version_used": detected_version,
+        "student_id_read": student_id_read,
+        "ratios": ratios,
     }
+
+
+async def process_sheet(file_path: str, sheet_id: str, exam_id: str, version: Optional[str], student_id: str = None, settings_obj=settings):
+    """
+    Process saved image file:
+      - Run the image + scoring pipeline in the process pool (see run_pipeline)
+      - Persist result, paths and status via the batching result writer
+    """
+    # uploads handled by this process are still in memory; otherwise read from disk
+    data = upload_buffers.pop(sheet_id)
+    result = await run_in_process_pool(run_pipeline, file_path, sheet_id, exam_id, version, settings_obj, data)
+
+    # Persist paths, result and status in one transaction, batched with other workers' results
+    await get_result_writer(settings_obj).write({
+        "sheet_id": sheet_id,
+        "exam_id": exam_id,
+        "student_id": student_id,  # None: keep the sheet's
+        "student_id_read": result["student_id_read"],
+        "version": result["version_used"],
+        "answers": result["answers"],
+        "per_subject": result["per_subject"],
+        "total": result["total"],
+        "flags": result["flags"],
+        "ratios": result["ratios"],
+        "confidence": str(result["confidence"]),
+        "warped_path": result["warped_path"],
+        "overlay_path": result["overlay_path"],
+        "processed_at": datetime.utcnow(),
+    })
+
+    # reviewers mostly open flagged sheets; optionally have their overlays ready
+    if result["flags"] and settings_obj.PRERENDER_FLAGGED_OVERLAYS:
+        schedule_prerender(sheet_id, exam_id, result["warped_path"], result["answers"], settings_obj)
+
+    return result
@@ -0,0 +1,172 @@
+# backend/services/overlay_service.py
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import cv2
+
+from core.config import settings
+from services.storage_service import encode_image, IMAGE_FORMATS
+from services.template_service import get_compiled_template
+from services.worker_pool import run_in_process_pool
+from utils.Image_utils import draw_overlay
+from utils.logger import get_logger
+
+logger = get_logger()
+
+def answers_digest(answers: Dict[str, Optional[str]]) -> str:
+    """
+    Short digest of the detection data; part of the cache key so a re-thresholded or
+    corrected sheet never gets a stale overlay.
+    """
+    return hashlib.sha1(json.dumps(answers, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def render_overlay(warped_path: str, exam_id: str, answers: Dict[str, Optional[str]], settings_obj=settings) -> bytes:
+    """
+    Render the review overlay from the stored warped image and the compiled template.
+    CPU-bound; runs in the process pool.
+    """
+    warped = cv2.imread(str(warped_path), cv2.IMREAD_UNCHANGED)
+    if warped is None:
+        raise FileNotFoundError(f"Warped image not found or not readable: {warped_path}")
+    template = get_compiled_template(exam_id, settings_obj)
+    return encode_image(draw_overlay(warped, template, answers), settings_obj=settings_obj)
+
+
+class OverlayCache:
+    """
+    Two-level, size-bounded LRU of rendered overlays: encoded bytes in memory, files in
+    OVERLAY_DIR. Disk eviction removes the least recently used files (by mtime) once the
+    directory exceeds its budget.
+    """
+
+    def __init__(self, directory: Path, memory_bytes: int, disk_bytes: int, ext: str = ".jpg"):
+        self.directory = Path(directory)
+        self.ext = ext
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_size = 0
+        self._disk_size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}{self.ext}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                return data
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mark as recently used for disk eviction
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._remember(key, data)
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(data)
+        self._prune_disk()
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_size -= len(old)
+            self._mem[key] = data
+            self._mem_size += len(data)
+            while self._mem_size > self.memory_bytes:
+                _, evicted = self._mem.popitem(last=False)
+                self._mem_size -= len(evicted)
+
+    def _prune_disk(self):
+        with self._lock:
+            if self._disk_size is not None and self._disk_size <= self.disk_bytes:
+                return
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.is_file() and e.name.endswith((".jpg", ".webp", ".png")):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.disk_bytes:
+            # evict down to 90% of the budget so we don't rescan on every write
+            target = int(self.disk_bytes * 0.9)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._disk_size = total
+
+
+overlay_cache = OverlayCache(
+    settings.OVERLAY_DIR,
+    memory_bytes=settings.OVERLAY_MEMORY_CACHE_MB * 1024 * 1024,
+    disk_bytes=settings.OVERLAY_DISK_CACHE_MB * 1024 * 1024,
+    ext=IMAGE_FORMATS[settings.IMAGE_STORE_FORMAT.lower()][0],
+)
+
+
+def overlay_key(sheet_id: str, answers: Dict[str, Optional[str]]) -> str:
+    """
+    Cache key (also used as the HTTP ETag) of a sheet's overlay.
+    """
+    return f"{sheet_id}_{answers_digest(answers)}"
+
+
+async def get_overlay(sheet_id: str, exam_id: str, warped_path: str, answers: Dict[str, Optional[str]],
+                      settings_obj=settings) -> bytes:
+    """
+    Overlay image (IMAGE_STORE_FORMAT) for a sheet, rendered on first request and cached afterwards.
+    """
+    key = overlay_key(sheet_id, answers)
+    data = await asyncio.to_thread(overlay_cache.get, key)
+    if data is not None:
+        return data
+    data = await run_in_process_pool(render_overlay, warped_path, exam_id, answers, settings_obj)
+    await asyncio.to_thread(overlay_cache.put, key, data)
+    return data
+
+
+_prerender_tasks = set()
+
+
+def schedule_prerender(sheet_id: str, exam_id: str, warped_path: str, answers: Dict[str, Optional[str]],
+                       settings_obj=settings):
+    """
+    Render a (flagged) sheet's overlay in the background so reviewers get it from cache.
+    """
+    async def _run():
+        try:
+            await get_overlay(sheet_id, exam_id, warped_path, answers, settings_obj)
+        except Exception as e:
+            logger.warning(f"Overlay pre-render failed for sheet {sheet_id}: {e}")
+
+    task = asyncio.get_running_loop().create_task(_run())
+    _prerender_tasks.add(task)
+    task.add_done_callback(_prerender_tasks.discard)
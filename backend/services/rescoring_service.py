@@ -0,0 +1,196 @@
+# backend/services/rescoring_service.py
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from db import crud
+from services.omr_service import classify_marks, decode_ratios
+from services.scoring_service import (
+    answer_key_cache, encode_answer_rows, encode_option, per_subject_dict, score_by_version, NO_ANSWER,
+)
+from services.template_service import CompiledTemplate, get_compiled_template
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+def _rethreshold_rows(rows, exam_id: str, template: CompiledTemplate, min_fill: float, margin: float,
+                      settings_obj=settings) -> List[Dict]:
+    """
+    Re-derive answers, flags and scores for a chunk of results from their stored ratio
+    matrices, in one vectorized pass. CPU-bound; runs in a thread.
+    rows: (id, version, ratios) rows. Returns update dicts for crud.update_results.
+    """
+    qids = template.qids
+    q_range = np.arange(len(qids))
+    ratios = decode_ratios([r.ratios for r in rows], template.option_table.shape)
+    best_idx, best, second, no_mark, ambiguous = classify_marks(ratios, template.option_counts, min_fill, margin)
+
+    # chosen option per (sheet, question): as strings for the answers JSON, as codes for scoring
+    chosen = np.where(no_mark, None, template.option_table[q_range, best_idx])
+    option_codes = np.vectorize(encode_option, otypes=[np.uint16])(template.option_table)
+    codes = np.where(no_mark, NO_ANSWER, option_codes[q_range, best_idx]).astype(np.uint16)
+    qnums = np.array([int(q) for q in qids])
+    matrix = np.zeros((len(rows), qnums.max() + 1), dtype=np.uint16)
+    matrix[:, qnums] = codes
+    per_subject, total = score_by_version(matrix, [r.version for r in rows], exam_id, settings_obj)
+
+    flags: List[List[Dict]] = [[] for _ in rows]
+    for i, q in zip(*np.nonzero(no_mark | ambiguous)):
+        if no_mark[i, q]:
+            flags[i].append({"q": int(qids[q]), "reason": "no_mark", "score": float(best[i, q])})
+        else:
+            flags[i].append({"q": int(qids[q]), "reason": "ambiguous",
+                             "scores": [float(best[i, q]), float(second[i, q])]})
+    answered = (~no_mark).sum(axis=1)
+
+    updates = []
+    for i, (row, answers) in enumerate(zip(rows, chosen.tolist())):
+        updates.append({
+            "id": row.id,
+            "answers": dict(zip(qids, answers)),
+            "flags": flags[i],
+            "flag_count": len(flags[i]),
+            "per_subject": per_subject_dict(per_subject[i]),
+            "total": int(total[i]),
+            "confidence": f"{int(answered[i])}/100",
+        })
+    return updates
+
+
+async def _write_updates(db: AsyncSession, exam_id: str, pairs: List[tuple]):
+    """
+    Bulk-update results ((update dict, current row) pairs) and move the exam aggregates along.
+    """
+    if not pairs:
+        return
+    await crud.update_results(db, [u for u, _ in pairs])
+    await crud.apply_exam_stats(
+        db,
+        removed=[{"exam_id": exam_id, "total": r.total, "per_subject": r.per_subject, "flag_count": r.flag_count,
+                  "version": r.version} for _, r in pairs],
+        added=[{"exam_id": exam_id, "total": u["total"], "per_subject": u["per_subject"],
+                "flag_count": u.get("flag_count", r.flag_count), "version": r.version} for u, r in pairs],
+    )
+
+
+async def _commit_chunk(db: AsyncSession, exam_id: str, pairs: List[tuple], columns: List[str],
+                        compute: Callable[[list], List[tuple]]) -> int:
+    """
+    Write one chunk's (update, row) pairs - computed without any lock - in a short transaction.
+    The exam row lock (bump_results_revision) keeps result writers of this exam out until
+    the commit; rows rewritten since they were read (e.g. a reprocessed sheet) are computed
+    again from their current values. Returns the number of results updated.
+    """
+    await db.rollback()  # end the read transaction: the re-read below must see committed rows
+    await crud.bump_results_revision(db, [exam_id])
+    current = {r.id: r for r in await crud.get_results_columns(db, [r.id for _, r in pairs], columns)}
+    stale = [r.id for _, r in pairs if current.get(r.id) != r]
+    if stale:
+        pairs = [(u, r) for u, r in pairs if current.get(r.id) == r]
+        pairs += compute([current[i] for i in stale if i in current])
+    await _write_updates(db, exam_id, pairs)
+    await db.commit()
+    return len(pairs)
+
+
+def _flag_marks(flags) -> list:
+    # flags compared without their ratio values (stored ones are unquantized)
+    return [(f.get("q"), f.get("reason")) for f in flags or []]
+
+
+async def rethreshold_exam(db: AsyncSession, exam_id: str, min_fill: float, margin: float, dry_run: bool = False,
+                           user: Optional[str] = None, settings_obj=settings) -> Dict:
+    """
+    Re-threshold every stored result of an exam with new bubble thresholds (see classify_marks),
+    from the fill-ratio matrices kept with the results - no image is read. Results whose
+    answers or flags change are rewritten (answers, flags, scores), one short transaction
+    per chunk (see _commit_chunk), so other writers are never held up by the whole scan.
+    Results without a matrix, or one that doesn't fit the current template, are skipped.
+    Returns {"exam_id", "results", "changed", "skipped"}; dry_run reports without writing.
+    """
+    template = await asyncio.to_thread(get_compiled_template, exam_id, settings_obj)
+    size = int(np.prod(template.option_table.shape))
+    seen = changed = skipped = 0
+
+    def usable(row) -> bool:
+        return row.ratios is not None and len(row.ratios) == size
+
+    def compute(rows) -> List[tuple]:
+        rows = [r for r in rows if usable(r)]
+        if not rows:
+            return []
+        updates = _rethreshold_rows(rows, exam_id, template, min_fill, margin, settings_obj)
+        return [(u, r) for u, r in zip(updates, rows)
+                if u["answers"] != r.answers or _flag_marks(u["flags"]) != _flag_marks(r.flags)]
+
+    columns = ["version", "answers", "flags", "ratios", "total", "per_subject", "flag_count"]
+    async for chunk in crud.iter_results_for_update(db, exam_id, columns, chunk_size=settings_obj.EXPORT_CHUNK_SIZE):
+        seen += len(chunk)
+        skipped += sum(1 for r in chunk if not usable(r))
+        pairs = await asyncio.to_thread(compute, chunk)
+        if dry_run or not pairs:
+            changed += len(pairs)
+            continue
+        changed += await _commit_chunk(db, exam_id, pairs, columns, compute)
+
+    await db.rollback()
+    if changed and not dry_run:
+        await crud.log_audit(db, None, user, "rethreshold",
+                             json.dumps({"exam_id": exam_id, "min_fill": min_fill, "margin": margin, "changed": changed}))
+        logger.info(f"Re-thresholded exam {exam_id} (min_fill={min_fill}, margin={margin}): {changed} results changed")
+    return {"exam_id": exam_id, "results": seen, "changed": changed, "skipped": skipped}
+
+
+def _rescore_rows(rows, exam_id: str, settings_obj=settings) -> List[Dict]:
+    """
+    Score a chunk of stored results against the current answer keys in one vectorized pass
+    per version. CPU-bound; runs in a thread.
+    rows: (id, version, answers, per_subject, total) rows. Returns update dicts for the
+    results whose scores change.
+    """
+    matrix = encode_answer_rows([r.answers or {} for r in rows])
+    per_subject, total = score_by_version(matrix, [r.version for r in rows], exam_id, settings_obj)
+    updates = []
+    for i, row in enumerate(rows):
+        scores = per_subject_dict(per_subject[i])
+        if int(total[i]) != row.total or scores != row.per_subject:
+            updates.append({"id": row.id, "per_subject": scores, "total": int(total[i])})
+    return updates
+
+
+async def rescore_exam(db: AsyncSession, exam_id: str, dry_run: bool = False, user: Optional[str] = None,
+                       comment: Optional[str] = None, settings_obj=settings) -> Dict:
+    """
+    Re-score every stored result of an exam against its current answer keys (e.g. after a
+    key correction) from the stored answers - no image is read. Changed totals and
+    per-subject scores are bulk-updated, one short transaction per chunk (see _commit_chunk),
+    and the run is audited.
+    Returns {"exam_id", "results", "changed"}; dry_run reports without writing.
+    """
+    answer_key_cache.invalidate(exam_id)  # pick up the corrected workbook
+    seen = changed = 0
+
+    def compute(rows) -> List[tuple]:
+        by_id = {r.id: r for r in rows}
+        return [(u, by_id[u["id"]]) for u in _rescore_rows(rows, exam_id, settings_obj)] if rows else []
+
+    columns = ["version", "answers", "per_subject", "total", "flag_count"]
+    async for chunk in crud.iter_results_for_update(db, exam_id, columns, chunk_size=settings_obj.EXPORT_CHUNK_SIZE):
+        seen += len(chunk)
+        pairs = await asyncio.to_thread(compute, chunk)
+        if dry_run or not pairs:
+            changed += len(pairs)
+            continue
+        changed += await _commit_chunk(db, exam_id, pairs, columns, compute)
+
+    await db.rollback()
+    if changed and not dry_run:
+        await crud.log_audit(db, None, user, "rescore",
+                             json.dumps({"exam_id": exam_id, "changed": changed, "comment": comment}))
+        logger.info(f"Re-scored exam {exam_id}: {changed} of {seen} results changed")
+    return {"exam_id": exam_id, "results": seen, "changed": changed}
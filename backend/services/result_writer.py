@@ -0,0 +1,111 @@
+# backend/services/result_writer.py
+import asyncio
+from typing import List, Optional, Tuple
+
+from core.config import settings
+from db import crud
+from db.session import AsyncSessionLocal
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class ResultWriter:
+    """
+    Collects sheet results from all worker slots of this process and writes them with
+    crud.persist_sheet_results: one transaction per batch of `batch_size` results, or
+    whatever is pending after `flush_ms`. write() returns once the result is committed,
+    so a job is only acked after its result is durable.
+    Each slot has at most one write pending, so a batch is also flushed as soon as every
+    slot holding a job (see job_started/job_finished) is waiting on its write: nothing
+    more can join it, and waiting for the timer would only idle the slots.
+    """
+
+    def __init__(self, batch_size: int = 50, flush_ms: int = 200):
+        self.batch_size = max(1, batch_size)
+        self.flush_ms = flush_ms
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+        self._active_jobs = 0
+
+    def job_started(self):
+        self._active_jobs += 1
+
+    def job_finished(self):
+        self._active_jobs -= 1
+        if self._pending and self._batch_full():
+            self._flush_now()
+
+    def _batch_full(self) -> bool:
+        return len(self._pending) >= max(1, min(self.batch_size, self._active_jobs))
+
+    async def write(self, item: dict):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((item, fut))
+        if self._batch_full():
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_ms / 1000, self._flush_now)
+        await fut
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            async with AsyncSessionLocal() as db:
+                await crud.persist_sheet_results(db, [item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _resolve(batch, e)
+                return
+            # one bad row must not fail the others: retry them one transaction each
+            logger.warning(f"Batched result write of {len(batch)} sheets failed ({e}); writing individually")
+            for entry in batch:
+                try:
+                    async with AsyncSessionLocal() as db:
+                        await crud.persist_sheet_result(db, entry[0])
+                    _resolve([entry])
+                except Exception as single_error:
+                    _resolve([entry], single_error)
+            return
+        _resolve(batch)
+
+    async def close(self):
+        """
+        Flush anything pending and wait for in-flight writes.
+        """
+        self._flush_now()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+def _resolve(batch, error: Optional[BaseException] = None):
+    for _, fut in batch:
+        if fut.done():
+            continue
+        if error is None:
+            fut.set_result(None)
+        else:
+            fut.set_exception(error)
+
+
+_writer: Optional[ResultWriter] = None
+
+
+def get_result_writer(settings_obj=settings) -> ResultWriter:
+    """
+    Process-wide writer (used from the event loop only, so no lock is needed).
+    """
+    global _writer
+    if _writer is None:
+        _writer = ResultWriter(settings_obj.RESULT_WRITER_BATCH_SIZE, settings_obj.RESULT_WRITER_FLUSH_MS)
+    return _writer
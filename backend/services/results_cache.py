@@ -0,0 +1,112 @@
+# backend/services/results_cache.py
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from core.config import settings
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+def results_cache_key(exam_id: str, revision: int, fmt: str, params: Optional[Dict] = None,
+                      template_digest: Optional[str] = None) -> str:
+    """
+    Cache key (also used as the HTTP ETag) of a results response: the exam, its results
+    revision, the output format and the query parameters. A new or updated result bumps
+    the revision, so entries of older revisions are never hit again and age out.
+    Formats whose columns follow the exam template also pass its compiled digest, so a
+    new or changed template isn't served the old layout.
+    """
+    raw = json.dumps([exam_id, revision, fmt, params or {}, template_digest], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ResultsCache:
+    """
+    Size-bounded LRU caches of results responses: JSON listing pages in memory, export
+    files on disk (least recently used files, by mtime, are removed over budget).
+    """
+
+    def __init__(self, directory: Path, memory_bytes: int, disk_bytes: int):
+        self.directory = Path(directory)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_size = 0
+        self._lock = threading.Lock()
+
+    # JSON pages (memory)
+    def get_page(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+            return data
+
+    def put_page(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_size -= len(old)
+            self._mem[key] = data
+            self._mem_size += len(data)
+            while self._mem_size > self.memory_bytes:
+                _, evicted = self._mem.popitem(last=False)
+                self._mem_size -= len(evicted)
+
+    # export files (disk)
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.directory / f"{key}{suffix}"
+
+    def get_file(self, key: str, suffix: str) -> Optional[Path]:
+        path = self._path(key, suffix)
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put_file(self, key: str, suffix: str, src: str) -> Optional[Path]:
+        """
+        Move a finished export file into the cache. Returns its cached path, or None when
+        the file is larger than the whole budget (src is then left where it is).
+        """
+        if os.path.getsize(src) > self.disk_bytes:
+            return None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key, suffix)
+        os.replace(src, path)
+        self._prune_disk(keep=path)
+        return path
+
+    def _prune_disk(self, keep: Path):
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.is_file():
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            if path == str(keep):
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+results_cache = ResultsCache(
+    Path(settings.RESULTS_EXPORT_DIR) / "cache",
+    memory_bytes=settings.RESULTS_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_bytes=settings.EXPORT_CACHE_DISK_MB * 1024 * 1024,
+)
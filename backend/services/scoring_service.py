@@ -1,5 +1,9 @@
 # backend/services/scoring_service.py
-from typing import Dict, Optional
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple, Iterable
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from core.config import settings
@@ -7,6 +11,132 @@ from utils.logger import get_logger
 
 logger = get_logger()
 
+# scoring layout: 1-20 => subject1, 21-40 => subject2, ...
+SUBJECTS = ("subject1", "subject2", "subject3", "subject4", "subject5")
+QUESTIONS_PER_SUBJECT = 20
+
+# Option values are encoded to small ints so keys and answers compare as arrays.
+# 0 means "no answer" (detected) / "no key" (answer key).
+NO_ANSWER = 0
+_option_codes: Dict[str, int] = {}
+_option_codes_lock = threading.Lock()
+
+
+def encode_option(value) -> int:
+    if value is None:
+        return NO_ANSWER
+    v = str(value).strip().upper()
+    if not v:
+        return NO_ANSWER
+    code = _option_codes.get(v)
+    if code is None:
+        with _option_codes_lock:
+            code = _option_codes.setdefault(v, len(_option_codes) + 1)
+    return code
+
+
+@dataclass(frozen=True, eq=False)
+class AnswerKey:
+    """
+    Array-backed answer key for one exam version. Arrays are indexed by question number.
+      - correct:       (N,) uint16 option codes, NO_ANSWER where the question has no key
+      - subject_index: (N,) int8 index into SUBJECTS, -1 if the question isn't in a subject
+      - subject_onehot: (N, len(SUBJECTS)) int32 one-hot form of subject_index, for matmul sums
+    """
+    sheet_name: str
+    correct: np.ndarray
+    subject_index: np.ndarray
+    subject_onehot: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return int(self.correct.shape[0])
+
+
+def build_answer_key(key_map: Dict[int, str], sheet_name: str = "") -> AnswerKey:
+    size = (max(key_map) if key_map else 0) + 1
+    correct = np.zeros(size, dtype=np.uint16)
+    for q, ans in key_map.items():
+        correct[q] = encode_option(ans)
+    qnums = np.arange(size)
+    subject_index = np.where(
+        (qnums >= 1) & (qnums <= QUESTIONS_PER_SUBJECT * len(SUBJECTS)),
+        (qnums - 1) // QUESTIONS_PER_SUBJECT,
+        -1,
+    ).astype(np.int8)
+    subject_onehot = np.zeros((size, len(SUBJECTS)), dtype=np.int32)
+    in_subject = np.flatnonzero(subject_index >= 0)
+    subject_onehot[in_subject, subject_index[in_subject]] = 1
+    for arr in (correct, subject_index, subject_onehot):
+        arr.setflags(write=False)
+    return AnswerKey(sheet_name=sheet_name, correct=correct, subject_index=subject_index, subject_onehot=subject_onehot)
+
+
+def encode_answers(detected_answers: Dict[str, Optional[str]], size: int) -> np.ndarray:
+    """
+    Encode {qnum_str: option} into a (size,) uint16 array indexed by question number.
+    Questions outside the key range are dropped (they can't score).
+    """
+    arr = np.zeros(size, dtype=np.uint16)
+    for qnum_str, detected in detected_answers.items():
+        q = int(qnum_str)
+        if 0 <= q < size:
+            arr[q] = encode_option(detected)
+    return arr
+
+
+def encode_answer_rows(answer_rows: Sequence[Dict[str, Optional[str]]], width: Optional[int] = None) -> np.ndarray:
+    """
+    Encode many {qnum_str: option} dicts (stored Result.answers) into an (N, width) uint16
+    matrix, column = question number; width defaults to the largest question number + 1.
+    """
+    qkeys = {k for answers in answer_rows for k in answers}
+    if width is None:
+        width = max((int(k) for k in qkeys), default=0) + 1
+    matrix = np.zeros((len(answer_rows), width), dtype=np.uint16)
+    codes: Dict[Optional[str], int] = {}
+    for k in qkeys:
+        q = int(k)
+        if not 0 <= q < width:
+            continue
+        column = [answers.get(k) for answers in answer_rows]
+        for v in set(column) - codes.keys():
+            codes[v] = encode_option(v)
+        matrix[:, q] = [codes[v] for v in column]
+    return matrix
+
+
+def score_answer_matrix(answers: np.ndarray, key: AnswerKey) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized scoring of an (N, key.size) encoded answer matrix.
+    Returns (per_subject (N, len(SUBJECTS)) int32, total (N,) int32).
+    """
+    correct = (answers == key.correct) & (key.correct != NO_ANSWER)
+    total = correct.sum(axis=-1, dtype=np.int32)
+    per_subject = correct.astype(np.int32) @ key.subject_onehot
+    return per_subject, total
+
+
+def score_by_version(answers: np.ndarray, versions: Sequence[Optional[str]], exam_id: str,
+                     settings_obj=settings) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score an (N, W) encoded answer matrix (column = question number) whose rows belong to
+    different versions: one score_answer_matrix pass per version against that version's key.
+    Returns (per_subject (N, len(SUBJECTS)) int32, total (N,) int32).
+    """
+    n, width = answers.shape
+    per_subject = np.zeros((n, len(SUBJECTS)), dtype=np.int32)
+    total = np.zeros(n, dtype=np.int32)
+    versions = np.array([_normalize_sheet_name(v) for v in versions], dtype=object)
+    for version in np.unique(versions):
+        rows = np.flatnonzero(versions == version)
+        key = get_answer_key(exam_id, version, settings_obj)
+        sub = answers[rows, :key.size]
+        if width < key.size:
+            sub = np.pad(sub, ((0, 0), (0, key.size - width)))
+        per_subject[rows], total[rows] = score_answer_matrix(sub, key)
+    return per_subject, total
+
 
 def _normalize_sheet_name(version: str) -> str:
     """
@@ -21,38 +151,45 @@ def _normalize_sheet_name(version: str) -> str:
     return v if v else "A"
 
 
-async def score_answers(exam_id: str, version: Optional[str], detected_answers: Dict[str, Optional[str]], settings_obj=settings) -> Dict:
-    """
-    Compare detected_answers (dict qnum->'A'/'B'/None) with answer key.
-    Loads answer key from Excel at data/answer_keys/{exam_id}_keys.xlsx (sheet_name=version) by default.
-    Returns dict: {"per_subject": {...}, "total": N}
-    """
+def _answer_key_path(exam_id: str, settings_obj=settings) -> Path:
     keys_path_xlsx = Path(settings_obj.ANSWER_KEYS_DIR) / f"{exam_id}_keys.xlsx"
     if not keys_path_xlsx.exists():
         # try alternative filename without suffix
         alt = Path(settings_obj.ANSWER_KEYS_DIR) / f"{exam_id}.xlsx"
         if alt.exists():
-            keys_path_xlsx = alt
-        else:
-            raise FileNotFoundError(f"Answer key file not found at {keys_path_xlsx}. Please place Excel with sheets named A/B in answer_keys directory.")
+            return alt
+        raise FileNotFoundError(f"Answer key file not found at {keys_path_xlsx}. Please place Excel with sheets named A/B in answer_keys directory.")
+    return keys_path_xlsx
+
+
+def _sheet_match_name(name: str) -> str:
+    # workbook sheets are matched ignoring case, spaces and hyphens
+    return str(name).upper().replace(" ", "").replace("-", "")
 
-    # decide sheet name
-    sheet_name = _normalize_sheet_name(version) if version else "A"
 
-    # read list of sheet names to handle lowercase or variants
+def _read_answer_key(keys_path_xlsx: Path, sheet_name: str) -> AnswerKey:
+    """
+    Load the answer key of one version from the keys workbook; sheet names are compared
+    ignoring case, spaces and hyphens. Falls back to the first sheet when none matches.
+    Raises ValueError when two sheets of the workbook match the same name.
+    """
     try:
-        xls = pd.ExcelFile(keys_path_xlsx, engine="openpyxl")
-        available_sheets = [s.upper().replace(" ", "").replace("-", "") for s in xls.sheet_names]
-        normalized_available = {s.upper().replace(" ", "").replace("-", ""): orig for orig, s in zip(xls.sheet_names, xls.sheet_names)}
-        # find best match
-        norm_requested = sheet_name.upper().replace(" ", "").replace("-", "")
-        if norm_requested in normalized_available:
-            actual_sheet_name = normalized_available[norm_requested]
-        else:
-            # fallback to first sheet
-            actual_sheet_name = xls.sheet_names[0]
-            logger.info(f"Requested sheet {sheet_name} not found; falling back to first sheet {actual_sheet_name}")
-        df = pd.read_excel(keys_path_xlsx, sheet_name=actual_sheet_name, engine="openpyxl")
+        with pd.ExcelFile(keys_path_xlsx, engine="openpyxl") as xls:
+            normalized_available = {}
+            for s in xls.sheet_names:
+                other = normalized_available.setdefault(_sheet_match_name(s), s)
+                if other != s:
+                    raise ValueError(f"Answer key sheets '{other}' and '{s}' in {keys_path_xlsx.name} "
+                                     f"can't be told apart; rename one of them")
+            # find best match
+            norm_requested = _sheet_match_name(sheet_name)
+            if norm_requested in normalized_available:
+                actual_sheet_name = normalized_available[norm_requested]
+            else:
+                # fallback to first sheet
+                actual_sheet_name = xls.sheet_names[0]
+                logger.info(f"Requested sheet {sheet_name} not found; falling back to first sheet {actual_sheet_name}")
+            df = xls.parse(sheet_name=actual_sheet_name)
     except Exception as e:
         logger.error(f"Failed reading answer key Excel: {e}")
         raise
@@ -61,30 +198,92 @@ async def score_answers(exam_id: str, version: Optional[str], detected_answers:
     if "Question" not in df.columns or "Answer" not in df.columns:
         df = df.iloc[:, :2]
         df.columns = ["Question", "Answer"]
+    df = df.dropna(subset=["Question"])
 
-    key_map = {str(int(row["Question"])): str(row["Answer"]).strip().upper() for _, row in df.iterrows()}
+    key_map = {
+        int(q): str(a).strip().upper()
+        for q, a in zip(df["Question"].to_numpy(), df["Answer"].to_numpy())
+    }
+    return build_answer_key(key_map, sheet_name=actual_sheet_name)
 
-    # scoring logic: 1-20 => subject1, 21-40 => subject2, ...
-    per_subject = {"subject1": 0, "subject2": 0, "subject3": 0, "subject4": 0, "subject5": 0}
-    total = 0
-    for qnum_str, detected in detected_answers.items():
-        if qnum_str not in key_map:
-            continue
-        correct = key_map[qnum_str]
-        if detected is not None and str(detected).strip().upper() == correct:
-            qnum = int(qnum_str)
-            if 1 <= qnum <= 20:
-                per_subject["subject1"] += 1
-            elif 21 <= qnum <= 40:
-                per_subject["subject2"] += 1
-            elif 41 <= qnum <= 60:
-                per_subject["subject3"] += 1
-            elif 61 <= qnum <= 80:
-                per_subject["subject4"] += 1
-            elif 81 <= qnum <= 100:
-                per_subject["subject5"] += 1
-            total += 1
+
+class AnswerKeyCache:
+    """
+    Process-wide cache of AnswerKey objects keyed by (exam_id, normalized version).
+    Entries are dropped when the workbook's mtime/size change.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()  # -> (path, mtime_ns, size, key)
+        self._lock = threading.Lock()
+
+    def get(self, exam_id: str, version: Optional[str], settings_obj=settings) -> AnswerKey:
+        path = _answer_key_path(exam_id, settings_obj)
+        st = path.stat()
+        cache_key = (exam_id, _normalize_sheet_name(version))
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and entry[0] == path and entry[1] == st.st_mtime_ns and entry[2] == st.st_size:
+                self._entries.move_to_end(cache_key)
+                return entry[3]
+
+        key = _read_answer_key(path, cache_key[1])
+        logger.info(f"Loaded answer key for exam {exam_id} version {cache_key[1]} from {path.name}")
+        with self._lock:
+            self._entries[cache_key] = (path, st.st_mtime_ns, st.st_size, key)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return key
+
+    def preload(self, exam_id: str, settings_obj=settings) -> int:
+        """
+        Load every sheet of the exam's workbook into the cache. Returns number of keys loaded.
+        """
+        path = _answer_key_path(exam_id, settings_obj)
+        with pd.ExcelFile(path, engine="openpyxl") as xls:
+            versions = {_normalize_sheet_name(s) for s in xls.sheet_names}
+        for v in versions:
+            self.get(exam_id, v, settings_obj)
+        return len(versions)
+
+    def invalidate(self, exam_id: Optional[str] = None):
+        with self._lock:
+            if exam_id is None:
+                self._entries.clear()
+            else:
+                for k in [k for k in self._entries if k[0] == exam_id]:
+                    del self._entries[k]
+
+
+answer_key_cache = AnswerKeyCache(max_entries=settings.ANSWER_KEY_CACHE_SIZE)
+
+
+def get_answer_key(exam_id: str, version: Optional[str], settings_obj=settings) -> AnswerKey:
+    return answer_key_cache.get(exam_id, version, settings_obj)
+
+
+def per_subject_dict(row: Iterable[int]) -> Dict[str, int]:
+    return {name: int(v) for name, v in zip(SUBJECTS, row)}
+
+
+def score_detected_answers(exam_id: str, version: Optional[str], detected_answers: Dict[str, Optional[str]], settings_obj=settings) -> Dict:
+    """
+    Compare detected_answers (dict qnum->'A'/'B'/None) with answer key.
+    Loads answer key from Excel at data/answer_keys/{exam_id}_keys.xlsx (sheet_name=version) by default.
+    Returns dict: {"per_subject": {...}, "total": N}
+    """
+    key = get_answer_key(exam_id, version, settings_obj)
+    per_subject, total = score_answer_matrix(encode_answers(detected_answers, key.size), key)
 
     answered = sum(1 for v in detected_answers.values() if v is not None)
     confidence = f"{answered}/100"
-    return {"per_subject": per_subject, "total": total, "confidence": confidence}
+    return {"per_subject": per_subject_dict(per_subject), "total": int(total), "confidence": confidence}
+
+
+async def score_answers(exam_id: str, version: Optional[str], detected_answers: Dict[str, Optional[str]], settings_obj=settings) -> Dict:
+    """
+    Async wrapper around score_detected_answers (kept for route/service callers).
+    """
+    return score_detected_answers(exam_id, version, detected_answers, settings_obj)
@@ -0,0 +1,268 @@
+# backend/services/storage_service.py
+import atexit
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import settings
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# format -> (file extension, media type)
+IMAGE_FORMATS = {
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "jpg": (".jpg", "image/jpeg"),
+}
+
+# pending background writes per process; submit() blocks beyond this (backpressure)
+MAX_PENDING_WRITES = 16
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _format(fmt: Optional[str] = None, settings_obj=settings) -> str:
+    fmt = (fmt or settings_obj.IMAGE_STORE_FORMAT).lower()
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format '{fmt}'. Use one of: {', '.join(IMAGE_FORMATS)}")
+    return fmt
+
+
+def media_type(fmt: Optional[str] = None, settings_obj=settings) -> str:
+    return IMAGE_FORMATS[_format(fmt, settings_obj)][1]
+
+
+def encode_image(img: np.ndarray, fmt: Optional[str] = None, quality: Optional[int] = None, settings_obj=settings) -> bytes:
+    """
+    Encode with the configured format/quality (IMAGE_STORE_FORMAT / IMAGE_STORE_QUALITY).
+    """
+    fmt = _format(fmt, settings_obj)
+    quality = quality or settings_obj.IMAGE_STORE_QUALITY
+    ext = IMAGE_FORMATS[fmt][0]
+    if fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif fmt == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return buf.tobytes()
+
+
+def _shard_dir(base: Path, sheet_id: str) -> Path:
+    # two-level fan-out keeps directories small at hundreds of thousands of sheets
+    return Path(base) / sheet_id[:2]
+
+
+def warped_image_path(sheet_id: str, settings_obj=settings) -> Path:
+    ext = IMAGE_FORMATS[_format(None, settings_obj)][0]
+    return _shard_dir(settings_obj.PROCESSED_DIR, sheet_id) / f"{sheet_id}_warped{ext}"
+
+
+def thumbnail_path(warped_path: str, width: int) -> Path:
+    p = Path(warped_path)
+    return p.with_name(f"{p.stem}_w{width}{p.suffix}")
+
+
+def make_thumbnails(img: np.ndarray, widths: List[int]) -> Dict[int, np.ndarray]:
+    """
+    Downscaled copies (INTER_AREA) at each width smaller than the image.
+    """
+    h, w = img.shape[:2]
+    thumbs = {}
+    for tw in sorted(set(widths)):
+        if tw >= w:
+            continue
+        th = max(1, round(h * tw / w))
+        thumbs[tw] = cv2.resize(img, (tw, th), interpolation=cv2.INTER_AREA)
+    return thumbs
+
+
+def _write_atomic(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _store_warped(img: np.ndarray, path: Path, settings_obj=settings) -> str:
+    try:
+        _write_atomic(path, encode_image(img, settings_obj=settings_obj))
+        for width, thumb in make_thumbnails(img, settings_obj.THUMBNAIL_WIDTHS).items():
+            _write_atomic(thumbnail_path(str(path), width), encode_image(thumb, settings_obj=settings_obj))
+    except Exception:
+        logger.exception(f"Failed to store warped image {path}")
+        raise
+    return str(path)
+
+
+class BackgroundWriter:
+    """
+    Per-process thread that encodes and writes images off the pipeline's critical path.
+    Non-daemon worker threads are joined at interpreter exit, so queued writes are flushed.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_WRITES):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_writer: Optional[BackgroundWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> BackgroundWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BackgroundWriter()
+            atexit.register(_writer.shutdown)
+        return _writer
+
+
+def save_warped_image(sheet_id: str, warped: np.ndarray, settings_obj=settings) -> "Future[str]":
+    """
+    Queue the warped image (+ thumbnails) for writing. Returns a future of the final path;
+    wait on it before the path is persisted or served, so it never points at a missing file.
+    """
+    path = warped_image_path(sheet_id, settings_obj)
+    return get_writer().submit(_store_warped, warped, path, settings_obj)
+
+
+def resolve_image(warped_path: str, width: Optional[int] = None) -> Tuple[Path, str]:
+    """
+    Path and media type of the stored warped image or one of its thumbnails.
+    Unknown widths fall back to the nearest larger thumbnail, else the full image.
+    """
+    path = Path(warped_path)
+    if width:
+        for tw in sorted(settings.THUMBNAIL_WIDTHS):
+            if tw >= width:
+                candidate = thumbnail_path(warped_path, tw)
+                if candidate.exists():
+                    path = candidate
+                    break
+    ext = path.suffix.lower()
+    mt = next((m for e, m in IMAGE_FORMATS.values() if e == ext), "application/octet-stream")
+    return path, mt
+
+
+def upload_path(content_hash: str, ext: str, settings_obj=settings) -> Path:
+    """
+    Content-addressed location of an upload: UPLOAD_DIR/ab/cd/<sha256><ext>.
+    """
+    return Path(settings_obj.UPLOAD_DIR) / content_hash[:2] / content_hash[2:4] / f"{content_hash}{ext}"
+
+
+def _upload_tempfile(settings_obj=settings) -> Tuple[int, str]:
+    tmp_dir = Path(settings_obj.UPLOAD_DIR) / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    return tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+
+
+def store_upload(src: BinaryIO, filename: str, settings_obj=settings) -> Tuple[str, Path, bool]:
+    """
+    Stream an upload into content-addressed storage, hashing it on the way.
+    Identical bytes are stored once. Returns (sha256 hex, path, created), where
+    created is False when the content was already on disk.
+    """
+    digest = hashlib.sha256()
+    fd, tmp = _upload_tempfile(settings_obj)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        content_hash = digest.hexdigest()
+        dest = upload_path(content_hash, Path(filename or "").suffix.lower(), settings_obj)
+        if dest.exists():
+            os.remove(tmp)
+            return content_hash, dest, False
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, dest)
+        return content_hash, dest, True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def store_upload_bytes(data: bytes, content_hash: str, ext: str, settings_obj=settings) -> Tuple[Path, bool]:
+    """
+    store_upload for an upload already in memory (hash computed by the caller).
+    Returns (path, created).
+    """
+    dest = upload_path(content_hash, ext, settings_obj)
+    if dest.exists():
+        return dest, False
+    fd, tmp = _upload_tempfile(settings_obj)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return dest, True
+
+
+class UploadBuffers:
+    """
+    Recently uploaded bytes by sheet_id, so a worker in this process can decode the upload
+    from memory instead of reading back the archived file. Bounded by total size; oldest
+    entries are dropped (they are read from disk instead).
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, sheet_id: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(sheet_id, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[sheet_id] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def pop(self, sheet_id: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._data.pop(sheet_id, None)
+            if data is not None:
+                self._size -= len(data)
+            return data
+
+
+upload_buffers = UploadBuffers(settings.UPLOAD_BUFFER_MB * 1024 * 1024)
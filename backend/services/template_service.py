@@ -0,0 +1,193 @@
+# backend/services/template_service.py
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+from core.config import settings
+from utils.logger import get_logger
+
+logger = get_logger()
+
+DEFAULT_CANVAS_SIZE = (1240, 1754)
+
+
+@dataclass(frozen=True, eq=False)
+class CompiledTemplate:
+    """
+    Immutable, array-backed form of {exam_id}_template.json.
+      - qids:          (Q,) question ids as strings, in template order
+      - option_table:  (Q, O) option ids, padded with "" for missing options
+      - option_counts: (Q,) number of real options per question
+      - boxes:         (Q, O, 4) int32 bboxes (x, y, w, h), padding boxes are all zero
+      - version_ids / version_boxes: optional version-marker bubbles ((V,), (1, V, 4))
+      - version_ocr_bbox: optional printed version code area, used as OCR fallback
+      - header_bbox: optional header box for OCR (default: top of the page)
+      - student_id_table / student_id_boxes / student_id_counts: optional student-id bubble
+        grid, one row per digit column ((D, O), (D, O, 4), (D,)), padded like the questions
+    """
+    exam_id: str
+    canvas_size: Tuple[int, int]
+    qids: Tuple[str, ...]
+    option_table: np.ndarray
+    option_counts: np.ndarray
+    boxes: np.ndarray
+    digest: str
+    version_ids: Tuple[str, ...] = ()
+    version_boxes: Optional[np.ndarray] = None
+    version_ocr_bbox: Optional[Tuple[int, int, int, int]] = None
+    header_bbox: Optional[Tuple[int, int, int, int]] = None
+    student_id_table: Optional[np.ndarray] = None
+    student_id_boxes: Optional[np.ndarray] = None
+    student_id_counts: Optional[np.ndarray] = None
+
+    @property
+    def num_questions(self) -> int:
+        return len(self.qids)
+
+
+def _readonly(arr: np.ndarray) -> np.ndarray:
+    arr.setflags(write=False)
+    return arr
+
+
+def _compile_bubble_grid(rows: List[List[dict]]):
+    """
+    [[{"id", "bbox"}, ...], ...] -> (option_table, option_counts, boxes), padded to the widest row.
+    """
+    n_opts = max((len(opts) for opts in rows), default=0)
+    boxes = np.zeros((len(rows), n_opts, 4), dtype=np.int32)
+    option_table = np.full((len(rows), n_opts), "", dtype=object)
+    option_counts = np.zeros(len(rows), dtype=np.int32)
+    for i, opts in enumerate(rows):
+        option_counts[i] = len(opts)
+        for j, opt in enumerate(opts):
+            option_table[i, j] = str(opt["id"])
+            boxes[i, j] = [int(v) for v in opt["bbox"]]
+    return option_table, option_counts, boxes
+
+
+def compile_template(raw: dict, exam_id: str = "", digest: str = "") -> CompiledTemplate:
+    """
+    Turn parsed template JSON into a CompiledTemplate.
+    """
+    questions = raw["questions"]
+    qids = [str(qmeta["q"]) for qmeta in questions]
+    option_table, option_counts, boxes = _compile_bubble_grid([qmeta["options"] for qmeta in questions])
+
+    canvas_size = tuple(int(v) for v in raw.get("canvas_size", DEFAULT_CANVAS_SIZE))
+
+    # optional version marker: {"options": [{"id": "A", "bbox": [...]}, ...], "ocr_bbox": [x, y, w, h]}
+    marker = raw.get("version_marker") or {}
+    marker_opts = marker.get("options") or []
+    version_ids = tuple(str(opt["id"]) for opt in marker_opts)
+    version_boxes = None
+    if marker_opts:
+        version_boxes = _readonly(np.array([[[int(v) for v in opt["bbox"]] for opt in marker_opts]], dtype=np.int32))
+    ocr_bbox = marker.get("ocr_bbox")
+    version_ocr_bbox = tuple(int(v) for v in ocr_bbox) if ocr_bbox else None
+    header_bbox = tuple(int(v) for v in raw["header_bbox"]) if raw.get("header_bbox") else None
+
+    # optional student id grid: {"columns": [{"options": [{"id": "0", "bbox": [...]}, ...]}, ...]}
+    sid_columns = (raw.get("student_id") or {}).get("columns") or []
+    sid_table = sid_counts = sid_boxes = None
+    if sid_columns:
+        sid_table, sid_counts, sid_boxes = (_readonly(a) for a in _compile_bubble_grid([c["options"] for c in sid_columns]))
+
+    return CompiledTemplate(
+        exam_id=exam_id,
+        canvas_size=canvas_size,
+        qids=tuple(qids),
+        option_table=_readonly(option_table),
+        option_counts=_readonly(option_counts),
+        boxes=_readonly(boxes),
+        digest=digest,
+        version_ids=version_ids,
+        version_boxes=version_boxes,
+        version_ocr_bbox=version_ocr_bbox,
+        header_bbox=header_bbox,
+        student_id_table=sid_table,
+        student_id_boxes=sid_boxes,
+        student_id_counts=sid_counts,
+    )
+
+
+def template_path(exam_id: str, settings_obj=settings) -> Path:
+    return Path(settings_obj.ANSWER_KEYS_DIR) / f"{exam_id}_template.json"
+
+
+class TemplateStore:
+    """
+    Process-wide LRU cache of compiled templates keyed by exam_id.
+    An entry is revalidated with a stat() per lookup; when mtime/size change the file
+    is re-read and only recompiled if its content hash actually changed.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # exam_id -> (mtime_ns, size, compiled)
+        self._lock = threading.Lock()
+
+    def get(self, exam_id: str, settings_obj=settings) -> CompiledTemplate:
+        path = template_path(exam_id, settings_obj)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self.invalidate(exam_id)
+            raise FileNotFoundError(f"Template file for exam '{exam_id}' not found at {path}.")
+
+        with self._lock:
+            entry = self._entries.get(exam_id)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._entries.move_to_end(exam_id)
+                return entry[2]
+
+        data = path.read_bytes()
+        digest = hashlib.sha1(data).hexdigest()
+        if entry and entry[2].digest == digest:
+            compiled = entry[2]
+        else:
+            compiled = compile_template(json.loads(data.decode("utf-8")), exam_id=exam_id, digest=digest)
+            logger.info(f"Compiled template for exam {exam_id} ({compiled.num_questions} questions)")
+
+        with self._lock:
+            self._entries[exam_id] = (st.st_mtime_ns, st.st_size, compiled)
+            self._entries.move_to_end(exam_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, exam_id: Optional[str] = None):
+        with self._lock:
+            if exam_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(exam_id, None)
+
+
+template_store = TemplateStore(max_entries=settings.TEMPLATE_CACHE_SIZE)
+
+
+def get_compiled_template(exam_id: str, settings_obj=settings) -> CompiledTemplate:
+    return template_store.get(exam_id, settings_obj)
+
+
+def preload_templates(settings_obj=settings) -> List[str]:
+    """
+    Compile every {exam_id}_template.json in ANSWER_KEYS_DIR. Returns the exam ids loaded.
+    """
+    suffix = "_template.json"
+    exam_ids = []
+    for path in sorted(Path(settings_obj.ANSWER_KEYS_DIR).glob(f"*{suffix}")):
+        exam_id = path.name[: -len(suffix)]
+        try:
+            template_store.get(exam_id, settings_obj)
+            exam_ids.append(exam_id)
+        except Exception as e:
+            logger.warning(f"Could not preload template {path.name}: {e}")
+    return exam_ids
@@ -0,0 +1,84 @@
+# backend/services/worker_pool.py
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Callable, Optional
+
+from core.config import settings
+from utils.logger import get_logger
+
+logger = get_logger()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    """
+    Runs once in every worker process: warm the compiled template and answer key
+    caches so the first sheets of each exam don't pay for JSON/Excel parsing.
+    """
+    from services.template_service import preload_templates
+    from services.scoring_service import answer_key_cache
+
+    exam_ids = preload_templates(settings)
+    for exam_id in exam_ids:
+        try:
+            answer_key_cache.preload(exam_id, settings)
+        except Exception as e:
+            logger.warning(f"Could not preload answer keys for exam {exam_id}: {e}")
+    logger.info(f"OMR worker {os.getpid()} ready ({len(exam_ids)} templates preloaded)")
+
+
+def pool_size(settings_obj=settings) -> int:
+    return settings_obj.PROCESS_POOL_WORKERS or os.cpu_count() or 1
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = pool_size()
+            # spawn: workers must not inherit the event loop / DB connections of the API process
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+            logger.info(f"Started OMR process pool with {workers} workers")
+        return _pool
+
+
+async def run_in_process_pool(fn: Callable, *args, **kwargs):
+    """
+    Run a picklable, CPU-bound callable in the process pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    try:
+        return await loop.run_in_executor(pool, partial(fn, *args, **kwargs))
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM); drop the pool so the next call starts a fresh one
+        logger.error("OMR process pool is broken; it will be restarted on next use")
+        _discard_pool(pool)
+        raise
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_process_pool(wait: bool = True):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=not wait)
@@ -1,35 +1,135 @@
 # backend/utils/image_utils.py
+import heapq
+import io
+import re
 import cv2
 import numpy as np
 from typing import Tuple, Optional
 from pathlib import Path
 import pytesseract
+from PIL import Image
 
 # If tesseract binary is not in PATH, set pytesseract.pytesseract.tesseract_cmd to the full path:
 # pytesseract.pytesseract.tesseract_cmd = r"/usr/bin/tesseract"  # adjust for your system
 
-def load_image(path: str):
-    img = cv2.imread(str(path))
+_REDUCED_FLAGS = {
+    # factor: (colour flag, grayscale flag)
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+def choose_decode_reduction(image_size: Tuple[int, int], min_size: Tuple[int, int]) -> int:
+    """
+    Largest decode reduction (1, 2, 4 or 8) that keeps the image at least min_size
+    (orientation-agnostic), so the warp to the template canvas never upsamples.
+    """
+    img_dims = sorted(image_size)
+    need = sorted(min_size)
+    for factor in (8, 4, 2):
+        if img_dims[0] // factor >= need[0] and img_dims[1] // factor >= need[1]:
+            return factor
+    return 1
+
+
+def _decode_flag(src, grayscale: bool, min_size: Optional[Tuple[int, int]]) -> int:
+    factor = 1
+    if min_size is not None:
+        try:
+            with Image.open(src) as im:  # reads the header only
+                factor = choose_decode_reduction(im.size, min_size)
+        except Exception:
+            factor = 1
+    return _REDUCED_FLAGS[factor][1 if grayscale else 0]
+
+
+def load_image(path: str, grayscale: bool = False, min_size: Optional[Tuple[int, int]] = None):
+    """
+    Decode an image from disk. grayscale=True decodes a single channel directly.
+    min_size (w, h): allow a reduced-resolution decode (JPEG decodes at 1/2, 1/4, 1/8
+    natively) as long as the result stays at least this large.
+    """
+    img = cv2.imread(str(path), _decode_flag(str(path), grayscale, min_size))
     if img is None:
         raise FileNotFoundError(f"Image not found or not readable: {path}")
     return img
 
 
-def find_largest_quad_contour(gray):
+def decode_image(data: bytes, grayscale: bool = False, min_size: Optional[Tuple[int, int]] = None):
+    """
+    Same as load_image, for an upload that is still in memory.
+    """
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), _decode_flag(io.BytesIO(data), grayscale, min_size))
+    if img is None:
+        raise ValueError("Uploaded data is not a decodable image")
+    return img
+
+
+# Page detection runs on a downscaled pyramid level no larger than this (px, longest side)
+PAGE_DETECT_MAX_DIM = 800
+# Only the k largest contours are tested for a 4-corner approximation
+PAGE_DETECT_TOP_K = 5
+
+
+def find_largest_quad_contour(gray, min_area: float = 10000, top_k: int = PAGE_DETECT_TOP_K):
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     _, th = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     contours, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
         return None
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
+    contours = heapq.nlargest(top_k, contours, key=cv2.contourArea)
     for c in contours:
         peri = cv2.arcLength(c, True)
         approx = cv2.approxPolyDP(c, 0.02 * peri, True)
-        if len(approx) == 4 and cv2.contourArea(approx) > 10000:
+        if len(approx) == 4 and cv2.contourArea(approx) > min_area:
             return approx.reshape(4, 2)
     return None
 
 
+def build_pyramid_level(gray, max_dim: int = PAGE_DETECT_MAX_DIM):
+    """
+    pyrDown until the longest side is <= max_dim. Returns (level, (scale_x, scale_y))
+    where full-res coords = level coords * scale.
+    """
+    level = gray
+    while max(level.shape[:2]) > max_dim:
+        level = cv2.pyrDown(level)
+    scale = (gray.shape[1] / level.shape[1], gray.shape[0] / level.shape[0])
+    return level, scale
+
+
+def refine_corners(gray, corners: np.ndarray, search_radius: int) -> np.ndarray:
+    """
+    Sub-pixel refinement of approximate page corners on the full-resolution image.
+    Corners that drift further than the search window are kept at their initial estimate.
+    """
+    pts = corners.astype(np.float32).reshape(-1, 1, 2)
+    win = int(min(max(search_radius, 5), 40))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 50, 0.01)
+    refined = cv2.cornerSubPix(gray, pts.copy(), (win, win), (-1, -1), criteria)
+    drift = np.linalg.norm(refined - pts, axis=2).ravel()
+    refined[drift > 2 * win] = pts[drift > 2 * win]
+    return refined.reshape(-1, 2)
+
+
+def detect_page_corners(gray, max_dim: int = PAGE_DETECT_MAX_DIM) -> Optional[np.ndarray]:
+    """
+    Find the sheet's four corners: contour search on a pyramid level, then
+    sub-pixel refinement at full resolution. Returns (4, 2) float32 or None.
+    """
+    level, (sx, sy) = build_pyramid_level(gray, max_dim)
+    quad = find_largest_quad_contour(level, min_area=10000 / (sx * sy))
+    if quad is None:
+        return None
+    corners = quad.astype(np.float32) * np.array([sx, sy], dtype=np.float32)
+    if sx > 1 or sy > 1:
+        # approxPolyDP vertices are typically within ~2 level pixels of the true corner
+        corners = refine_corners(gray, corners, search_radius=int(np.ceil(3 * max(sx, sy))))
+    return corners
+
+
 def order_points_clockwise(pts):
     rect = np.zeros((4, 2), dtype="float32")
     s = pts.sum(axis=1)
@@ -41,20 +141,34 @@ def order_points_clockwise(pts):
     return rect
 
 
-def rectify_perspective(img, out_size: Tuple[int, int] = (1240, 1754)):
+def page_transform(gray, out_size: Tuple[int, int] = (1240, 1754)) -> Optional[np.ndarray]:
     """
-    Warp the sheet to canonical size. If no sheet boundary found, resize to out_size.
+    Perspective transform that maps the detected sheet onto the out_size canvas,
+    or None when no sheet boundary is found.
     """
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    quad = find_largest_quad_contour(gray)
+    quad = detect_page_corners(gray)
     if quad is None:
-        h, w = out_size[1], out_size[0]
-        return cv2.resize(img, (w, h))
+        return None
     rect = order_points_clockwise(quad)
     dst = np.array([[0, 0], [out_size[0] - 1, 0], [out_size[0] - 1, out_size[1] - 1], [0, out_size[1] - 1]], dtype="float32")
-    M = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(img, M, out_size)
-    return warped
+    return cv2.getPerspectiveTransform(rect, dst)
+
+
+def warp_to_canvas(img, M: Optional[np.ndarray], out_size: Tuple[int, int] = (1240, 1754)):
+    """
+    Apply a page_transform result (None: plain resize to out_size).
+    """
+    if M is None:
+        return cv2.resize(img, out_size)
+    return cv2.warpPerspective(img, M, out_size)
+
+
+def rectify_perspective(img, out_size: Tuple[int, int] = (1240, 1754)):
+    """
+    Warp the sheet to canonical size. If no sheet boundary found, resize to out_size.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    return warp_to_canvas(img, page_transform(gray, out_size), out_size)
 
 
 def compute_fill_ratio(warped_bgr, x: int, y: int, w: int, h: int) -> float:
@@ -69,7 +183,7 @@ def compute_fill_ratio(warped_bgr, x: int, y: int, w: int, h: int) -> float:
     roi = warped_bgr[y0:y1, x0:x1]
     if roi.size == 0:
         return 0.0
-    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
     # adaptive threshold
     th = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                cv2.THRESH_BINARY_INV, 11, 2)
@@ -81,16 +195,66 @@ def compute_fill_ratio(warped_bgr, x: int, y: int, w: int, h: int) -> float:
     return float(ratio)
 
 
-def draw_overlay(warped_bgr, template: dict, answers: dict):
-    overlay = warped_bgr.copy()
-    for qmeta in template["questions"]:
-        qid = str(qmeta["q"])
-        for opt in qmeta["options"]:
-            x, y, w, h = opt["bbox"]
-            x1, y1, x2, y2 = int(x), int(y), int(x + w), int(y + h)
+def binarize_sheet(warped_bgr):
+    """
+    Threshold an image (or canvas region) in one pass, same pipeline as compute_fill_ratio.
+    Returns a uint8 mask where dark (marked) pixels are 1.
+    """
+    gray = cv2.cvtColor(warped_bgr, cv2.COLOR_BGR2GRAY) if warped_bgr.ndim == 3 else warped_bgr
+    th = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                               cv2.THRESH_BINARY_INV, 11, 2)
+    kernel = np.ones((3, 3), np.uint8)
+    return cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel)
+
+
+def compute_fill_ratio_matrix(warped_bgr, boxes: np.ndarray) -> np.ndarray:
+    """
+    Vectorized compute_fill_ratio for every bbox on the sheet.
+    boxes: int array (..., 4) of x, y, w, h. Empty boxes (w or h == 0) give 0.0.
+    Returns float32 array of ratios with shape boxes.shape[:-1].
+    """
+    h_img, w_img = warped_bgr.shape[:2]
+    boxes = np.asarray(boxes, dtype=np.int64)
+    x0 = np.clip(boxes[..., 0], 0, w_img)
+    y0 = np.clip(boxes[..., 1], 0, h_img)
+    x1 = np.maximum(np.clip(boxes[..., 0] + boxes[..., 2], 0, w_img), x0)
+    y1 = np.maximum(np.clip(boxes[..., 1] + boxes[..., 3], 0, h_img), y0)
+    area = (x1 - x0) * (y1 - y0)
+    ratios = np.zeros(area.shape, dtype=np.float32)
+    if not np.any(area > 0):
+        return ratios
+
+    # only binarize the region covering the bubbles (+ margin for the threshold/morph windows)
+    pad = 8
+    live = area > 0
+    cx0 = max(0, int(x0[live].min()) - pad)
+    cy0 = max(0, int(y0[live].min()) - pad)
+    cx1 = min(w_img, int(x1[live].max()) + pad)
+    cy1 = min(h_img, int(y1[live].max()) + pad)
+    mask = binarize_sheet(warped_bgr[cy0:cy1, cx0:cx1])
+
+    # integral image has a leading row/col of zeros: sum = I[y1,x1] - I[y0,x1] - I[y1,x0] + I[y0,x0]
+    integral = cv2.integral(mask, sdepth=cv2.CV_32S)
+    x0, x1 = np.clip(x0 - cx0, 0, cx1 - cx0), np.clip(x1 - cx0, 0, cx1 - cx0)
+    y0, y1 = np.clip(y0 - cy0, 0, cy1 - cy0), np.clip(y1 - cy0, 0, cy1 - cy0)
+    filled = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    np.divide(filled, area, out=ratios, where=live, casting="unsafe")
+    return ratios
+
+
+def draw_overlay(warped_bgr, template, answers: dict):
+    """
+    template: CompiledTemplate (see services/template_service.py).
+    A grayscale warped image is converted to colour here, only for the overlay.
+    """
+    overlay = cv2.cvtColor(warped_bgr, cv2.COLOR_GRAY2BGR) if warped_bgr.ndim == 2 else warped_bgr.copy()
+    for i, qid in enumerate(template.qids):
+        selected = answers.get(qid)
+        for j in range(int(template.option_counts[i])):
+            x, y, w, h = (int(v) for v in template.boxes[i, j])
+            x1, y1, x2, y2 = x, y, x + w, y + h
             cv2.rectangle(overlay, (x1, y1), (x2, y2), (0, 255, 0), 1)
-            selected = answers.get(qid)
-            if selected == opt["id"]:
+            if selected == template.option_table[i, j]:
                 cv2.rectangle(overlay, (x1, y1), (x2, y2), (0, 0, 255), 2)
                 cv2.putText(overlay, "X", (x1 + 3, y1 + h - 3), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
     return overlay
@@ -116,28 +280,44 @@ def crop_header_region(img_bgr, header_height_ratio: float = 0.20):
     return img_bgr[0:crop_h, :]
 
 
-def detect_version_from_header_image(img_bgr) -> Optional[str]:
+def crop_bbox(img, bbox):
     """
-    Try to detect the sheet version text from header using OCR.
-    Returns 'A' or 'B' (or other detected token), or None if not found.
+    Crop an (x, y, w, h) box, clipped to the image.
+    """
+    x, y, w, h = (int(v) for v in bbox)
+    h_img, w_img = img.shape[:2]
+    return img[max(0, y):min(h_img, y + h), max(0, x):min(w_img, x + w)]
+
+
+# OCR: allow uppercase letters and -_, A B characters
+VERSION_OCR_WHITELIST = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789- "
+
+
+def prepare_header_for_ocr(img_bgr, bbox=None):
     """
-    header = crop_header_region(img_bgr, header_height_ratio=0.18)  # tuned
-    gray = cv2.cvtColor(header, cv2.COLOR_BGR2GRAY)
+    Crop the header (bbox (x, y, w, h) if given, else the top 18% of the page) and
+    binarize it for OCR.
+    """
+    if bbox is not None:
+        header = crop_bbox(img_bgr, bbox)
+    else:
+        header = crop_header_region(img_bgr, header_height_ratio=0.18)  # tuned
+    gray = cv2.cvtColor(header, cv2.COLOR_BGR2GRAY) if header.ndim == 3 else header
     # simple preprocessing to boost OCR
     gray = cv2.GaussianBlur(gray, (3, 3), 0)
     _, th = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    # OCR: allow uppercase letters and -_, A B characters
-    config = r'--psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789- '
-    try:
-        text = pytesseract.image_to_string(th, config=config)
-    except Exception:
-        text = ""
+    return th
+
+
+def parse_version_text(text: str) -> Optional[str]:
+    """
+    Extract the version token from OCR'd header text.
+    """
     if not text:
         return None
     text = text.upper().replace(" ", "").replace("SET", "SET").replace(":", "").replace(".", "")
     # common patterns: "SET-A", "SET A", "A", "SET-A.", "SET NO: A"
     # Search for 'SET' then look for following letter
-    import re
     m = re.search(r"SET[-:]?([A-Z0-9])", text)
     if m:
         return m.group(1)
@@ -152,3 +332,19 @@ def detect_version_from_header_image(img_bgr) -> Optional[str]:
     if "SETB" in text:
         return "B"
     return None
+
+
+def detect_version_from_header_image(img_bgr, bbox=None) -> Optional[str]:
+    """
+    Try to detect the sheet version text from header using OCR (one tesseract run per call;
+    the pipeline uses services/ocr_service.py, which pools engines and caches results).
+    bbox: optional (x, y, w, h) of the printed version code; defaults to the top 18% of the page.
+    Returns 'A' or 'B' (or other detected token), or None if not found.
+    """
+    th = prepare_header_for_ocr(img_bgr, bbox)
+    config = f'--psm 6 -c tessedit_char_whitelist="{VERSION_OCR_WHITELIST}"'
+    try:
+        text = pytesseract.image_to_string(th, config=config)
+    except Exception:
+        text = ""
+    return parse_version_text(text)
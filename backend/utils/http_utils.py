@@ -0,0 +1,74 @@
+# backend/utils/http_utils.py
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+
+def file_etag(path: Path) -> str:
+    """
+    Weak-enough validator for an immutable-by-name file: mtime + size.
+    """
+    st = Path(path).stat()
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    True if the request's If-None-Match header matches etag (handles lists, W/ and *).
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return any(c == etag or c.removeprefix("W/") == etag for c in candidates)
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware capping request bodies per path suffix ({suffix: max bytes}).
+    Rejects on Content-Length up front, and otherwise stops reading (413) as soon as the
+    streamed body passes the limit, before it is spooled any further.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    def _limit(self, path: str) -> Optional[int]:
+        path = path.rstrip("/")
+        for suffix, limit in self.limits.items():
+            if path.endswith(suffix):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        limit = self._limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            await JSONResponse(status_code=413, content={"detail": _too_large(limit)})(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=_too_large(limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _too_large(limit: int) -> str:
+    return f"Request body exceeds {limit // (1024 * 1024)} MB"
@@ -0,0 +1,161 @@
+# backend/worker.py
+"""
+Standalone OMR processing worker.
+
+    python -m backend.worker            (from the repository root)
+    python -m worker                    (from backend/)
+
+Claims jobs from the `jobs` table, runs the pipeline in the process pool and persists
+results. Any number of workers (on any number of nodes) can share one database.
+"""
+import sys
+from pathlib import Path
+
+if __package__ == "backend":
+    # backend modules import each other as top-level packages (core, db, services, ...)
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import argparse
+import asyncio
+import os
+import socket
+from typing import Optional
+
+from core.config import settings
+from db import crud
+from db.session import AsyncSessionLocal, async_engine
+from services import omr_service
+from services.result_writer import get_result_writer
+from services.worker_pool import pool_size, shutdown_process_pool
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# missing template / answer key / image, undecodable image: retrying can't help
+NON_RETRYABLE_ERRORS = (FileNotFoundError, ValueError)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def _renew_lease(job_id: int, worker_id: str, settings_obj=settings):
+    """
+    Keep extending the lease of a running job so a sheet that takes longer than
+    JOB_LEASE_SECONDS isn't re-claimed and processed a second time. Cancelled when the job ends.
+    """
+    lease_seconds = settings_obj.JOB_LEASE_SECONDS
+    while True:
+        await asyncio.sleep(max(lease_seconds / 3, 1))
+        try:
+            async with AsyncSessionLocal() as db:
+                if not await crud.renew_job_lease(db, job_id, worker_id, lease_seconds):
+                    logger.warning(f"Lost the lease of job {job_id}")
+                    return
+        except Exception:
+            logger.exception(f"Failed to renew the lease of job {job_id}")
+
+
+async def _run_job(db, job, settings_obj=settings):
+    worker_id = job.lease_owner
+    if job.attempts > job.max_attempts:
+        # lease kept expiring (worker crashes); don't try again
+        if await crud.fail_job(db, job.id, worker_id, f"lease expired after {job.max_attempts} attempts", 0) is None:
+            logger.warning(f"Stale failure of job {job.id} dropped: lease taken over by another worker")
+        return
+    renewal = asyncio.create_task(_renew_lease(job.id, worker_id, settings_obj))
+    try:
+        await omr_service.process_sheet(job.file_path, job.sheet_id, job.exam_id, job.version, settings_obj=settings_obj)
+    except Exception as e:
+        retryable = not isinstance(e, NON_RETRYABLE_ERRORS)
+        logger.exception(f"Error processing sheet {job.sheet_id} (attempt {job.attempts}/{job.max_attempts})")
+        status = await crud.fail_job(db, job.id, worker_id, f"{type(e).__name__}: {e}",
+                                     settings_obj.JOB_RETRY_BACKOFF_SECONDS, retryable=retryable)
+        if status is None:
+            logger.warning(f"Stale failure of job {job.id} dropped: lease taken over by another worker")
+        elif status == "dead":
+            logger.error(f"Sheet {job.sheet_id} dead-lettered after {job.attempts} attempts"
+                         + ("" if retryable else " (error is not retryable)"))
+        return
+    finally:
+        renewal.cancel()
+    if not await crud.complete_job(db, job.id, worker_id):
+        logger.warning(f"Stale ack of job {job.id} dropped: lease taken over by another worker")
+
+
+async def _process_job(db, job, settings_obj=settings):
+    """
+    Process one leased job and ack it. A failure to record the outcome (e.g. a transient
+    "database is locked") is logged and rolled back; the job stays leased and is picked up
+    again once its lease expires, so the slot keeps running.
+    """
+    try:
+        await _run_job(db, job, settings_obj)
+    except Exception:
+        logger.exception(f"Failed to record the outcome of job {job.id} (sheet {job.sheet_id})")
+        await db.rollback()
+
+
+async def _slot(worker_id: str, stop: asyncio.Event, settings_obj=settings):
+    """
+    One job at a time: claim, process, ack. Sleeps for the poll interval when the queue is empty.
+    """
+    writer = get_result_writer(settings_obj)
+    async with AsyncSessionLocal() as db:
+        while not stop.is_set():
+            try:
+                job = await crud.claim_job(db, worker_id, settings_obj.JOB_LEASE_SECONDS)
+            except Exception:
+                logger.exception("Failed to claim job")
+                await db.rollback()
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=settings_obj.JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            writer.job_started()
+            try:
+                await _process_job(db, job, settings_obj)
+            finally:
+                writer.job_finished()
+
+
+async def run_worker(stop: asyncio.Event, worker_id: Optional[str] = None, concurrency: Optional[int] = None,
+                     settings_obj=settings):
+    """
+    Run `concurrency` claim/process loops until `stop` is set.
+    """
+    worker_id = worker_id or default_worker_id()
+    concurrency = concurrency or settings_obj.WORKER_CONCURRENCY or pool_size(settings_obj)
+    logger.info(f"OMR worker {worker_id} started with concurrency {concurrency}")
+    await asyncio.gather(*(_slot(f"{worker_id}/{i}", stop, settings_obj) for i in range(concurrency)))
+    await get_result_writer(settings_obj).close()
+    logger.info(f"OMR worker {worker_id} stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OMR processing worker")
+    parser.add_argument("--worker-id", default=None, help="lease owner name (default: host:pid)")
+    parser.add_argument("--concurrency", type=int, default=None, help="jobs in flight (default: WORKER_CONCURRENCY or pool size)")
+    args = parser.parse_args(argv)
+
+    async def _run():
+        stop = asyncio.Event()
+        try:
+            await run_worker(stop, worker_id=args.worker_id, concurrency=args.concurrency)
+        finally:
+            stop.set()
+            await async_engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_process_pool()
+
+
+if __name__ == "__main__":
+    main()
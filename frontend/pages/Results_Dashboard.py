@@ -1,22 +1,51 @@
 import streamlit as st
 import pandas as pd
-from utils.api_client import get_results
+from utils.api_client import get_results, get_results_summary
 
 st.set_page_config(page_title="Results Dashboard", page_icon="📊")
 
 st.header("📊 Results Dashboard")
 
 exam_id = st.number_input("Enter Exam ID", min_value=1, step=1)
+page_size = st.selectbox("Rows per page", [50, 100, 500], index=1)
+flagged_only = st.checkbox("Flagged sheets only")
 
-if st.button("Fetch Results"):
-    with st.spinner("Fetching results..."):
-        results = get_results(exam_id)
-        if results and "students" in results:
-            df = pd.DataFrame(results["students"])
-            st.dataframe(df, use_container_width=True)
+if "results_cursors" not in st.session_state:
+    st.session_state.results_cursors = [None]  # cursor of each visited page
 
+
+def fetch_page():
+    cursor = st.session_state.results_cursors[-1]
+    return get_results(exam_id, cursor=cursor, limit=page_size, flagged=True if flagged_only else None)
+
+
+col_first, col_prev, col_next = st.columns(3)
+if col_first.button("Fetch Results"):
+    st.session_state.results_cursors = [None]
+    st.session_state.results_page = fetch_page()
+if col_prev.button("⬅️ Previous") and len(st.session_state.results_cursors) > 1:
+    st.session_state.results_cursors.pop()
+    st.session_state.results_page = fetch_page()
+if col_next.button("Next ➡️") and st.session_state.get("results_page", {}).get("next_cursor") is not None:
+    st.session_state.results_cursors.append(st.session_state.results_page["next_cursor"])
+    st.session_state.results_page = fetch_page()
+
+results = st.session_state.get("results_page")
+if results is not None:
+    if results.get("results"):
+        summary = get_results_summary(exam_id)
+        if "count" in summary:
             st.subheader("📈 Performance Summary")
-            st.metric("Total Students", len(df))
-            st.metric("Average Score", df["score"].mean())
-        else:
-            st.warning("No results found for this exam.")
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("Total Students", summary["count"])
+            c2.metric("Average Score", summary["mean"])
+            c3.metric("Std. Deviation", summary["std"])
+            c4.metric("Flagged Sheets", summary["flagged"])
+            st.bar_chart(pd.Series(summary["histogram"], name="students").rename(lambda k: int(k)).sort_index())
+            st.dataframe(pd.DataFrame({"mean": summary["subject_means"]}), use_container_width=True)
+
+        df = pd.DataFrame(results["results"])
+        st.caption(f"Page {len(st.session_state.results_cursors)}")
+        st.dataframe(df, use_container_width=True)
+    else:
+        st.warning("No results found for this exam.")
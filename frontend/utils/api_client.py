@@ -3,6 +3,8 @@ import os
 import streamlit as st
 
 BASE_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+# the results router is mounted at /api/results and has its own /results prefix
+RESULTS_URL = f"{BASE_URL}/api/results/results"
 
 def get_headers():
     """Attach JWT token if available."""
@@ -17,8 +19,16 @@ def upload_sheet(file, exam_id: int, set_no: str):
     response = requests.post(f"{BASE_URL}/omr/upload/", files=files, data=data, headers=get_headers())
     return response.json()
 
-def get_results(exam_id: int):
-    response = requests.get(f"{BASE_URL}/results/{exam_id}", headers=get_headers())
+def get_results(exam_id: int, cursor: int = None, limit: int = 100, **filters):
+    """One page of results; pass the returned next_cursor to get the next page."""
+    params = {"limit": limit, **{k: v for k, v in filters.items() if v is not None}}
+    if cursor is not None:
+        params["cursor"] = cursor
+    response = requests.get(f"{RESULTS_URL}/exam/{exam_id}", params=params, headers=get_headers())
+    return response.json()
+
+def get_results_summary(exam_id: int):
+    response = requests.get(f"{RESULTS_URL}/exam/{exam_id}/summary", headers=get_headers())
     return response.json()
 
 def export_results(exam_id: int, format: str = "excel"):